@@ -1,8 +1,10 @@
 # app/main.py (最终版: 初始加载时预取所有数据)
 
 import requests
+from requests.adapters import HTTPAdapter
+import numpy as np
 import pandas as pd
-from flask import Flask, render_template, jsonify, request as flask_request, redirect, url_for, Response
+from flask import Flask, render_template, jsonify, request as flask_request, redirect, url_for, Response, stream_with_context, get_template_attribute, g as flask_g
 import json
 import sys
 import os
@@ -11,6 +13,16 @@ import time
 import platform
 import concurrent.futures
 import datetime
+import threading
+import sqlite3
+import contextlib
+import queue
+import itertools
+import random
+import collections
+import gzip
+import hashlib
+import logging
 
 # --- 应用程序配置 ---
 app = Flask(__name__)
@@ -21,31 +33,1019 @@ PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 # 使用项目根目录来定位 templates 文件夹
 app.template_folder = os.path.join(PROJECT_ROOT, 'templates')
 
-BASE_URL = "https://localhost:5000/v1/api/"
+# 网关地址可通过环境变量覆盖, 例如指向 scripts/mock_gateway.py 做离线基准测试
+BASE_URL = os.environ.get('IBKR_GATEWAY_URL', "https://localhost:5000/v1/api/")
 requests.packages.urllib3.disable_warnings(requests.packages.urllib3.exceptions.InsecureRequestWarning)
 
-# 全局变量用于缓存历史表现数据
-performance_cache = {}
+# 网关 I/O 调度: 整个进程同时在途的网关请求上限, 以及其中可被历史表现等后台任务占用的上限
+GATEWAY_MAX_CONCURRENCY = int(os.environ.get('IBKR_GATEWAY_MAX_CONCURRENCY', 16))
+GATEWAY_BACKGROUND_CONCURRENCY = int(os.environ.get('IBKR_GATEWAY_BACKGROUND_CONCURRENCY', 4))
+# 调度优先级 (数值越小越先执行): 价格 > 认证 > 账户/持仓 > 历史表现
+PRIORITY_PRICES = 0
+PRIORITY_AUTH = 1
+PRIORITY_PORTFOLIO = 2
+PRIORITY_PERFORMANCE = 3
+# 网关限速: 各接口族的令牌桶 (每秒请求数, 突发容量, 最大并发), 速率取自 Client Portal 文档中各接口的限速;
+# 文档未单独限速的接口族速率为 None (不限速), 只有被网关返回 429/503 后才开始限速
+GATEWAY_RATE_LIMITS = {
+    'marketdata': (10.0, 10, 4),            # iserver/marketdata/snapshot: 10 次/秒
+    'portfolio_accounts': (1 / 5, 1, 1),    # portfolio/accounts, portfolio/subaccounts: 每 5 秒 1 次
+    'performance': (1 / 900, 1, 1),         # pa/performance 等: 每 15 分钟 1 次
+    'tickle': (1.0, 1, 1),                  # tickle: 1 次/秒
+    'portfolio': (None, 0, 8),
+    'auth': (None, 0, 2),
+    'default': (None, 0, 8),
+}
+# 不限速的接口族被限流后的起始速率 (网关整体限速为 10 次/秒), 之后乘性减、加性增, 恢复到该速率后重新取消限速
+GATEWAY_UNLIMITED_FALLBACK_RATE = 10.0
+# 成功请求后的加性增量 (每次成功增加上限速率的该比例)
+GATEWAY_RATE_INCREASE_FRACTION = 0.05
+GATEWAY_THROTTLE_STATUS = (429, 503)
+GATEWAY_MAX_RETRIES = int(os.environ.get('IBKR_GATEWAY_MAX_RETRIES', 3))
+GATEWAY_BACKOFF_BASE_SECONDS = 0.5
+GATEWAY_BACKOFF_MAX_SECONDS = 8.0
+# 网关健康检查: 状态正常时的复查间隔; 未就绪时从最小间隔开始指数退避到上限 (状态变化时才回到最小间隔);
+# 有人在等待 (启动时的 wait_until, 或登录页最近轮询过 /api/check_auth) 时间隔不超过最小间隔, 轮询在该时长内视为仍在等待;
+# 启动时等待网关可访问的最长时间
+GATEWAY_HEALTH_INTERVAL_SECONDS = float(os.environ.get('IBKR_GATEWAY_HEALTH_INTERVAL', 10.0))
+GATEWAY_HEALTH_MIN_INTERVAL_SECONDS = 1.0
+GATEWAY_HEALTH_MAX_BACKOFF_SECONDS = float(os.environ.get('IBKR_GATEWAY_HEALTH_MAX_BACKOFF', 30.0))
+GATEWAY_HEALTH_WATCH_SECONDS = 10.0
+GATEWAY_STARTUP_TIMEOUT_SECONDS = float(os.environ.get('IBKR_GATEWAY_STARTUP_TIMEOUT', 120))
+# 持仓分页: 网关每页最多返回 100 条, 每个账户最多同时请求的页数及页数上限
+POSITIONS_PAGE_SIZE = 100
+POSITIONS_PAGE_CONCURRENCY = int(os.environ.get('IBKR_POSITIONS_PAGE_CONCURRENCY', 4))
+POSITIONS_MAX_PAGES = 50
+# 连接池大小与调度器的并发上限保持一致, 避免连接被丢弃后重新握手
+GATEWAY_POOL_SIZE = int(os.environ.get('IBKR_GATEWAY_POOL_SIZE', GATEWAY_MAX_CONCURRENCY))
+
+# 账户列表的缓存有效期: portfolio/accounts 限速为每 5 秒 1 次, 主页和随后的数据流请求 (及多个标签页) 共用一次结果
+ACCOUNT_IDS_CACHE_TTL_SECONDS = float(os.environ.get('IBKR_ACCOUNT_IDS_CACHE_TTL', 10.0))
+
+# 价格快照缓存的有效期: 多个页面在此时间内的轮询共享同一次上游请求
+PRICE_CACHE_TTL_SECONDS = float(os.environ.get('IBKR_PRICE_CACHE_TTL', 2.0))
+
+# md/snapshot 分块: 每次请求的 conid 上限 (控制 URL 长度), 以及首次订阅未返回价格字段时的补请求次数与间隔
+PRICE_SNAPSHOT_CHUNK_SIZE = int(os.environ.get('IBKR_SNAPSHOT_CHUNK_SIZE', 50))
+PRICE_SNAPSHOT_WARMUP_RETRIES = int(os.environ.get('IBKR_SNAPSHOT_WARMUP_RETRIES', 2))
+PRICE_SNAPSHOT_WARMUP_DELAY_SECONDS = 0.3
+
+# SSE 价格推送: 后台轮询间隔与心跳间隔
+PRICE_STREAM_INTERVAL_SECONDS = float(os.environ.get('IBKR_PRICE_STREAM_INTERVAL', 2.0))
+PRICE_STREAM_HEARTBEAT_SECONDS = 15
+
+# 日内净清算价值序列: 分辨率 -> (时间桶秒数, 环形缓冲容量); 逐笔保留最近 30 分钟, 1 分钟保留 24 小时, 5 分钟保留 48 小时
+NET_LIQ_RESOLUTIONS = {'tick': (1, 1800), '1m': (60, 1440), '5m': (300, 576)}
+
+# 历史表现(TWR)持久化存储: 刷新间隔与账户淘汰策略
+PERFORMANCE_DB_PATH = os.environ.get('IBKR_PERFORMANCE_DB', os.path.join(PROJECT_ROOT, 'data', 'performance_history.sqlite3'))
+PERFORMANCE_REFRESH_MINUTES = 15
+PERFORMANCE_MAX_IDLE_DAYS = int(os.environ.get('IBKR_PERFORMANCE_MAX_IDLE_DAYS', 30))
+PERFORMANCE_MAX_ACCOUNTS = int(os.environ.get('IBKR_PERFORMANCE_MAX_ACCOUNTS', 200))
+# /pa/performance 支持的查询区间 (区间代码, 覆盖天数), 用于增量刷新时选取最短的可用区间
+PERFORMANCE_PERIODS = [('7D', 7), ('1M', 28), ('3M', 89), ('6M', 180), ('12M', 364)]
+# 请求 /pa/performance 的超时时间; 每次刷新把所有需要更新的账户合并为一个请求, 不分块
+PERFORMANCE_TIMEOUT_SECONDS = 30
+# 派生指标的滚动窗口 (交易日)
+ROLLING_RETURN_WINDOWS = {'return_1m': 21, 'return_3m': 63}
+ROLLING_VOLATILITY_WINDOW = 63
+# 带 ETag 的响应 (主页与 /api/history 等): 响应体超过该大小 (字节) 且客户端支持时使用 gzip 压缩
+RESPONSE_GZIP_MIN_BYTES = 1024
+# 渲染结果缓存: 按内容哈希保存主页及各账户片段的 HTML, 超出条目数时淘汰最久未使用的
+FRAGMENT_CACHE_MAX_ENTRIES = int(os.environ.get('IBKR_FRAGMENT_CACHE_MAX_ENTRIES', 512))
+# 进程间共享缓存 (SQLite): 多个 worker 进程共用缓存条目, 并保证同一个键同一时间只有一个进程在计算
+SHARED_CACHE_DB_PATH = os.environ.get('IBKR_SHARED_CACHE_DB', os.path.join(PROJECT_ROOT, 'data', 'shared_cache.sqlite3'))
+SHARED_CACHE_MAX_ENTRIES = int(os.environ.get('IBKR_SHARED_CACHE_MAX_ENTRIES', 20000))
+SHARED_CACHE_EVICT_EVERY_WRITES = 200
+SHARED_CACHE_POLL_SECONDS = 0.05
+# 共享缓存前的进程内一级缓存: 命中时不读 SQLite、不解析 JSON; 条目沿用写入时的过期时间, 超出条目数时淘汰最久未使用的
+SHARED_CACHE_L1_MAX_ENTRIES = int(os.environ.get('IBKR_SHARED_CACHE_L1_MAX_ENTRIES', 4096))
+# 日志格式: json 为每行一个 JSON 对象 (便于采集), text 为便于人读的单行文本, off 为关闭 (基准测试时使用); 以及最低输出级别
+LOG_FORMAT = os.environ.get('IBKR_LOG_FORMAT', 'json')
+LOG_LEVEL = os.environ.get('IBKR_LOG_LEVEL', 'INFO').upper()
+# 耗时直方图的分桶上界 (秒)
+METRICS_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+# --- 指标与结构化日志 ---
+
+logger = logging.getLogger('ibkr_dashboard')
+
+
+class JsonLogFormatter(logging.Formatter):
+    """每条日志输出为一行 JSON: ts/level/event/msg 加上 log_event 通过 extra 附带的字段"""
+
+    def format(self, record):
+        entry = {'ts': _log_timestamp(record), 'level': record.levelname.lower(),
+                 'event': getattr(record, 'event', record.name), 'msg': record.getMessage(),
+                 **getattr(record, 'fields', {})}
+        if record.exc_info:
+            entry['exc_info'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class TextLogFormatter(logging.Formatter):
+    """便于人读的单行文本: 时间 级别 事件名 说明 key=value ..."""
+
+    def format(self, record):
+        extra = ' '.join(f'{key}={value}' for key, value in getattr(record, 'fields', {}).items())
+        line = f"{_log_timestamp(record)} {record.levelname:<5} {getattr(record, 'event', record.name)} {record.getMessage()} {extra}".rstrip()
+        if record.exc_info:
+            line += '\n' + self.formatException(record.exc_info)
+        return line
+
+
+def _log_timestamp(record):
+    return datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(timespec='milliseconds')
+
+
+def configure_logging(log_format=LOG_FORMAT, level=LOG_LEVEL):
+    """按 LOG_FORMAT 为 logger 配置输出到 stdout 的处理器; off 时只挂 NullHandler。不向根 logger 传播, 避免重复输出"""
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+    logger.propagate = False
+    logger.setLevel(level)
+    if log_format == 'off':
+        logger.addHandler(logging.NullHandler())
+        return
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(TextLogFormatter() if log_format == 'text' else JsonLogFormatter())
+    logger.addHandler(handler)
+
+
+configure_logging()
+
+
+def log_event(event, message, level='info', **fields):
+    """输出一条结构化日志: event 为固定的事件名, message 为面向人的说明, 其余字段原样附带
+
+    event 和字段通过 extra 挂在 LogRecord 上 (字段放在 record.fields 中, 不与 LogRecord 自带的属性冲突), 由格式化器输出。
+    """
+    logger.log(logging.getLevelName(level.upper()), message, extra={'event': event, 'fields': fields})
+
+
+class MetricsRegistry:
+    """进程内指标注册表: 计数器、仪表和直方图按 (名称, 标签) 聚合, 以 Prometheus 文本格式导出
+
+    每次记录只在锁内做一次字典查找和加法; 仪表类指标也可以注册采集函数, 在导出时再读取当前值。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._meta = {}        # name -> (类型, 说明, 直方图分桶)
+        self._values = {}      # name -> {标签元组: 数值 或 [各分桶计数..., 总和, 次数]}
+        self._collectors = []
+
+    def _declare(self, kind, name, help_text, buckets=None):
+        with self._lock:
+            self._meta[name] = (kind, help_text, buckets)
+            self._values.setdefault(name, {})
+
+    def counter(self, name, help_text):
+        self._declare('counter', name, help_text)
+
+    def gauge(self, name, help_text):
+        self._declare('gauge', name, help_text)
+
+    def histogram(self, name, help_text, buckets=METRICS_LATENCY_BUCKETS):
+        self._declare('histogram', name, help_text, tuple(buckets))
+
+    @staticmethod
+    def _key(labels):
+        # 标签值统一为字符串: 同一指标下可能同时出现数字和字符串 (如 HTTP 状态码与异常类型名), 导出时需要可排序
+        return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        """计数器加 value; 也用于仪表的增减 (value 可为负)"""
+        key = self._key(labels)
+        with self._lock:
+            series = self._values[name]
+            series[key] = series.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[name][key] = value
+
+    def observe(self, name, value, **labels):
+        key = self._key(labels)
+        buckets = self._meta[name][2]
+        with self._lock:
+            series = self._values[name]
+            entry = series.get(key)
+            if entry is None:
+                entry = series[key] = [0] * (len(buckets) + 2)
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    entry[i] += 1
+                    break
+            entry[-2] += value
+            entry[-1] += 1
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def register_collector(self, collector):
+        """注册导出前调用的采集函数, 用于把调度器队列长度等即时状态写入仪表"""
+        self._collectors.append(collector)
+
+    @staticmethod
+    def _format_labels(labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ''
+        escaped = (f'{k}="{str(v).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34)).replace(chr(10), chr(92) + "n")}"'
+                   for k, v in pairs)
+        return '{' + ','.join(escaped) + '}'
+
+    def render(self):
+        """导出 Prometheus 文本格式 (text/plain; version=0.0.4)"""
+        for collector in self._collectors:
+            try:
+                collector()
+            except Exception as e:
+                log_event('metrics_collector_failed', '指标采集函数执行失败', level='error', error=str(e))
+        lines = []
+        with self._lock:
+            for name, (kind, help_text, buckets) in sorted(self._meta.items()):
+                lines.append(f'# HELP {name} {help_text}')
+                lines.append(f'# TYPE {name} {kind}')
+                for labels, value in sorted(self._values[name].items()):
+                    if kind != 'histogram':
+                        lines.append(f'{name}{self._format_labels(labels)} {value}')
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(buckets, value):
+                        cumulative += count
+                        lines.append(f'{name}_bucket{self._format_labels(labels, [("le", bound)])} {cumulative}')
+                    lines.append(f'{name}_bucket{self._format_labels(labels, [("le", "+Inf")])} {value[-1]}')
+                    lines.append(f'{name}_sum{self._format_labels(labels)} {value[-2]}')
+                    lines.append(f'{name}_count{self._format_labels(labels)} {value[-1]}')
+        return '\n'.join(lines) + '\n'
+
+
+metrics = MetricsRegistry()
+metrics.histogram('ibkr_gateway_request_duration_seconds', '单次网关请求耗时 (含重试前的每次尝试)')
+metrics.counter('ibkr_gateway_requests_total', '网关请求次数, 按接口和结果 (HTTP 状态码或异常类型) 区分')
+metrics.counter('ibkr_gateway_retries_total', '网关请求重试次数, 按接口和原因区分')
+metrics.gauge('ibkr_gateway_in_flight', '各接口族当前在途的网关请求数')
+metrics.gauge('ibkr_gateway_rate_limit', '各接口族当前的自适应限速 (每秒请求数)')
+metrics.histogram('ibkr_http_request_duration_seconds', 'Flask 路由处理耗时 (流式响应包含整个推送过程)')
+metrics.gauge('ibkr_http_requests_in_flight', '正在处理的 HTTP 请求数')
+metrics.counter('ibkr_cache_requests_total', '各缓存的查询次数, 按结果 (hit/miss/stale/coalesced) 区分')
+metrics.counter('ibkr_performance_missing_total', '批量获取历史表现时未拿到数据的账户数, 按原因 (error/mismatch) 区分')
+metrics.gauge('ibkr_scheduler_queued', '网关调度器中排队的任务数')
+metrics.gauge('ibkr_scheduler_busy_workers', '网关调度器中正在执行任务的工作线程数')
+metrics.gauge('ibkr_scheduler_background_running', '正在执行的低优先级后台任务数')
+metrics.gauge('ibkr_threads', '进程内的线程总数')
+metrics.histogram('ibkr_dashboard_load_seconds', '仪表盘数据流从开始到全部账户加载完成的耗时')
+metrics.gauge('ibkr_gateway_up', '最近一次健康检查的网关状态 (reachable/connected/authenticated), 1 为是')
+
+
+# --- 共享缓存 ---
+
+class SharedCache:
+    """基于 SQLite 的多进程共享缓存, 带 TTL、条目数上限淘汰和按键的单飞 (single-flight) 计算
+
+    同一进程内, 同一个键的并发请求共享同一个 Future; 跨进程时, 计算方先在 cache_leases 表中
+    为这些键登记租约, 其余进程轮询等待结果写入, 租约过期 (计算方崩溃) 后自行接手计算。
+    值以 JSON 保存, 只适合可 JSON 序列化的数据。读取先查进程内一级缓存, 未命中才查 SQLite;
+    一级缓存返回的是共享对象, 调用方不应修改。
+    """
+
+    def __init__(self, path, max_entries, evict_every=SHARED_CACHE_EVICT_EVERY_WRITES, l1_max_entries=SHARED_CACHE_L1_MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self.evict_every = evict_every
+        self.l1_max_entries = l1_max_entries
+        self._l1 = collections.OrderedDict()  # 完整键 -> (过期时间, 值)
+        self.owner = f'{platform.node()}:{os.getpid()}'
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._inflight = {}  # 完整键 -> 本进程内正在计算的 Future
+        self._writes = 0
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS cache_entries ("
+                         "key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL, "
+                         "stored_at REAL NOT NULL, size INTEGER NOT NULL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS cache_entries_stored_at ON cache_entries (stored_at)")
+            conn.execute("CREATE TABLE IF NOT EXISTS cache_leases ("
+                         "key TEXT PRIMARY KEY, owner TEXT NOT NULL, expires_at REAL NOT NULL)")
+
+    @contextlib.contextmanager
+    def _connect(self):
+        """每个线程复用一个连接 (价格轮询是热路径), 以事务方式执行"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = sqlite3.connect(self.path, timeout=10)
+            conn.execute("PRAGMA synchronous=NORMAL")
+        with conn:
+            yield conn
+
+    @staticmethod
+    def _chunks(keys, size=500):
+        for start in range(0, len(keys), size):
+            yield keys[start:start + size]
+
+    def _l1_get(self, keys, now):
+        found = {}
+        with self._lock:
+            for key in keys:
+                entry = self._l1.get(key)
+                if entry is None:
+                    continue
+                if entry[0] > now:
+                    self._l1.move_to_end(key)
+                    found[key] = entry[1]
+                else:
+                    del self._l1[key]
+        return found
+
+    def _l1_put(self, entries):
+        """entries 为 {完整键: (过期时间, 值)}"""
+        evicted = 0
+        with self._lock:
+            for key, entry in entries.items():
+                self._l1[key] = entry
+                self._l1.move_to_end(key)
+            while len(self._l1) > self.l1_max_entries:
+                self._l1.popitem(last=False)
+                evicted += 1
+        if evicted:
+            metrics.inc('ibkr_cache_evictions_total', evicted, cache='shared_l1', reason='size')
+
+    def _read(self, keys):
+        now = time.time()
+        found = self._l1_get(keys, now)
+        missing = [k for k in keys if k not in found]
+        if not missing:
+            return found
+        loaded = {}
+        with self._connect() as conn:
+            for chunk in self._chunks(missing):
+                rows = conn.execute(f"SELECT key, value, expires_at FROM cache_entries WHERE expires_at > ? AND key IN ({','.join('?' * len(chunk))})",
+                                    (now, *chunk)).fetchall()
+                loaded.update((key, (expires_at, json.loads(value))) for key, value, expires_at in rows)
+        self._l1_put(loaded)
+        found.update((key, value) for key, (_, value) in loaded.items())
+        return found
+
+    def _write(self, values, ttl):
+        if not values:
+            return
+        now = time.time()
+        rows = []
+        for key, value in values.items():
+            encoded = json.dumps(value)
+            rows.append((key, encoded, now + ttl, now, len(encoded)))
+        with self._connect() as conn:
+            conn.executemany("INSERT OR REPLACE INTO cache_entries (key, value, expires_at, stored_at, size) VALUES (?, ?, ?, ?, ?)", rows)
+        self._l1_put({key: (now + ttl, value) for key, value in values.items()})
+        with self._lock:
+            self._writes += 1
+            evict = self._writes % self.evict_every == 0
+        if evict:
+            self.evict()
+
+    def evict(self):
+        """删除已过期的条目; 条目数仍超过上限时按写入时间从旧到新删除"""
+        now = time.time()
+        with self._connect() as conn:
+            expired = conn.execute("DELETE FROM cache_entries WHERE expires_at <= ?", (now,)).rowcount
+            overflow = conn.execute("DELETE FROM cache_entries WHERE key IN (SELECT key FROM cache_entries ORDER BY stored_at DESC "
+                                    "LIMIT -1 OFFSET ?)", (self.max_entries,)).rowcount
+            conn.execute("DELETE FROM cache_leases WHERE expires_at <= ?", (now,))
+        if expired or overflow:
+            metrics.inc('ibkr_cache_evictions_total', expired, cache='shared', reason='expired')
+            metrics.inc('ibkr_cache_evictions_total', overflow, cache='shared', reason='size')
+
+    def _acquire_leases(self, keys, lease_seconds):
+        """尝试为 keys 登记租约, 返回 (本进程取得的键, 被其他进程持有的键)"""
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(f"DELETE FROM cache_leases WHERE expires_at <= ? AND key IN ({','.join('?' * len(keys))})", (now, *keys))
+            conn.executemany("INSERT OR IGNORE INTO cache_leases (key, owner, expires_at) VALUES (?, ?, ?)",
+                             [(key, self.owner, now + lease_seconds) for key in keys])
+            owned = {key for key, in conn.execute(f"SELECT key FROM cache_leases WHERE owner = ? AND key IN ({','.join('?' * len(keys))})",
+                                                  (self.owner, *keys))}
+        return [k for k in keys if k in owned], [k for k in keys if k not in owned]
+
+    def _release_leases(self, keys):
+        with self._connect() as conn:
+            conn.executemany("DELETE FROM cache_leases WHERE key = ? AND owner = ?", [(key, self.owner) for key in keys])
+
+    def _wait_for_other_process(self, keys):
+        """轮询等待其他进程写入结果; 租约消失或过期后仍未拿到的键原样返回, 由调用方自行计算"""
+        found, pending = {}, list(keys)
+        while pending:
+            time.sleep(SHARED_CACHE_POLL_SECONDS)
+            found.update(self._read(pending))
+            pending = [k for k in pending if k not in found]
+            if not pending:
+                break
+            with self._connect() as conn:
+                leased = {key for key, in conn.execute(
+                    f"SELECT key FROM cache_leases WHERE expires_at > ? AND key IN ({','.join('?' * len(pending))})",
+                    (time.time(), *pending))}
+            abandoned = [k for k in pending if k not in leased]
+            if abandoned:
+                return found, abandoned
+        return found, []
+
+    def _compute(self, keys, compute, ttl, lease_seconds):
+        owned, elsewhere = self._acquire_leases(keys, lease_seconds)
+        computed = {}
+        try:
+            if owned:
+                computed = compute(owned)
+                owned_keys = set(owned)
+                self._write({k: v for k, v in computed.items() if k in owned_keys}, ttl)
+        finally:
+            if owned:
+                self._release_leases(owned)
+        if elsewhere:
+            found, abandoned = self._wait_for_other_process(elsewhere)
+            computed.update(found)
+            if abandoned:
+                extra = compute(abandoned)
+                self._write(extra, ttl)
+                computed.update(extra)
+        return computed
+
+    def get_many_or_compute(self, namespace, keys, compute, ttl, lease_seconds=30):
+        """返回 {键: 值}; 未命中的键合并为一次 compute(未命中的键列表) 调用, 其结果写入缓存
+
+        compute 应返回 {键: 值}, 未返回的键不缓存 (下次请求会再次计算)。不能在调度器的工作线程里
+        调用会再通过调度器阻塞等待的 compute。
+        """
+        prefix = f'{namespace}:'
+        full_keys = [prefix + str(k) for k in dict.fromkeys(keys)]
+        if not full_keys:
+            return {}
+        found = self._read(full_keys)
+        result = {k[len(prefix):]: v for k, v in found.items()}
+
+        waiting, own = {}, []
+        with self._lock:
+            for key in full_keys:
+                if key in found:
+                    continue
+                if key in self._inflight:
+                    waiting[key] = self._inflight[key]
+                else:
+                    own.append(key)
+            if own:
+                own_future = concurrent.futures.Future()
+                for key in own:
+                    self._inflight[key] = own_future
+        for outcome, count in (('hit', len(found)), ('coalesced', len(waiting)), ('miss', len(own))):
+            if count:
+                metrics.inc('ibkr_cache_requests_total', count, cache=namespace, result=outcome)
+
+        if own:
+            def compute_prefixed(missing):
+                values = compute([k[len(prefix):] for k in missing])
+                return {prefix + str(k): v for k, v in values.items()}
+            try:
+                computed = self._compute(own, compute_prefixed, ttl, lease_seconds)
+                own_future.set_result(computed)
+            except BaseException as e:
+                own_future.set_exception(e)
+                raise
+            finally:
+                with self._lock:
+                    for key in own:
+                        if self._inflight.get(key) is own_future:
+                            del self._inflight[key]
+            result.update({k[len(prefix):]: v for k, v in computed.items()})
+
+        for key, future in waiting.items():
+            try:
+                values = future.result()
+            except Exception:
+                continue
+            if key in values:
+                result[key[len(prefix):]] = values[key]
+        return result
+
+    def get_many(self, namespace, keys):
+        """只读取缓存, 返回命中的 {键: 值}, 不计算未命中的键"""
+        prefix = f'{namespace}:'
+        found = self._read([prefix + str(k) for k in dict.fromkeys(keys)])
+        return {k[len(prefix):]: v for k, v in found.items()}
+
+    def get_or_compute(self, namespace, key, compute, ttl, lease_seconds=30):
+        """单个键的 get_many_or_compute; compute() 无参数, 返回 None 时不缓存"""
+        def compute_one(_):
+            value = compute()
+            return {} if value is None else {key: value}
+        return self.get_many_or_compute(namespace, [key], compute_one, ttl, lease_seconds).get(str(key))
+
+    def stats(self):
+        with self._connect() as conn:
+            count, size = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM cache_entries").fetchone()
+        with self._lock:
+            l1_entries = len(self._l1)
+        return {'entries': count, 'bytes': size, 'l1_entries': l1_entries}
+
+
+shared_cache = SharedCache(SHARED_CACHE_DB_PATH, SHARED_CACHE_MAX_ENTRIES)
+metrics.counter('ibkr_cache_evictions_total', '缓存淘汰的条目数, 按缓存 (shared/shared_l1/fragment) 和原因 (expired/size) 区分')
+metrics.gauge('ibkr_shared_cache_entries', '共享缓存中的条目数')
+metrics.gauge('ibkr_shared_cache_bytes', '共享缓存中条目值的总字节数')
+metrics.gauge('ibkr_shared_cache_l1_entries', '共享缓存进程内一级缓存的条目数')
+
+
+# --- 网关客户端 ---
+
+def endpoint_family(path):
+    """按接口路径划分限速族, 与 Client Portal 文档中各接口的限速规则对应"""
+    if path.startswith('md/') or path.startswith('iserver/marketdata'):
+        return 'marketdata'
+    if path.startswith('pa/'):
+        return 'performance'
+    if path in ('portfolio/accounts', 'portfolio/subaccounts'):
+        return 'portfolio_accounts'
+    if path.startswith('portfolio/'):
+        return 'portfolio'
+    if path.startswith('tickle'):
+        return 'tickle'
+    if path.startswith('iserver/auth'):
+        return 'auth'
+    return 'default'
+
+
+class GatewayRateLimited(requests.exceptions.RequestException):
+    """在请求的超时时间内拿不到限速令牌 (例如每 15 分钟 1 次的接口刚被调用过)"""
+
+
+class AdaptiveRateLimiter:
+    """单个接口族的令牌桶限速器, 按 AIMD 自适应
+
+    从文档规定的速率 (rate 为 None 时不限速) 和最大并发开始; 只有被网关限流 (429/503) 后才把速率和并发减半,
+    之后每次成功请求加性地恢复, 直到回到初始上限。不限速的接口族恢复到 GATEWAY_UNLIMITED_FALLBACK_RATE 后重新取消限速。
+    """
+
+    def __init__(self, rate, burst, max_concurrency):
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.max_concurrency = max_concurrency
+        self.concurrency = max_concurrency
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._in_flight = 0
+        self._successes = 0
+        self._blocked_until = 0.0
+        self._cond = threading.Condition()
+
+    def _refill(self, now):
+        if self.rate is not None:
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self, timeout=None):
+        """阻塞直到拿到一个令牌和一个并发名额; timeout 秒内肯定拿不到时抛出 GatewayRateLimited"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                self._refill(now)
+                if now < self._blocked_until:
+                    wait = self._blocked_until - now
+                elif self._in_flight >= self.concurrency:
+                    wait = None
+                elif self.rate is not None and self._tokens < 1:
+                    wait = (1 - self._tokens) / self.rate
+                else:
+                    if self.rate is not None:
+                        self._tokens -= 1
+                    self._in_flight += 1
+                    return
+                if deadline is not None:
+                    remaining = deadline - now
+                    if remaining <= 0 or (wait is not None and wait > remaining):
+                        raise GatewayRateLimited(f'{timeout} 秒内无法获得限速令牌')
+                    wait = remaining if wait is None else wait
+                self._cond.wait(wait)
+
+    def release(self, throttled=False, retry_after=None):
+        """归还并发名额; throttled 表示本次请求被网关限流"""
+        with self._cond:
+            self._in_flight -= 1
+            ceiling = self.max_rate if self.max_rate is not None else GATEWAY_UNLIMITED_FALLBACK_RATE
+            if throttled:
+                current = self.rate if self.rate is not None else ceiling
+                self.rate = max(ceiling / 16, current / 2)
+                self._tokens = min(self._tokens, 1.0)
+                self.concurrency = max(1, self.concurrency // 2)
+                self._successes = 0
+                if retry_after:
+                    self._blocked_until = max(self._blocked_until, time.monotonic() + retry_after)
+            elif self.rate != self.max_rate or self.concurrency < self.max_concurrency:
+                self._successes += 1
+                if self._successes >= self.concurrency:
+                    self._successes = 0
+                    self.concurrency = min(self.max_concurrency, self.concurrency + 1)
+                if self.rate is not None and self.rate != self.max_rate:
+                    self.rate += ceiling * GATEWAY_RATE_INCREASE_FRACTION
+                    if self.rate >= ceiling:
+                        self.rate = self.max_rate
+            self._cond.notify_all()
+
+    def stats(self):
+        with self._cond:
+            return {'rate': float('inf') if self.rate is None else self.rate, 'concurrency': self.concurrency,
+                    'in_flight': self._in_flight}
+
+
+def parse_retry_after(response):
+    """解析 Retry-After 头 (秒数), 无法解析时返回 None"""
+    try:
+        return float(response.headers.get('Retry-After'))
+    except (TypeError, ValueError):
+        return None
+
+
+class GatewayClient:
+    """共享的 Client Portal 网关客户端: 复用 HTTPS 长连接, 按接口族限速, 对限流响应退避重试, 并按接口统计调用耗时"""
+
+    def __init__(self, base_url, pool_size=GATEWAY_POOL_SIZE, verify=False, rate_limits=GATEWAY_RATE_LIMITS,
+                 max_retries=GATEWAY_MAX_RETRIES):
+        self.base_url = base_url
+        self.verify = verify
+        self.max_retries = max_retries
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=False, max_retries=0)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers.update({'Connection': 'keep-alive'})
+        self.limiters = {family: AdaptiveRateLimiter(*limits) for family, limits in rate_limits.items()}
+        self._stats_lock = threading.Lock()
+        self._stats = {}
+
+    def _record(self, name, elapsed, status, retried=None):
+        """记录一次请求尝试; status 为 HTTP 状态码或异常类型名, retried 为将要重试的原因"""
+        ok = isinstance(status, int) and status < 400
+        throttled = status in GATEWAY_THROTTLE_STATUS
+        metrics.observe('ibkr_gateway_request_duration_seconds', elapsed, endpoint=name)
+        metrics.inc('ibkr_gateway_requests_total', endpoint=name, status=status)
+        if retried:
+            metrics.inc('ibkr_gateway_retries_total', endpoint=name, reason=retried)
+        with self._stats_lock:
+            entry = self._stats.setdefault(name, {'calls': 0, 'errors': 0, 'throttled': 0, 'retried': 0,
+                                                  'total_seconds': 0.0, 'max_seconds': 0.0})
+            entry['calls'] += 1
+            entry['total_seconds'] += elapsed
+            entry['max_seconds'] = max(entry['max_seconds'], elapsed)
+            if not ok:
+                entry['errors'] += 1
+            if throttled:
+                entry['throttled'] += 1
+            if retried:
+                entry['retried'] += 1
+
+    @staticmethod
+    def _backoff(attempt, retry_after):
+        delay = random.uniform(0, min(GATEWAY_BACKOFF_MAX_SECONDS, GATEWAY_BACKOFF_BASE_SECONDS * 2 ** attempt))
+        return max(delay, retry_after or 0)
+
+    def request(self, method, path, name=None, retries=None, **kwargs):
+        """发送请求; name 用于统计分组 (例如 'portfolio/{id}/summary'), 默认为 path
+
+        被限流 (429/503) 或连接失败时按指数退避加抖动重试, 最多 retries 次 (默认 max_retries); 重试耗尽后返回最后一次响应或抛出异常。
+        """
+        kwargs.setdefault('verify', self.verify)
+        name = name or path
+        max_retries = self.max_retries if retries is None else retries
+        limiter = self.limiters.get(endpoint_family(path), self.limiters['default'])
+        for attempt in range(max_retries + 1):
+            timeout = kwargs.get('timeout')
+            try:
+                limiter.acquire(timeout[0] if isinstance(timeout, tuple) else timeout)
+            except GatewayRateLimited:
+                self._record(name, 0.0, 'GatewayRateLimited')
+                raise
+            start = time.perf_counter()
+            try:
+                response = self.session.request(method, f"{self.base_url}{path}", **kwargs)
+            except requests.exceptions.ConnectionError:
+                limiter.release()
+                retry = attempt < max_retries
+                self._record(name, time.perf_counter() - start, 'ConnectionError', retried='connection' if retry else None)
+                if not retry:
+                    raise
+                time.sleep(self._backoff(attempt, None))
+                continue
+            except BaseException as e:
+                limiter.release()
+                self._record(name, time.perf_counter() - start, type(e).__name__)
+                raise
+
+            throttled = response.status_code in GATEWAY_THROTTLE_STATUS
+            retry_after = parse_retry_after(response) if throttled else None
+            limiter.release(throttled=throttled, retry_after=retry_after)
+            retry = throttled and attempt < max_retries
+            self._record(name, time.perf_counter() - start, response.status_code, retried='throttled' if retry else None)
+            if not retry:
+                if throttled:
+                    log_event('gateway_retries_exhausted', '接口连续被网关限流, 放弃重试', level='warning',
+                              endpoint=name, attempts=attempt + 1)
+                return response
+            time.sleep(self._backoff(attempt, retry_after))
+
+    def get(self, path, name=None, retries=None, **kwargs):
+        return self.request('GET', path, name=name, retries=retries, **kwargs)
+
+    def post(self, path, name=None, retries=None, **kwargs):
+        return self.request('POST', path, name=name, retries=retries, **kwargs)
+
+    def stats(self):
+        """返回各接口的调用、错误、限流与重试次数及耗时统计快照"""
+        with self._stats_lock:
+            snapshot = {}
+            for name, entry in self._stats.items():
+                snapshot[name] = dict(entry, avg_seconds=entry['total_seconds'] / entry['calls'] if entry['calls'] else 0.0)
+            return snapshot
+
+    def limiter_stats(self):
+        """返回各接口族限速器当前的速率、并发上限与在途请求数"""
+        return {family: limiter.stats() for family, limiter in self.limiters.items()}
+
+
+gateway = GatewayClient(BASE_URL)
+
+
+# --- 网关 I/O 调度器 ---
+
+class GatewayScheduler:
+    """进程级网关 I/O 调度器: 固定数量的常驻工作线程按优先级从队列中取任务执行
+
+    工作线程数即全局并发上限; 低优先级的后台任务 (历史表现) 同时最多占用 background_limit 个线程,
+    保证价格和认证请求总有线程可用。提交的任务只能做网关 I/O 和数据处理, 不能阻塞等待其他调度任务,
+    需要编排多个请求时使用 Future 回调 (参见 fetch_account_data_async)。
+    """
+
+    def __init__(self, max_workers, background_limit):
+        self.max_workers = max_workers
+        self.background_limit = background_limit
+        self._queue = queue.PriorityQueue()
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+        self._deferred = collections.deque()
+        self._background_running = 0
+        self._busy = 0
+        self._threads = []
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._threads:
+                return
+            for i in range(self.max_workers):
+                thread = threading.Thread(target=self._worker, name=f'gateway-io-{i}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def submit(self, priority, fn, *args, **kwargs):
+        """按优先级提交任务, 返回 concurrent.futures.Future"""
+        self._ensure_started()
+        future = concurrent.futures.Future()
+        self._queue.put((priority, next(self._counter), future, fn, args, kwargs))
+        return future
+
+    def call(self, priority, fn, *args, **kwargs):
+        """在请求线程中同步执行一个调度任务; 不能在调度器的工作线程中调用"""
+        return self.submit(priority, fn, *args, **kwargs).result()
+
+    def _worker(self):
+        while True:
+            item = self._queue.get()
+            priority, _, future, fn, args, kwargs = item
+            background = priority >= PRIORITY_PERFORMANCE
+            if background:
+                with self._lock:
+                    if self._background_running >= self.background_limit:
+                        self._deferred.append(item)
+                        continue
+                    self._background_running += 1
+            with self._lock:
+                self._busy += 1
+            try:
+                if future.set_running_or_notify_cancel():
+                    try:
+                        future.set_result(fn(*args, **kwargs))
+                    except BaseException as e:
+                        future.set_exception(e)
+            finally:
+                with self._lock:
+                    self._busy -= 1
+                if background:
+                    with self._lock:
+                        self._background_running -= 1
+                        if self._deferred:
+                            self._queue.put(self._deferred.popleft())
+
+    def stats(self):
+        """返回排队中的任务数及后台任务占用情况"""
+        with self._lock:
+            return {'queued': self._queue.qsize(), 'deferred': len(self._deferred), 'busy': self._busy,
+                    'background_running': self._background_running, 'workers': len(self._threads)}
+
+
+gateway_scheduler = GatewayScheduler(GATEWAY_MAX_CONCURRENCY, GATEWAY_BACKGROUND_CONCURRENCY)
+
+
+def collect_runtime_metrics():
+    """导出前把调度器、限速器和线程数的即时状态写入仪表"""
+    stats = gateway_scheduler.stats()
+    metrics.set('ibkr_scheduler_queued', stats['queued'] + stats['deferred'])
+    metrics.set('ibkr_scheduler_busy_workers', stats['busy'])
+    metrics.set('ibkr_scheduler_background_running', stats['background_running'])
+    metrics.set('ibkr_threads', threading.active_count())
+    for state, value in gateway_health.cached_status().items():
+        metrics.set('ibkr_gateway_up', int(value), state=state)
+    cache_stats = shared_cache.stats()
+    metrics.set('ibkr_shared_cache_entries', cache_stats['entries'])
+    metrics.set('ibkr_shared_cache_bytes', cache_stats['bytes'])
+    metrics.set('ibkr_shared_cache_l1_entries', cache_stats['l1_entries'])
+    for family, limiter_stats in gateway.limiter_stats().items():
+        metrics.set('ibkr_gateway_in_flight', limiter_stats['in_flight'], family=family)
+        metrics.set('ibkr_gateway_rate_limit', limiter_stats['rate'], family=family)
+
+metrics.register_collector(collect_runtime_metrics)
+
+
+def when_all(futures, combine):
+    """所有 futures 完成后, 在最后一个完成的线程中调用 combine(), 返回以其结果完成的 Future"""
+    result = concurrent.futures.Future()
+    futures = list(futures)
+    remaining = [len(futures)]
+    lock = threading.Lock()
+
+    def on_done(_):
+        with lock:
+            remaining[0] -= 1
+            if remaining[0]:
+                return
+        try:
+            result.set_result(combine())
+        except Exception as e:
+            result.set_exception(e)
+
+    if not futures:
+        result.set_result(combine())
+        return result
+    for future in futures:
+        future.add_done_callback(on_done)
+    return result
 
 
 # --- 核心功能函数 ---
 
-def is_gateway_running():
-    """检查网关是否已连接并认证"""
+def check_gateway_status():
+    """请求一次 iserver/auth/status, 返回 {'reachable', 'connected', 'authenticated'}; 不重试, 由健康检查自行退避"""
     try:
-        response = requests.get(f"{BASE_URL}iserver/auth/status", verify=False, timeout=2)
-        return response.status_code == 200 and response.json().get('connected')
+        response = gateway.get("iserver/auth/status", timeout=2, retries=0)
     except requests.exceptions.RequestException:
-        return False
+        return {'reachable': False, 'connected': False, 'authenticated': False}
+    try:
+        body = response.json() if response.status_code == 200 else {}
+    except ValueError:
+        body = {}
+    return {'reachable': True, 'connected': bool(body.get('connected')), 'authenticated': bool(body.get('authenticated'))}
+
+
+class GatewayHealthMonitor:
+    """后台线程按自适应间隔检查网关状态并缓存结果, 请求处理函数只读取缓存, 不再各自请求网关
+
+    状态正常时每 interval 秒复查一次; 未连接时从 min_interval 开始指数退避到 max_backoff,
+    只有状态发生变化 (如网关变为可访问) 时才回到 min_interval。
+    有人在等待状态变化时 (wait_until 期间, 或 watch_seconds 内有 status(watch=True) 的轮询, 如登录页),
+    未连接状态下的检查间隔不超过 min_interval, 以便尽快发现网关启动或登录完成; 没有人等待时才使用长退避。
+    读取状态本身不会触发额外检查, 因此无论有多少个页面在轮询, 对网关的请求频率都不超过每 min_interval 一次。
+    """
+
+    def __init__(self, check, interval, min_interval, max_backoff, watch_seconds=GATEWAY_HEALTH_WATCH_SECONDS):
+        self._check = check
+        self._interval = interval
+        self._min_interval = min_interval
+        self._max_backoff = max_backoff
+        self._watch_seconds = watch_seconds
+        self._cond = threading.Condition()
+        self._status = {'reachable': False, 'connected': False, 'authenticated': False}
+        self._checked_at = None
+        self._waiters = 0
+        self._watched_at = None
+        self._thread = None
+
+    def _ensure_started(self):
+        with self._cond:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='gateway-health', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        backoff = self._min_interval
+        while True:
+            try:
+                status = gateway_scheduler.call(PRIORITY_AUTH, self._check)
+            except Exception as e:
+                log_event('gateway_health_failed', '网关健康检查出错', level='error', error=str(e))
+                status = {'reachable': False, 'connected': False, 'authenticated': False}
+            with self._cond:
+                previous, self._status = self._status, status
+                self._checked_at = time.monotonic()
+                self._cond.notify_all()
+            if status != previous:
+                log_event('gateway_health_changed', '网关状态发生变化', **status)
+                backoff = self._min_interval
+            if status['connected']:
+                delay = self._interval
+            else:
+                delay, backoff = backoff, min(backoff * 2, self._max_backoff)
+            self._sleep_after_check(delay, urgent_allowed=not status['connected'])
+
+    def _watched(self):
+        """在锁内调用: 当前是否有人在等待状态变化"""
+        return self._waiters > 0 or (self._watched_at is not None
+                                     and time.monotonic() - self._watched_at < self._watch_seconds)
+
+    def _sleep_after_check(self, delay, urgent_allowed):
+        """等到下一次检查的时间; 等待期间有人开始等待时被唤醒, 下一次检查提前到上次检查后 min_interval"""
+        with self._cond:
+            while True:
+                effective = min(delay, self._min_interval) if urgent_allowed and self._watched() else delay
+                remaining = self._checked_at + effective - time.monotonic()
+                if remaining <= 0:
+                    return
+                self._cond.wait(remaining)
+
+    def _watch(self):
+        """在锁内调用: 登记一次等待方的轮询; 从无人等待变为有人等待时唤醒检查线程"""
+        was_watched = self._watched()
+        self._watched_at = time.monotonic()
+        if not was_watched:
+            self._cond.notify_all()
+
+    def status(self, watch=False):
+        """返回缓存的网关状态; 尚未检查过时等待第一次检查完成
+
+        watch 为真表示调用方正在等待状态变化 (如登录页轮询), 之后 watch_seconds 内检查间隔不超过 min_interval。
+        """
+        self._ensure_started()
+        with self._cond:
+            if watch:
+                self._watch()
+            if self._checked_at is None:
+                self._cond.wait_for(lambda: self._checked_at is not None, timeout=3)
+            return dict(self._status)
+
+    def cached_status(self):
+        """返回缓存的网关状态, 不启动检查线程也不触发检查 (供指标导出使用)"""
+        with self._cond:
+            return dict(self._status)
+
+    def wait_until(self, condition, timeout):
+        """阻塞直到 condition(状态) 为真或超时, 返回最后的状态; 等待期间检查间隔不超过 min_interval"""
+        self._ensure_started()
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            self._waiters += 1
+            self._cond.notify_all()
+            try:
+                while not (self._checked_at is not None and condition(self._status)):
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                return dict(self._status)
+            finally:
+                self._waiters -= 1
+
+
+gateway_health = GatewayHealthMonitor(check_gateway_status, GATEWAY_HEALTH_INTERVAL_SECONDS,
+                                      GATEWAY_HEALTH_MIN_INTERVAL_SECONDS, GATEWAY_HEALTH_MAX_BACKOFF_SECONDS)
+
+
+def is_gateway_running():
+    """网关是否已连接并认证 (读取健康检查缓存的状态)"""
+    return gateway_health.status()['connected']
 
 def start_gateway():
     """启动IBKR网关, 使用其内部的默认配置文件"""
-    print(">>> 正在尝试自动启动 IBKR Gateway...")
+    log_event('gateway_start', '正在尝试自动启动 IBKR Gateway')
     
     gateway_path = os.path.join(PROJECT_ROOT, 'vendor', 'clientportal.gw')
     
     if not os.path.isdir(gateway_path):
-        print(f"!!! 错误：在项目目录下未找到 'vendor/clientportal.gw' 文件夹: {gateway_path}")
+        log_event('gateway_start_failed', "在项目目录下未找到 'vendor/clientportal.gw' 文件夹", level='error', path=gateway_path)
         return False
 
     if platform.system() == "Windows":
@@ -58,21 +1058,21 @@ def start_gateway():
         flags = 0
 
     if not os.path.exists(run_script):
-        print(f"!!! 错误: 启动脚本未找到: {run_script}")
+        log_event('gateway_start_failed', '启动脚本未找到', level='error', path=run_script)
         return False
         
     try:
         subprocess.Popen([run_script, conf_file_argument], cwd=gateway_path, creationflags=flags)
-        print(">>> ✅ 网关启动命令已发送。请等待其初始化。")
+        log_event('gateway_start_sent', '网关启动命令已发送, 请等待其初始化')
         return True
     except Exception as e:
-        print(f"!!! 自动启动网关失败: {e}")
+        log_event('gateway_start_failed', '自动启动网关失败', level='error', error=str(e))
         return False
 
 def get_all_account_ids():
     """获取所有账户ID"""
     try:
-        response = requests.get(f"{BASE_URL}portfolio/accounts", verify=False, timeout=5)
+        response = gateway.get("portfolio/accounts", timeout=5)
         if response.status_code == 200:
             accounts_data = response.json()
             if isinstance(accounts_data, list):
@@ -82,113 +1082,791 @@ def get_all_account_ids():
     except requests.exceptions.RequestException:
         return None
 
+def get_cached_account_ids():
+    """经共享缓存获取账户ID列表, 有效期内的重复请求不再调用 portfolio/accounts; 获取失败或为空时不缓存"""
+    return shared_cache.get_or_compute('account_ids', 'all',
+                                       lambda: gateway_scheduler.call(PRIORITY_PORTFOLIO, get_all_account_ids) or None,
+                                       ACCOUNT_IDS_CACHE_TTL_SECONDS, lease_seconds=10)
+
 def get_account_summary(account_id):
-    """获取单个账户的摘要信息"""
+    """获取单个账户的摘要信息; 请求失败 (含重试耗尽) 时返回 None, 以便与空数据区分"""
     try:
-        response = requests.get(f"{BASE_URL}portfolio/{account_id}/summary", verify=False, timeout=10)
-        return response.json() if response.status_code == 200 else {}
+        response = gateway.get(f"portfolio/{account_id}/summary", name="portfolio/{id}/summary", timeout=10)
+        return response.json() if response.status_code == 200 else None
     except requests.exceptions.RequestException:
-        return {}
+        return None
         
-def get_account_positions(account_id):
-    """获取单个账户的持仓信息"""
+def get_account_positions(account_id, page=0):
+    """获取单个账户某一页的持仓信息; 请求失败 (含重试耗尽) 时返回 None, 以便与空页区分"""
     try:
-        response = requests.get(f"{BASE_URL}portfolio/{account_id}/positions/0", verify=False, timeout=10)
-        return response.json() if response.status_code == 200 else []
+        response = gateway.get(f"portfolio/{account_id}/positions/{page}", name="portfolio/{id}/positions", timeout=10)
+        return response.json() if response.status_code == 200 else None
     except requests.exceptions.RequestException:
-        return []
+        return None
+
+def fetch_position_pages_async(account_id, process=None):
+    """通过调度器获取账户的全部持仓页, 返回以 (按页序拼接的持仓列表, 是否完整) 完成的 Future
+
+    先只请求第 0 页: 它不足一整页时账户只有这一页, 只需一次调用; 是整页时才并发请求后续页,
+    最多同时 POSITIONS_PAGE_CONCURRENCY 页。任一页不足一整页即视为最后一页, 已在途的更靠后的页结果会被丢弃。
+    某页在重试后仍失败 (网关不可用、未认证等) 时立即停止调度新页并取消仍在排队的页,
+    只保留失败页之前的连续页, 结果标记为不完整。
+    每页到达后立即在回调中用 process 处理单条持仓, 与其余页的 I/O 重叠。
+    """
+    result = concurrent.futures.Future()
+    lock = threading.RLock()
+    state = {'next': 0, 'last': POSITIONS_MAX_PAGES - 1, 'in_flight': {}, 'pages': {}, 'fan_out': False,
+             'failed': False, 'finished': False}
+
+    def schedule():
+        window = POSITIONS_PAGE_CONCURRENCY if state['fan_out'] else 1
+        while not state['failed'] and state['next'] <= state['last'] and len(state['in_flight']) < window:
+            page = state['next']
+            state['next'] += 1
+            future = gateway_scheduler.submit(PRIORITY_PORTFOLIO, get_account_positions, account_id, page)
+            state['in_flight'][page] = future
+            future.add_done_callback(lambda f, page=page: on_page(page, f))
+
+    def on_page(page, future):
+        cancelled = future.cancelled()
+        positions = None if cancelled or future.exception() is not None else future.result()
+        failed = not cancelled and not isinstance(positions, list)
+        if failed:
+            log_event('positions_page_failed', '获取持仓页失败, 停止获取后续页, 持仓数据不完整', level='warning', account=account_id, page=page)
+        processed = [process(p) for p in positions] if process and isinstance(positions, list) else positions
+        to_cancel = []
+        with lock:
+            state['in_flight'].pop(page, None)
+            if failed:
+                state['failed'] = True
+                state['last'] = min(state['last'], page - 1)
+                to_cancel = list(state['in_flight'].values())
+            elif not cancelled:
+                if len(positions) < POSITIONS_PAGE_SIZE:
+                    state['last'] = min(state['last'], page)
+                else:
+                    state['fan_out'] = True
+                if page <= state['last'] and processed:
+                    state['pages'][page] = processed
+            schedule()
+            finish = not state['in_flight'] and not state['finished']
+            if finish:
+                state['finished'] = True
+                pages = state['pages']
+                merged = [p for page in sorted(pages) if page <= state['last'] for p in pages[page]]
+        # 取消回调会重新进入 on_page, 因此在锁外执行
+        for queued in to_cancel:
+            queued.cancel()
+        if finish:
+            result.set_result((merged, not state['failed']))
+
+    with lock:
+        schedule()
+    return result
+
+PRICE_SNAPSHOT_FIELDS = ('31', '83')
 
 def get_price_snapshots(conids):
-    """批量获取合约的价格快照"""
+    """获取一批合约的价格快照 (单次请求, 调用方负责控制 conid 数量)"""
     if not conids: return {}
     try:
-        endpoint_url = f"{BASE_URL}md/snapshot"
         params = {'conids': ','.join(conids), 'fields': '31,83'}
-        response = requests.get(endpoint_url, params=params, verify=False, timeout=5)
+        response = gateway.get("md/snapshot", params=params, timeout=5)
         if response.status_code == 200:
             return {str(item.get('conid')): item for item in response.json()}
         return {}
     except requests.exceptions.RequestException:
         return {}
 
-def get_historical_performance(account_id):
-    """获取并计算账户基于时间加权回报率(TWR)的真实每日投资表现"""
-    global performance_cache
-    cache_duration_minutes = 15
+class PriceSnapshotCache:
+    """按 conid 缓存价格快照 (短 TTL); 条目存放在进程间共享缓存中, 同一 conid 同时最多只有一个上游请求在途"""
+
+    NAMESPACE = 'price_snapshot'
+
+    def __init__(self, cache, fetcher, ttl_seconds):
+        self._cache = cache
+        self._fetcher = fetcher
+        self._ttl = ttl_seconds
+
+    def get(self, conids):
+        """返回 {conid: 快照}; 命中缓存的直接返回, 已在途的等待其结果, 其余合并为一次上游请求"""
+        return self._cache.get_many_or_compute(self.NAMESPACE, conids, self._fetcher, self._ttl, lease_seconds=10)
+
+
+class PriceSnapshotFetcher:
+    """把 md/snapshot 请求拆成固定大小的分块并发执行后合并, 并处理网关的订阅预热
+
+    网关对首次请求的 conid 只建立行情订阅, 返回的快照常缺少价格字段; 这类 conid 会在短暂延迟后
+    单独补请求 (最多 warmup_retries 次)。拿到过完整字段或已用完补请求次数的 conid 记入已订阅集合,
+    之后缺字段 (如停牌或无行情权限) 不再补请求, 避免每次轮询都多打一轮。
+    """
+
+    def __init__(self, chunk_size, warmup_retries, warmup_delay):
+        self.chunk_size = max(1, chunk_size)
+        self.warmup_retries = warmup_retries
+        self.warmup_delay = warmup_delay
+        self._lock = threading.Lock()
+        self._warmed = set()      # 拿到过完整价格字段的 conid
+        self._subscribed = set()  # 已用完补请求次数仍缺字段的 conid
+        self.chunks = 0
+        self.warmup_requests = 0
+
+    def is_complete(self, item):
+        return item is not None and all(field in item for field in PRICE_SNAPSHOT_FIELDS)
+
+    def fetch_async(self, conids):
+        """返回以 {conid: 快照} 完成的 Future; 所有分块及补请求均通过调度器以价格优先级执行"""
+        conids = list(dict.fromkeys(str(c) for c in conids))
+        result = concurrent.futures.Future()
+        merged = {}
+        lock = threading.Lock()
+        pending = [0]
+
+        def finish_one():
+            with lock:
+                pending[0] -= 1
+                if pending[0]:
+                    return
+            result.set_result(merged)
+
+        def submit_chunk(chunk, attempt):
+            with self._lock:
+                self.chunks += 1
+                if attempt:
+                    self.warmup_requests += len(chunk)
+            future = gateway_scheduler.submit(PRIORITY_PRICES, get_price_snapshots, chunk)
+            future.add_done_callback(lambda f: on_chunk(chunk, attempt, f))
+
+        def on_chunk(chunk, attempt, future):
+            fetched = future.result() if future.exception() is None else {}
+            complete = {c for c in chunk if self.is_complete(fetched.get(c))}
+            with self._lock:
+                self._warmed.update(complete)
+                cold = [c for c in chunk if c not in self._warmed and c not in self._subscribed]
+                if attempt >= self.warmup_retries:
+                    self._subscribed.update(cold)
+                    cold = []
+            with lock:
+                merged.update({c: fetched[c] for c in chunk if c in fetched})
+                retry = cold
+                if retry:
+                    pending[0] += 1
+            if retry:
+                # 延迟补请求放在定时器线程里提交, 不占用调度器的工作线程
+                timer = threading.Timer(self.warmup_delay, submit_chunk, args=(retry, attempt + 1))
+                timer.daemon = True
+                timer.start()
+            finish_one()
+
+        chunks = [conids[i:i + self.chunk_size] for i in range(0, len(conids), self.chunk_size)]
+        if not chunks:
+            result.set_result(merged)
+            return result
+        pending[0] = len(chunks)
+        for chunk in chunks:
+            submit_chunk(chunk, 0)
+        return result
+
+    def fetch(self, conids):
+        """同步版本; 不能在调度器的工作线程中调用"""
+        return self.fetch_async(conids).result()
+
+    def warm(self, conids):
+        """为尚未预热的 conid 提前发起订阅 (不等待结果), 使之后的第一次轮询即可拿到完整价格"""
+        with self._lock:
+            cold = [c for c in dict.fromkeys(str(c) for c in conids) if c not in self._warmed and c not in self._subscribed]
+        if cold:
+            self.fetch_async(cold)
+
+    def stats(self):
+        with self._lock:
+            return {'warmed': len(self._warmed), 'subscribed': len(self._subscribed), 'chunks': self.chunks, 'warmup_requests': self.warmup_requests}
+
+
+price_snapshots = PriceSnapshotFetcher(PRICE_SNAPSHOT_CHUNK_SIZE, PRICE_SNAPSHOT_WARMUP_RETRIES,
+                                       PRICE_SNAPSHOT_WARMUP_DELAY_SECONDS)
+price_cache = PriceSnapshotCache(shared_cache, price_snapshots.fetch, PRICE_CACHE_TTL_SECONDS)
+
+def format_price_snapshot(data):
+    """将 md/snapshot 返回的原始字段转换为前端使用的 {'price', 'change'} 结构"""
+    price = data.get('31', 'N/A')
+    is_closing_price = isinstance(price, str) and price.startswith('C')
+    return {'price': price[1:] if is_closing_price else price, 'change': data.get('83', 'N/A')}
+
+
+# --- 实时估值 ---
+
+def parse_price_value(value):
+    """将快照中的价格字段 (可能为 'N/A' 或带千分位的字符串) 转换为 float, 无法解析时返回 nan"""
+    try:
+        return float(str(value).replace(',', ''))
+    except (TypeError, ValueError):
+        return float('nan')
+
 
-    if account_id in performance_cache:
-        cached_data = performance_cache[account_id]
-        time_since_cache = datetime.datetime.now() - cached_data['timestamp']
-        if time_since_cache < datetime.timedelta(minutes=cache_duration_minutes):
-            print(f"--> [Cache HIT] 返回账户 {account_id} 的历史表现缓存数据。")
-            return cached_data['data']
+class PortfolioValuationState:
+    """按 conid 索引的内存持仓状态: 价格更新时在服务端计算每行市值、盈亏及各账户汇总, 前端只需套用结果"""
 
-    print(f"--> [Cache MISS] 正在为账户 {account_id} 调用 /pa/performance API 获取TWR数据...")
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._accounts = {}  # account_id -> {'conids', 'position', 'costBasis', 'cash', 'currency'}
+        self._prices = {}    # conid -> (最新价, 当日涨跌), 只保留能解析的最新值
 
+    def update_account(self, account_id, data):
+        """由 fetch_all_data_for_account (或聚合结果) 的数据重建单个账户的持仓数组; 数据为空时移除该账户"""
+        if not data or not data.get('summary'):
+            with self._lock:
+                self._accounts.pop(account_id, None)
+            return
+        positions = data.get('positions', [])
+        self.update_aggregate(account_id, {
+            'summary': data['summary'],
+            'conids': pd.Index([str(p.conid) for p in positions]),
+            'position': np.fromiter((p.position for p in positions), dtype='float64', count=len(positions)),
+            'costBasis': np.fromiter((p.costBasis for p in positions), dtype='float64', count=len(positions)),
+            'incomplete': bool(data.get('incomplete')),
+        })
+
+    def update_aggregate(self, account_id, arrays):
+        """直接写入已是数组形式的持仓 (PortfolioAggregator.valuation_input 的结果), 不再逐条遍历持仓
+
+        incomplete 为真 (摘要或部分持仓获取失败) 的账户估值不可信, 其 fullyPriced 始终为 False。
+        """
+        state = {
+            'conids': arrays['conids'],
+            'position': arrays['position'],
+            'costBasis': arrays['costBasis'],
+            'cash': float(arrays['summary'].get('cash', 0) or 0),
+            'currency': arrays['summary'].get('currency', 'USD'),
+            'incomplete': bool(arrays.get('incomplete')),
+        }
+        with self._lock:
+            self._accounts[account_id] = state
+
+    def apply_prices(self, price_dict):
+        """写入 format_price_snapshot 格式的价格; 价格无法解析时沿用上一次的有效价格"""
+        with self._lock:
+            for conid, info in price_dict.items():
+                price = parse_price_value(info.get('price'))
+                change = parse_price_value(info.get('change'))
+                if np.isnan(price):
+                    if conid not in self._prices:
+                        continue
+                    price = self._prices[conid][0]
+                self._prices[conid] = (price, 0.0 if np.isnan(change) else change)
+
+    def valuate(self, conids=None):
+        """计算估值; conids 给定时只返回这些 conid 的价格与行数据, 账户汇总总是完整返回
+
+        返回 {'prices': {conid: {...}}, 'rows': {account_id: {conid: {...}}}, 'accounts': {account_id: {...}}}
+        """
+        with self._lock:
+            accounts = dict(self._accounts)
+            prices = dict(self._prices)
+        wanted = None if conids is None else set(conids)
+
+        price_frame = pd.DataFrame.from_dict(prices, orient='index', columns=['price', 'change'])
+        previous_close = price_frame['price'] - price_frame['change']
+        with np.errstate(divide='ignore', invalid='ignore'):
+            change_percent = np.where(previous_close != 0, price_frame['change'] / previous_close * 100, 0.0)
+        result = {'prices': {}, 'rows': {}, 'accounts': {}}
+        for conid, price, change, pct in zip(price_frame.index.tolist(), price_frame['price'].tolist(),
+                                             price_frame['change'].tolist(), change_percent.tolist()):
+            if wanted is None or conid in wanted:
+                result['prices'][conid] = {'price': price, 'change': change, 'changePercent': pct}
+
+        for account_id, state in accounts.items():
+            aligned = price_frame.reindex(state['conids'])
+            price = np.nan_to_num(aligned['price'].to_numpy(dtype='float64'))
+            change = np.nan_to_num(aligned['change'].to_numpy(dtype='float64'))
+            market_value = price * state['position']
+            unrealized_pnl = market_value - state['costBasis']
+            daily_pnl = change * state['position']
+            with np.errstate(divide='ignore', invalid='ignore'):
+                pnl_percent = np.where(state['costBasis'] != 0, unrealized_pnl / state['costBasis'] * 100, 0.0)
+
+            total_market_value = float(market_value.sum())
+            result['accounts'][account_id] = {
+                'marketValue': total_market_value,
+                'dailyPnl': float(daily_pnl.sum()),
+                'netLiquidation': total_market_value + state['cash'],
+                'currency': state['currency'],
+                'fullyPriced': not state['incomplete'] and bool(aligned['price'].notna().all()),
+            }
+            rows = {}
+            for conid, mv, pnl, pct, dpnl in zip(state['conids'].tolist(), market_value.tolist(), unrealized_pnl.tolist(),
+                                                 pnl_percent.tolist(), daily_pnl.tolist()):
+                if (wanted is None or conid in wanted) and conid in prices:
+                    rows[conid] = {'marketValue': mv, 'unrealizedPnl': pnl, 'pnlPercent': pct, 'dailyPnl': dpnl}
+            if rows:
+                result['rows'][account_id] = rows
+        return result
+
+    @staticmethod
+    def filter_for(valuation, conid_set):
+        """从完整估值中截取某个订阅者关心的 conid"""
+        return {
+            'prices': {c: v for c, v in valuation['prices'].items() if c in conid_set},
+            'rows': {a: {c: v for c, v in rows.items() if c in conid_set} for a, rows in valuation['rows'].items()},
+            'accounts': valuation['accounts'],
+        }
+
+
+portfolio_state = PortfolioValuationState()
+
+
+class NetLiqRingBuffer:
+    """固定容量的环形缓冲, 时间戳与数值各占一个 numpy 数组; 落在同一时间桶内的新值覆盖该桶的点"""
+
+    def __init__(self, bucket_seconds, capacity):
+        self.bucket_seconds = bucket_seconds
+        self.capacity = capacity
+        self._ts = np.zeros(capacity, dtype='int64')
+        self._values = np.zeros(capacity, dtype='float64')
+        self._next = 0
+        self._size = 0
+
+    def append(self, timestamp, value):
+        bucket = int(timestamp) // self.bucket_seconds * self.bucket_seconds
+        last = (self._next - 1) % self.capacity
+        if self._size and self._ts[last] == bucket:
+            self._values[last] = value
+            return
+        self._ts[self._next] = bucket
+        self._values[self._next] = value
+        self._next = (self._next + 1) % self.capacity
+        self._size = min(self._size + 1, self.capacity)
+
+    def arrays(self):
+        """按时间顺序返回 (时间桶起点, 数值) 两个数组的副本"""
+        order = (self._next - self._size + np.arange(self._size)) % self.capacity
+        return self._ts[order], self._values[order]
+
+
+class NetLiqHistory:
+    """各账户的日内净清算价值序列: 每次价格刷新后记录一次, 同时写入每种分辨率的环形缓冲, 内存占用固定"""
+
+    def __init__(self, resolutions):
+        self._resolutions = resolutions
+        self._lock = threading.Lock()
+        self._buffers = {}  # account_id -> {分辨率: NetLiqRingBuffer}
+
+    def record(self, accounts, timestamp=None):
+        """accounts 为 valuate() 返回的账户汇总; 仍有持仓缺少价格的账户跳过, 避免记录偏低的净值"""
+        timestamp = time.time() if timestamp is None else timestamp
+        with self._lock:
+            for account_id, totals in accounts.items():
+                if not totals.get('fullyPriced'):
+                    continue
+                buffers = self._buffers.get(account_id)
+                if buffers is None:
+                    buffers = self._buffers[account_id] = {name: NetLiqRingBuffer(seconds, capacity)
+                                                           for name, (seconds, capacity) in self._resolutions.items()}
+                for buffer in buffers.values():
+                    buffer.append(timestamp, totals['netLiquidation'])
+
+    def series(self, account_id, resolution):
+        """返回 {'t': 时间桶起点 (Unix 秒), 'v': 净清算价值, 'bucket_seconds', 'capacity'}; 分辨率无效时返回 None"""
+        if resolution not in self._resolutions:
+            return None
+        bucket_seconds, capacity = self._resolutions[resolution]
+        with self._lock:
+            buffer = self._buffers.get(account_id, {}).get(resolution)
+            ts, values = buffer.arrays() if buffer else (np.empty(0, dtype='int64'), np.empty(0))
+        return {'t': ts.tolist(), 'v': np.round(values, 2).tolist(), 'bucket_seconds': bucket_seconds, 'capacity': capacity}
+
+
+net_liq_history = NetLiqHistory(NET_LIQ_RESOLUTIONS)
+
+
+class PriceStreamHub:
+    """每个进程一个后台轮询线程, 为所有 SSE 订阅者拉取价格, 并只向其推送订阅范围内发生变化的 conid 及其估值"""
+
+    def __init__(self, cache, state, interval_seconds):
+        self._cache = cache
+        self._state = state
+        self._interval = interval_seconds
+        self._lock = threading.Lock()
+        self._subscribers = {}  # 订阅者队列 -> 订阅的 conid 集合
+        self._latest = {}       # conid -> 最近一次推送的价格
+        self._thread = None
+
+    def subscribe(self, conids):
+        """注册订阅者, 返回其消息队列; 已知价格的估值会立即作为首条消息放入队列"""
+        subscriber = queue.Queue()
+        conid_set = set(conids)
+        with self._lock:
+            self._subscribers[subscriber] = conid_set
+            has_initial = any(c in self._latest for c in conid_set)
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='price-stream-poller', daemon=True)
+                self._thread.start()
+        if has_initial:
+            subscriber.put(self._state.valuate(conid_set))
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            self._subscribers.pop(subscriber, None)
+
+    def _run(self):
+        while True:
+            with self._lock:
+                if not self._subscribers:
+                    self._thread = None
+                    return
+                wanted = set().union(*self._subscribers.values())
+            try:
+                self._publish(self._cache.get(list(wanted)))
+            except Exception as e:
+                log_event('price_stream_fetch_failed', '价格推送线程获取价格时出错', level='error', error=str(e))
+            time.sleep(self._interval)
+
+    def _publish(self, raw_price_data):
+        changed = {}
+        for conid, data in raw_price_data.items():
+            formatted = format_price_snapshot(data)
+            if self._latest.get(conid) != formatted:
+                changed[conid] = formatted
+        if not changed:
+            return
+        self._state.apply_prices(changed)
+        valuation = self._state.valuate(changed)
+        net_liq_history.record(valuation['accounts'])
+        with self._lock:
+            self._latest.update(changed)
+            for subscriber, conid_set in self._subscribers.items():
+                if not conid_set.isdisjoint(changed):
+                    subscriber.put(PortfolioValuationState.filter_for(valuation, conid_set))
+
+
+price_stream_hub = PriceStreamHub(price_cache, portfolio_state, PRICE_STREAM_INTERVAL_SECONDS)
+
+# --- 历史表现持久化存储 ---
+
+class PerformanceHistoryStore:
+    """基于 SQLite 的账户累计回报率(CPS)存储: 重启后可直接复用, 刷新时只追加最后一个已存日期之后的数据"""
+
+    def __init__(self, path, max_idle_days, max_accounts):
+        self.path = path
+        self.max_idle_days = max_idle_days
+        self.max_accounts = max_accounts
+        self._write_lock = threading.Lock()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS cps_history ("
+                         "account_id TEXT NOT NULL, date TEXT NOT NULL, cumulative REAL NOT NULL, "
+                         "PRIMARY KEY (account_id, date))")
+            conn.execute("CREATE TABLE IF NOT EXISTS cps_accounts ("
+                         "account_id TEXT PRIMARY KEY, refreshed_at REAL NOT NULL, last_access REAL NOT NULL)")
+
+    @contextlib.contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=10)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def load(self, account_id):
+        """返回 (日期列表, 累计回报列表, 上次刷新时间戳); 无记录时返回 None"""
+        with self._connect() as conn:
+            meta = conn.execute("SELECT refreshed_at FROM cps_accounts WHERE account_id = ?", (account_id,)).fetchone()
+            if meta is None:
+                return None
+            rows = conn.execute("SELECT date, cumulative FROM cps_history WHERE account_id = ? ORDER BY date",
+                                (account_id,)).fetchall()
+            conn.execute("UPDATE cps_accounts SET last_access = ? WHERE account_id = ?", (time.time(), account_id))
+        if not rows:
+            return None
+        dates, cumulative = zip(*rows)
+        return list(dates), list(cumulative), meta[0]
+
+    def save(self, account_id, dates, cumulative):
+        """写入 (覆盖) 给定日期的累计回报, 更新刷新时间并执行淘汰策略"""
+        now = time.time()
+        with self._write_lock, self._connect() as conn:
+            conn.executemany("INSERT OR REPLACE INTO cps_history (account_id, date, cumulative) VALUES (?, ?, ?)",
+                             [(account_id, d, c) for d, c in zip(dates, cumulative)])
+            conn.execute("INSERT OR REPLACE INTO cps_accounts (account_id, refreshed_at, last_access) VALUES (?, ?, ?)",
+                         (account_id, now, now))
+            self._evict(conn, now)
+
+    def _evict(self, conn, now):
+        stale = [row[0] for row in conn.execute(
+            "SELECT account_id FROM cps_accounts WHERE last_access < ?", (now - self.max_idle_days * 86400,))]
+        overflow = [row[0] for row in conn.execute(
+            "SELECT account_id FROM cps_accounts ORDER BY last_access DESC LIMIT -1 OFFSET ?", (self.max_accounts,))]
+        for account_id in set(stale) | set(overflow):
+            log_event('performance_store_evict', '移除账户的历史表现数据', account=account_id)
+            conn.execute("DELETE FROM cps_history WHERE account_id = ?", (account_id,))
+            conn.execute("DELETE FROM cps_accounts WHERE account_id = ?", (account_id,))
+
+
+performance_store = PerformanceHistoryStore(PERFORMANCE_DB_PATH, PERFORMANCE_MAX_IDLE_DAYS, PERFORMANCE_MAX_ACCOUNTS)
+
+
+def choose_incremental_period(last_date):
+    """根据最后一个已存日期选取能覆盖它的最短查询区间; 间隔过长时返回 None 表示需全量获取"""
+    gap_days = (datetime.date.today() - datetime.datetime.strptime(last_date, "%Y%m%d").date()).days
+    for period, days in PERFORMANCE_PERIODS:
+        if gap_days < days:
+            return period
+    return None
+
+
+def compute_performance(series_by_account):
+    """对所有账户一次性做向量化计算: 每日 TWR 及累计回报、回撤、滚动收益/波动率等派生指标
+
+    series_by_account: {account_id: (日期列表, 累计回报列表)}
+    返回 {account_id: {'history': {'dates': [...], 'twr': [...]}, 'stats': {...}}}, 历史为列式的两个等长数组
+    """
+    if not series_by_account:
+        return {}
+    cumulative = pd.DataFrame({
+        account_id: pd.Series(values, index=dates, dtype='float64')
+        for account_id, (dates, values) in series_by_account.items()
+    }).sort_index()
+    valid = cumulative.notna()
+    # 各账户的日期范围不同: 区间内的缺口用前值填充, 使跨缺口的每日回报仍然正确, 计算后再屏蔽缺失位置
+    growth = (1 + cumulative).ffill()
+    daily_twr = (growth / growth.shift(1) - 1).where(valid)
+    drawdown = (growth / growth.cummax() - 1).where(valid)
+    rolling_returns = {name: growth / growth.shift(window) - 1 for name, window in ROLLING_RETURN_WINDOWS.items()}
+    volatility = daily_twr.rolling(ROLLING_VOLATILITY_WINDOW, min_periods=ROLLING_VOLATILITY_WINDOW // 3).std() * np.sqrt(252)
+
+    last_index = valid[::-1].idxmax()
+    results = {}
+    for account_id in cumulative.columns:
+        daily = daily_twr[account_id].dropna()
+        last = last_index[account_id]
+        stats = {
+            'cumulative_return': cumulative.at[last, account_id],
+            'current_drawdown': drawdown.at[last, account_id],
+            'max_drawdown': drawdown[account_id].min(),
+            'annualized_volatility': volatility.at[last, account_id],
+        }
+        stats.update({name: frame.at[last, account_id] for name, frame in rolling_returns.items()})
+        results[account_id] = {
+            'history': {'dates': daily.index.tolist(), 'twr': daily.to_numpy().tolist()},
+            'stats': {k: (None if pd.isna(v) else float(v)) for k, v in stats.items()},
+        }
+    return results
+
+
+def downsample_returns(dates, twr, max_points):
+    """把每日回报按相邻区间复利合并为不超过 max_points 个点, 每个点以区间最后一天为日期; max_points 为 0 时不降采样"""
+    count = len(twr)
+    if not max_points or count <= max_points:
+        return dates, twr
+    bucket = np.arange(count) * max_points // count
+    starts = np.flatnonzero(np.r_[True, bucket[1:] != bucket[:-1]])
+    ends = np.r_[starts[1:], count] - 1
+    merged = np.expm1(np.add.reduceat(np.log1p(np.asarray(twr, dtype='float64')), starts))
+    return [dates[i] for i in ends], merged.tolist()
+
+
+def fetch_cumulative_returns_batch(account_ids, period=None):
+    """一次调用 /pa/performance 获取多个账户的累计回报, 返回 {account_id: (日期列表, 累计回报列表)}, 按日期升序
+
+    回报序列与响应共享的日期轴长度不一致的账户会被跳过 (记录日志), 不出现在结果中。
+    """
+    payload = {'acctIds': list(account_ids)}
+    if period:
+        payload['period'] = period
+    response = gateway.post("pa/performance", json=payload, timeout=PERFORMANCE_TIMEOUT_SECONDS)
+    response.raise_for_status()
+    data = response.json()
+
+    cps_data_root = data.get('cps', {})
+    date_strings = cps_data_root.get('dates', [])
+    if not date_strings:
+        raise ValueError("API响应中缺少日期数据。")
+    order = np.argsort(date_strings, kind='stable')
+    sorted_dates = [date_strings[i] for i in order]
+
+    result, skipped = {}, []
+    for node in cps_data_root.get('data', []):
+        account_id = node.get('id') or (account_ids[0] if len(account_ids) == 1 else None)
+        cumulative_returns = node.get('returns', [])
+        if not account_id or len(cumulative_returns) != len(date_strings):
+            skipped.append({'account': account_id, 'returns': len(cumulative_returns), 'dates': len(date_strings)})
+            continue
+        result[account_id] = (sorted_dates, np.asarray(cumulative_returns, dtype='float64')[order].tolist())
+    if skipped:
+        log_event('performance_cps_invalid', 'CPS数据不完整或与日期不匹配, 已跳过', level='warning', skipped=skipped)
+    return result
+
+
+def _fetch_accounts(account_ids, period):
+    """用一次 /pa/performance 请求获取所有给定账户; 失败时只记录错误, 由调用方决定回退
+
+    /pa/performance 每 15 分钟只允许 1 次调用, 因此不分块: 分块后排在后面的账户每次刷新都拿不到配额。
+    请求失败或在响应中被跳过的账户不出现在结果中, 按原因 (error/mismatch) 计入 ibkr_performance_missing_total
+    并记录缺失的账户; 它们由调用方回退到存储数据, 没有存储数据的不会写入缓存, 下次刷新时与其余账户一起重新请求。
+    """
     try:
-        endpoint_url = f"{BASE_URL}pa/performance"
-        payload = {'acctIds': [account_id]}
-        response = requests.post(endpoint_url, json=payload, verify=False, timeout=20)
-        response.raise_for_status()
-        data = response.json()
-
-        cps_data_root = data.get('cps', {})
-        account_data_node = cps_data_root.get('data', [{}])[0]
-        cumulative_returns = account_data_node.get('returns', [])
-        date_strings = cps_data_root.get('dates', [])
-
-        if not cumulative_returns or not date_strings or len(cumulative_returns) != len(date_strings):
-            raise ValueError("API响应中CPS或日期数据不完整或不匹配。")
-
-        daily_twr_list = []
-        sorted_returns = sorted(zip(date_strings, cumulative_returns))
-
-        for i in range(1, len(sorted_returns)):
-            current_date, cumulative_today = sorted_returns[i]
-            _, cumulative_yesterday = sorted_returns[i-1]
-            daily_twr = (1 + cumulative_today) / (1 + cumulative_yesterday) - 1
-            daily_twr_list.append({'date': current_date, 'twr': daily_twr})
-
-        performance_cache[account_id] = {'timestamp': datetime.datetime.now(), 'data': daily_twr_list}
-        print(f"<-- 完成获取和处理账户 {account_id} 的每日TWR数据。")
-        return daily_twr_list
+        fetched, reason = fetch_cumulative_returns_batch(account_ids, period), 'mismatch'
     except (requests.exceptions.RequestException, KeyError, IndexError, ValueError) as e:
-        print(f"!!! 获取或处理账户 {account_id} 的历史表现数据时出错: {e}")
+        log_event('performance_batch_failed', '批量获取历史表现数据时出错', level='error', accounts=account_ids, error=str(e))
+        fetched, reason = {}, 'error'
+    missing = [account_id for account_id in account_ids if account_id not in fetched]
+    if missing:
+        metrics.inc('ibkr_performance_missing_total', len(missing), reason=reason)
+        if reason == 'mismatch':
+            log_event('performance_accounts_missing', '部分账户的历史表现数据缺失或与日期轴不匹配, 本次未获取到',
+                      level='warning', accounts=missing, period=period)
+    return fetched
+
+
+def refresh_performance_batch(account_ids):
+    """获取多个账户的历史表现, 返回 compute_performance() 的结果; 获取失败且无存储数据的账户不出现在结果中
+
+    计算结果放在进程间共享缓存中 (有效期与存储的刷新间隔一致): 多个页面或 worker 进程同时请求同一账户时,
+    只有一个会真正调用 /pa/performance, 其余等待并复用其结果。
+    """
+    lease_seconds = PERFORMANCE_TIMEOUT_SECONDS * (GATEWAY_MAX_RETRIES + 1)
+    return shared_cache.get_many_or_compute('performance', account_ids, _refresh_performance_batch,
+                                            PERFORMANCE_REFRESH_MINUTES * 60, lease_seconds=lease_seconds)
+
+
+def rebase_cumulative_returns(stored_dates, stored_cumulative, dates, cumulative):
+    """把某个区间的累计回报换算到全历史基准, 返回最后一个已存日期之后的 (日期列表, 累计回报列表)
+
+    区间内的累计回报以区间起点为基准, 以最后一个已存日期为锚点换算; 区间不包含该日期 (无重叠) 时返回 None。
+    """
+    last_date = stored_dates[-1]
+    if last_date not in dates:
         return None
+    anchor = dates.index(last_date)
+    scale = (1 + stored_cumulative[-1]) / (1 + cumulative[anchor])
+    return dates[anchor + 1:], ((np.asarray(cumulative[anchor + 1:]) + 1) * scale - 1).tolist()
+
+
+# 增量数据与已存数据无重叠的账户: 下次刷新改为全量获取
+_performance_needs_full = set()
+
+
+def _refresh_performance_batch(account_ids):
+    """存储中仍新鲜的直接读取, 其余账户合并为一次 /pa/performance 请求, 再计算每日TWR及统计指标
+
+    请求的区间取能覆盖所有过期账户的最长区间 (有账户没有存储数据时为全量), 每个账户再以自己的最后一个已存日期
+    为锚点在本地换算到全历史基准后写回存储。/pa/performance 每 15 分钟只允许 1 次调用, 因此每次刷新只发一个请求。
+    """
+    series, stale = {}, {}
+    for account_id in account_ids:
+        stored = performance_store.load(account_id)
+        if stored and time.time() - stored[2] < PERFORMANCE_REFRESH_MINUTES * 60:
+            series[account_id] = stored[:2]
+            continue
+        stale[account_id] = stored
+
+    periods = [choose_incremental_period(stored[0][-1]) if stored and account_id not in _performance_needs_full else None
+               for account_id, stored in stale.items()]
+    period_days = dict(PERFORMANCE_PERIODS)
+    period = None if None in periods else max(periods, key=period_days.get, default=None)
+    missing_store = sum(1 for stored in stale.values() if not stored)
+    for outcome, count in (('hit', len(series)), ('stale', len(stale) - missing_store), ('miss', missing_store)):
+        if count:
+            metrics.inc('ibkr_cache_requests_total', count, cache='performance_store', result=outcome)
+    if series:
+        log_event('performance_cache_hit', '历史表现直接使用存储数据', accounts=list(series))
+
+    if stale:
+        log_event('performance_fetch', '调用 /pa/performance 获取TWR数据', accounts=list(stale), period=period or 'full')
+        fetched = _fetch_accounts(list(stale), period)
+        for account_id, stored in stale.items():
+            if account_id not in fetched:
+                if stored:
+                    series[account_id] = stored[:2]
+                continue
+            dates, cumulative = fetched[account_id]
+            if period is None or not stored:
+                performance_store.save(account_id, dates, cumulative)
+                _performance_needs_full.discard(account_id)
+                series[account_id] = (dates, cumulative)
+                continue
+            stored_dates, stored_cumulative, _ = stored
+            rebased = rebase_cumulative_returns(stored_dates, stored_cumulative, dates, cumulative)
+            if rebased is None:
+                log_event('performance_incremental_gap', '增量数据与已存数据无重叠, 下次刷新改为全量获取', level='warning', account=account_id)
+                _performance_needs_full.add(account_id)
+                series[account_id] = (stored_dates, stored_cumulative)
+                continue
+            new_dates, new_cumulative = rebased
+            performance_store.save(account_id, new_dates, new_cumulative)
+            series[account_id] = (stored_dates + new_dates, stored_cumulative + new_cumulative)
+
+    results = compute_performance(series)
+    log_event('performance_computed', '完成每日TWR计算', accounts=len(results))
+    return results
+
+
+def load_cached_performance(account_id):
+    """只从共享缓存或存储读取账户的历史表现, 不请求 /pa/performance (其配额留给仪表盘的批量刷新); 都没有时返回 None"""
+    cached = shared_cache.get_many('performance', [account_id]).get(account_id)
+    if cached is not None:
+        return cached
+    stored = performance_store.load(account_id)
+    return compute_performance({account_id: stored[:2]}).get(account_id) if stored else None
+
+
+def get_historical_performance(account_id):
+    """读取账户基于时间加权回报率(TWR)的每日投资表现 (缓存或存储中的数据)"""
+    try:
+        result = load_cached_performance(account_id)
+    except sqlite3.Error as e:
+        log_event('performance_failed', '读取历史表现数据时出错', level='error', account=account_id, error=str(e))
+        return None
+    return result['history'] if result else None
 
 # main.py
 
-def fetch_all_data_for_account(acc_id):
-    """获取并处理单个账户的摘要、持仓和历史表现数据"""
-    
-    # --- 新增的防御性检查 ---
-    if not acc_id or not acc_id.strip():
-        print(f"!!! 检测到无效的账户ID，已跳过。ID: '{acc_id}'")
-        # 返回一个空的数据结构，以避免下游函数出错
-        return acc_id, {'summary': {}, 'positions': [], 'performance': None}
-    # --- 检查结束 ---
+def _to_float(value):
+    try:
+        return float(value)
+    except (ValueError, TypeError):
+        return 0.0
 
-    print(f"--> 开始并行获取账户 {acc_id} 的所有数据...")
-    
-    with concurrent.futures.ThreadPoolExecutor(max_workers=3) as executor:
-        future_summary = executor.submit(get_account_summary, acc_id)
-        future_positions = executor.submit(get_account_positions, acc_id)
-        future_performance = executor.submit(get_historical_performance, acc_id)
 
-        summary_raw = future_summary.result()
-        positions_raw = future_positions.result()
-        performance_data = future_performance.result()
+class PositionRecord:
+    """单条持仓的精简记录: 只保留仪表盘与估值用到的字段, 网关原始响应 (数十个字段) 仅在显式要求时保留在 raw 中"""
 
-    processed_positions = []
-    if isinstance(positions_raw, list):
-        for p in positions_raw:
-            try:
-                p['costBasis'] = float(p.get('position', 0)) * float(p.get('avgCost', 0))
-                processed_positions.append(p)
-            except (ValueError, TypeError):
-                p['costBasis'] = 0
-                processed_positions.append(p)
+    __slots__ = ('conid', 'contractDesc', 'assetClass', 'currency', 'position', 'avgCost', 'costBasis', 'raw')
+
+    def __init__(self, conid, contractDesc, assetClass, currency, position, avgCost, costBasis, raw=None):
+        self.conid = conid
+        self.contractDesc = contractDesc
+        self.assetClass = assetClass
+        self.currency = currency
+        self.position = position
+        self.avgCost = avgCost
+        self.costBasis = costBasis
+        self.raw = raw
+
+    @classmethod
+    def from_payload(cls, payload, keep_raw=False):
+        """从 portfolio/{id}/positions 的单条原始数据投影, 并计算持仓成本 costBasis"""
+        position, avg_cost = _to_float(payload.get('position')), _to_float(payload.get('avgCost'))
+        return cls(payload.get('conid'), payload.get('contractDesc'), payload.get('assetClass'), payload.get('currency'),
+                   position, avg_cost, position * avg_cost, payload if keep_raw else None)
 
+    def __repr__(self):
+        return f'{type(self).__name__}(conid={self.conid!r}, contractDesc={self.contractDesc!r}, position={self.position!r})'
+
+
+class AggregatePositionRecord(PositionRecord):
+    """聚合视图中的一行: 在精简记录之外附带各账户的持仓数量 holdings_breakdown"""
+
+    __slots__ = ('holdings_breakdown',)
+
+    def __init__(self, conid, contractDesc, assetClass, currency, position, avgCost, costBasis, holdings_breakdown):
+        super().__init__(conid, contractDesc, assetClass, currency, position, avgCost, costBasis)
+        self.holdings_breakdown = holdings_breakdown
+
+def build_summary_data(summary_raw):
+    """从 portfolio/{id}/summary 的原始响应中提取仪表盘使用的摘要字段"""
     summary_data = {
         key: float(summary_raw.get(val, {}).get('amount', 0)) 
         for key, val in [
@@ -199,139 +1877,496 @@ def fetch_all_data_for_account(acc_id):
         ]
     }
     summary_data['currency'] = summary_raw.get('netliquidation', {}).get('currency', 'USD')
+    return summary_data
+
+def fetch_account_data_async(acc_id, include_performance=True, include_raw=False):
+    """通过调度器并发获取单个账户的摘要、持仓和历史表现数据, 返回以 (acc_id, data) 完成的 Future
+
+    持仓为 PositionRecord 列表; include_raw 为真时每条记录的 raw 保留网关的原始数据。
+    """
     
-    print(f"<-- 完成获取账户 {acc_id} 的数据。")
-    return acc_id, {'summary': summary_data, 'positions': processed_positions, 'performance': performance_data}
-    """获取并处理单个账户的摘要、持仓和历史表现数据"""
-    print(f"--> 开始并行获取账户 {acc_id} 的所有数据...")
+    # --- 新增的防御性检查 ---
+    if not acc_id or not acc_id.strip():
+        log_event('invalid_account_id', '检测到无效的账户ID, 已跳过', level='warning', account=acc_id)
+        # 返回一个空的数据结构，以避免下游函数出错
+        result = concurrent.futures.Future()
+        result.set_result((acc_id, {'summary': {}, 'positions': [], 'performance': None}))
+        return result
+    # --- 检查结束 ---
+
+    log_event('account_fetch_start', '开始并行获取账户的所有数据', account=acc_id)
     
-    with concurrent.futures.ThreadPoolExecutor(max_workers=3) as executor:
-        future_summary = executor.submit(get_account_summary, acc_id)
-        future_positions = executor.submit(get_account_positions, acc_id)
-        future_performance = executor.submit(get_historical_performance, acc_id)
+    future_summary = gateway_scheduler.submit(PRIORITY_PORTFOLIO, get_account_summary, acc_id)
+    # 持仓逐页到达即处理, 与摘要/历史表现的请求重叠进行
+    future_positions = fetch_position_pages_async(acc_id, lambda p: PositionRecord.from_payload(p, keep_raw=include_raw))
+    future_performance = gateway_scheduler.submit(PRIORITY_PERFORMANCE, get_historical_performance, acc_id) if include_performance else None
 
+    def combine():
         summary_raw = future_summary.result()
-        positions_raw = future_positions.result()
-        performance_data = future_performance.result()
+        positions, positions_complete = future_positions.result()
+        performance_data = future_performance.result() if future_performance else None
+        incomplete = summary_raw is None or not positions_complete
+        if incomplete:
+            log_event('account_incomplete', '账户数据不完整 (摘要或部分持仓页在重试后仍获取失败)', level='warning', account=acc_id)
+        log_event('account_fetch_done', '完成获取账户的数据', account=acc_id, positions=len(positions))
+        return acc_id, {'summary': build_summary_data(summary_raw or {}), 'positions': positions,
+                        'performance': performance_data, 'incomplete': incomplete}
 
-    processed_positions = []
-    if isinstance(positions_raw, list):
-        for p in positions_raw:
-            try:
-                p['costBasis'] = float(p.get('position', 0)) * float(p.get('avgCost', 0))
-                processed_positions.append(p)
-            except (ValueError, TypeError):
-                p['costBasis'] = 0
-                processed_positions.append(p)
+    return when_all([f for f in (future_summary, future_positions, future_performance) if f], combine)
+
+def fetch_all_data_for_account(acc_id, include_performance=True, include_raw=False):
+    """获取并处理单个账户的摘要、持仓和历史表现数据 (同步版本, 只能在请求线程中调用)"""
+    return fetch_account_data_async(acc_id, include_performance, include_raw).result()
+
+# --- 持仓聚合引擎 ---
+
+SUMMARY_NUMERIC_KEYS = ['net_liquidation', 'realized_pnl', 'cash', 'buying_power']
+AGGREGATE_DESCRIPTIVE_FIELDS = ['contractDesc', 'assetClass', 'currency']
+
+
+class PortfolioAggregator:
+    """列式持仓聚合引擎: 按 conid 维护跨账户的累计持仓 (running totals)
+
+    每个账户的持仓按 conid 预聚合为一张小表 (贡献表)。某个账户变化时从累计表中减去它旧的贡献、加上新的贡献,
+    其他账户不参与计算; 各账户持仓数量的明细 (holdings_breakdown) 只在生成结果时用一次透视得到。
+    获取失败或数据不完整的账户不计入汇总 (失败的摘要会被当作全 0), 结果中的 excluded_accounts 列出这些账户。
+    """
+
+    NUMERIC_COLUMNS = ['position', 'costBasis', 'holders']
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._summaries = {}      # account_id -> 摘要字典
+        self._contributions = {}  # account_id -> 以 conid 为索引的 DataFrame (position, costBasis, holders, 描述字段)
+        self._fingerprints = {}
+        self._versions = {}
+        self._incomplete = set()  # 获取失败或数据不完整 (摘要或部分持仓获取失败) 而未计入汇总的账户
+        # 累计表与描述字段表只整体替换、不原地修改, 读取方可以在锁外使用取到的引用
+        self._totals = pd.DataFrame(columns=self.NUMERIC_COLUMNS, dtype='float64')
+        self._descriptions = pd.DataFrame(columns=AGGREGATE_DESCRIPTIVE_FIELDS, dtype='object')
+        self._result_cache = (None, None)
+
+    @staticmethod
+    def _fingerprint(data):
+        positions = data.get('positions', [])
+        return hash((tuple(sorted(data['summary'].items())),
+                     tuple((p.conid, p.position, p.costBasis) for p in positions)))
+
+    @staticmethod
+    def _build_contribution(positions):
+        columns = ['conid', 'position', 'costBasis', *AGGREGATE_DESCRIPTIVE_FIELDS]
+        frame = pd.DataFrame({c: [getattr(p, c) for p in positions] for c in columns}, columns=columns)
+        for column in ('position', 'costBasis'):
+            frame[column] = frame[column].astype('float64')
+        aggregations = {'position': 'sum', 'costBasis': 'sum', **{c: 'first' for c in AGGREGATE_DESCRIPTIVE_FIELDS}}
+        contribution = frame.groupby('conid', sort=False).agg(aggregations)
+        contribution['holders'] = 1.0
+        return contribution
+
+    def _replace_contribution(self, account_id, new):
+        """在锁内调用: 用 new 替换账户旧的贡献 (new 为 None 时移除), 只对这两张表做向量化加减"""
+        old = self._contributions.pop(account_id, None)
+        totals, descriptions = self._totals, self._descriptions
+        if old is not None and not old.empty:
+            totals = totals.sub(old[self.NUMERIC_COLUMNS], fill_value=0)
+        if new is not None:
+            self._contributions[account_id] = new
+            if not new.empty:
+                totals = totals.add(new[self.NUMERIC_COLUMNS], fill_value=0)
+                fresh = new.loc[~new.index.isin(descriptions.index), AGGREGATE_DESCRIPTIVE_FIELDS]
+                if not fresh.empty:
+                    descriptions = pd.concat([descriptions, fresh]) if not descriptions.empty else fresh
+        gone = totals.index[totals['holders'] <= 0]
+        if len(gone):
+            totals = totals.drop(gone)
+            descriptions = descriptions.drop(gone, errors='ignore')
+        self._totals, self._descriptions = totals, descriptions
+
+    def update_account(self, account_id, data):
+        """写入单个账户的最新数据; 数据为空 (获取失败) 或不完整时从汇总中移除该账户并记为未计入"""
+        if not data or not data.get('summary') or data.get('incomplete'):
+            self.remove_account(account_id)
+            with self._lock:
+                self._incomplete.add(account_id)
+            return
+        fingerprint = self._fingerprint(data)
+        with self._lock:
+            self._incomplete.discard(account_id)
+            if self._fingerprints.get(account_id) == fingerprint:
+                return
+        contribution = self._build_contribution(data.get('positions', []))
+        with self._lock:
+            self._replace_contribution(account_id, contribution)
+            self._summaries[account_id] = dict(data['summary'])
+            self._fingerprints[account_id] = fingerprint
+            self._versions[account_id] = self._versions.get(account_id, 0) + 1
+
+    def remove_account(self, account_id):
+        with self._lock:
+            self._replace_contribution(account_id, None)
+            for store in (self._summaries, self._fingerprints, self._versions):
+                store.pop(account_id, None)
+            self._incomplete.discard(account_id)
+
+    def retain(self, account_ids):
+        """移除不在 account_ids 中的账户 (账户列表变化后调用)"""
+        wanted = set(account_ids)
+        with self._lock:
+            stale = [a for a in self._contributions if a not in wanted]
+        for account_id in stale:
+            self.remove_account(account_id)
+
+    def summary(self, account_ids):
+        """当前聚合的摘要合计 (只对各账户的摘要求和, 不涉及持仓表); currency 取 account_ids 中最后一个已加载账户的币种"""
+        with self._lock:
+            summaries = [self._summaries[a] for a in account_ids if a in self._summaries]
+        aggregated = {k: sum(summary.get(k, 0) for summary in summaries) for k in SUMMARY_NUMERIC_KEYS}
+        aggregated['currency'] = summaries[-1].get('currency', 'USD') if summaries else 'USD'
+        return aggregated
+
+    def excluded_accounts(self, account_ids):
+        """account_ids 中因获取失败或数据不完整而未计入汇总的账户"""
+        with self._lock:
+            return [a for a in account_ids if a in self._incomplete]
+
+    def valuation_input(self, account_ids):
+        """供 PortfolioValuationState 使用的聚合持仓数组: {'summary', 'conids', 'position', 'costBasis', 'incomplete'}
+
+        account_ids 中有账户尚未加载、获取失败或数据不完整时 incomplete 为真, 此时的聚合净值不应被记录。
+        """
+        with self._lock:
+            totals = self._totals
+            incomplete = any(a not in self._summaries or a in self._incomplete for a in account_ids)
+        return {'summary': self.summary(account_ids), 'conids': pd.Index([str(c) for c in totals.index]),
+                'position': totals['position'].to_numpy(dtype='float64'),
+                'costBasis': totals['costBasis'].to_numpy(dtype='float64'), 'incomplete': incomplete}
+
+    def result(self, account_ids):
+        """返回聚合结果, 结构与模板使用的 {'summary', 'positions'} 一致; 明细中的账户按 account_ids 排序"""
+        with self._lock:
+            accounts = [a for a in account_ids if a in self._contributions]
+            key = (tuple((a, self._versions[a]) for a in accounts), tuple(a for a in account_ids if a in self._incomplete))
+            cached_key, cached_result = self._result_cache
+            if cached_key == key:
+                return cached_result
+            totals, descriptions = self._totals, self._descriptions
+            holdings = {a: self._contributions[a]['position'] for a in accounts if not self._contributions[a].empty}
+
+        aggregated_summary = self.summary(account_ids)
+        excluded = self.excluded_accounts(account_ids)
+        if totals.empty:
+            result = {'summary': aggregated_summary, 'positions': [], 'excluded_accounts': excluded}
+        else:
+            position = totals['position'].to_numpy()
+            cost_basis = totals['costBasis'].to_numpy()
+            with np.errstate(divide='ignore', invalid='ignore'):
+                avg_cost = np.where(position != 0, cost_basis / position, 0.0)
+            columns = {c: descriptions[c].reindex(totals.index).tolist() for c in AGGREGATE_DESCRIPTIVE_FIELDS}
+
+            # 一次透视得到 conid x 账户的持仓数量矩阵, 未持有的位置为 NaN
+            pivot = pd.concat(holdings, axis=1).reindex(totals.index)
+            holders = pivot.columns.tolist()
+            quantities = pivot.to_numpy(dtype='float64')
+            held = ~np.isnan(quantities)
+            final_positions = []
+            for i, conid in enumerate(totals.index.tolist()):
+                breakdown = {holders[j]: float(quantities[i, j]) for j in np.flatnonzero(held[i])}
+                final_positions.append(AggregatePositionRecord(
+                    conid, columns['contractDesc'][i], columns['assetClass'][i], columns['currency'][i],
+                    float(position[i]), float(avg_cost[i]), float(cost_basis[i]), breakdown))
+            result = {'summary': aggregated_summary, 'positions': final_positions, 'excluded_accounts': excluded}
+
+        with self._lock:
+            self._result_cache = (key, result)
+        return result
+
+
+portfolio_aggregator = PortfolioAggregator()
 
-    summary_data = {
-        key: float(summary_raw.get(val, {}).get('amount', 0)) 
-        for key, val in [
-            ('net_liquidation', 'netliquidation'), 
-            ('realized_pnl', 'realizedpnl'), 
-            ('cash', 'cashbalance'), 
-            ('buying_power', 'buyingpower')
-        ]
-    }
-    summary_data['currency'] = summary_raw.get('netliquidation', {}).get('currency', 'USD')
-    
-    print(f"<-- 完成获取账户 {acc_id} 的数据。")
-    return acc_id, {'summary': summary_data, 'positions': processed_positions, 'performance': performance_data}
 
 def aggregate_portfolio_data(all_data):
     """汇总所有账户的数据"""
-    aggregated_summary = {'net_liquidation': 0, 'realized_pnl': 0, 'cash': 0, 'buying_power': 0, 'currency': 'USD'}
-    aggregated_positions = {}
-    if not all_data: return {'summary': aggregated_summary, 'positions': []}
-
+    portfolio_aggregator.retain(list(all_data))
     for account_id, data in all_data.items():
-        if not data or not data.get('summary'): continue
-        for key in ['net_liquidation', 'realized_pnl', 'cash', 'buying_power']:
-            aggregated_summary[key] += data['summary'].get(key, 0)
-        aggregated_summary['currency'] = data['summary'].get('currency', 'USD')
-
-        for pos in data.get('positions', []):
-            conid, position_size, cost_basis = pos['conid'], float(pos.get('position', 0)), float(pos.get('costBasis', 0))
-            if conid not in aggregated_positions:
-                aggregated_positions[conid] = pos.copy()
-                aggregated_positions[conid]['total_position'] = 0
-                aggregated_positions[conid]['total_costBasis'] = 0
-                aggregated_positions[conid]['holdings_breakdown'] = {}
-            
-            aggregated_positions[conid]['total_position'] += position_size
-            aggregated_positions[conid]['total_costBasis'] += cost_basis
-            aggregated_positions[conid]['holdings_breakdown'][account_id] = position_size
-
-    final_positions = []
-    for conid, pos in aggregated_positions.items():
-        total_pos, total_cb = pos['total_position'], pos['total_costBasis']
-        pos['position'], pos['costBasis'] = total_pos, total_cb
-        pos['avgCost'] = total_cb / total_pos if total_pos != 0 else 0
-        final_positions.append(pos)
-        
-    return {'summary': aggregated_summary, 'positions': final_positions}
+        portfolio_aggregator.update_account(account_id, data)
+    return portfolio_aggregator.result(list(all_data))
+
+# --- 片段渲染缓存 ---
+
+class FragmentCache:
+    """进程内的 LRU 渲染缓存: 键为内容哈希, 内容不变时直接复用已渲染的 HTML"""
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+
+    def get_or_render(self, key, render):
+        with self._lock:
+            html = self._entries.get(key)
+            if html is not None:
+                self._entries.move_to_end(key)
+        metrics.inc('ibkr_cache_requests_total', cache='fragment', result='miss' if html is None else 'hit')
+        if html is not None:
+            return html
+        html = render()
+        with self._lock:
+            self._entries[key] = html
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                metrics.inc('ibkr_cache_evictions_total', cache='fragment', reason='size')
+        return html
+
+
+fragment_cache = FragmentCache(FRAGMENT_CACHE_MAX_ENTRIES)
+
+
+def content_hash(value):
+    """对可 repr 的嵌套元组/列表求稳定的短哈希, 用作渲染缓存的键"""
+    return hashlib.blake2b(repr(value).encode('utf-8'), digest_size=16).hexdigest()
+
+
+def account_fragment_key(account_id, data):
+    """账户片段的内容哈希: 摘要、持仓和完整性标记都不变时, 渲染出的 HTML 也不变"""
+    if not data:
+        return content_hash((account_id, None))
+    positions = [(p.conid, p.contractDesc, p.assetClass, p.currency, p.position, p.avgCost, p.costBasis)
+                 for p in data.get('positions', [])]
+    return content_hash((account_id, sorted(data.get('summary', {}).items()), bool(data.get('incomplete')), positions))
+
+
+def aggregate_fragment_key(account_ids, account_keys):
+    """最终聚合片段的键: 由完整的账户列表及每个账户的片段键决定, 与账户的到达顺序无关
+
+    只在所有账户都到达后使用; 账户集合或任一账户的内容不变时, 每次加载得到相同的键。
+    """
+    return content_hash((tuple(account_ids), tuple(account_keys[a] for a in account_ids)))
 
 # --- Flask 路由 ---
+@app.before_request
+def start_request_timer():
+    flask_g.request_start = time.perf_counter()
+    metrics.inc('ibkr_http_requests_in_flight')
+
+def observe_request(start, route, method, status):
+    metrics.observe('ibkr_http_request_duration_seconds', time.perf_counter() - start, route=route, method=method, status=status)
+    metrics.inc('ibkr_http_requests_in_flight', -1)
+
+@app.after_request
+def schedule_request_observation(response):
+    """路由耗时在响应关闭时记录, 流式响应 (NDJSON/SSE) 因此包含整个推送过程"""
+    start = flask_g.pop('request_start', None)
+    if start is not None:
+        route = flask_request.url_rule.rule if flask_request.url_rule else 'unmatched'
+        method, status = flask_request.method, response.status_code
+        response.call_on_close(lambda: observe_request(start, route, method, status))
+    return response
+
+@app.teardown_request
+def observe_failed_request(exc):
+    """未经过 after_request 的请求 (处理中抛出异常) 在这里按 500 记录"""
+    start = flask_g.pop('request_start', None)
+    if start is not None:
+        route = flask_request.url_rule.rule if flask_request.url_rule else 'unmatched'
+        observe_request(start, route, flask_request.method, 500)
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Prometheus 文本格式的指标导出"""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
 @app.route('/favicon.ico')
 def favicon():
     return Response(status=204)
 
 @app.route('/')
 def home():
-    """主页，使用并发加载所有账户数据并展示"""
-    print("\n--- 正在并行加载所有账户数据... ---")
-    start_time = time.time()
-    
-    account_ids = get_all_account_ids()
+    """主页: 立即返回页面框架, 各账户数据由 /api/dashboard/stream 逐个推送"""
+    account_ids = get_cached_account_ids()
     if not account_ids:
-        print(">>> 警告: 未能获取到任何账户ID。可能需要重新认证。")
+        log_event('no_accounts', '未能获取到任何账户ID, 可能需要重新认证', level='warning')
         return render_template('login.html', error="获取账户信息失败，请在弹窗中重新登录。")
+    # 页面框架只取决于账户列表: 复用已渲染的结果, 浏览器刷新或多个屏幕打开时按 ETag 返回 304
+    html = fragment_cache.get_or_render(('index', tuple(account_ids)),
+                                        lambda: render_template('index.html', account_ids=account_ids))
+    return cacheable_response(html.encode('utf-8'), 'text/html')
 
-    all_data = {}
-    historical_data = {}
+def render_fragment(macro_name, *args):
+    """渲染 _dashboard_fragments.html 中的单个宏, 返回 HTML 字符串"""
+    return str(get_template_attribute('_dashboard_fragments.html', macro_name)(*args))
+
+@app.route('/api/dashboard/stream')
+def dashboard_stream():
+    """以 NDJSON 流的形式并发加载所有账户数据: 每完成一个账户即推送其片段及聚合摘要, 全部到达后推送一次聚合持仓表"""
+    account_ids = get_cached_account_ids()
+    if not account_ids:
+        return jsonify({'error': '获取账户信息失败'}), 503
+
+    def generate():
+        log_event('dashboard_load_start', '正在并行加载所有账户数据', accounts=len(account_ids))
+        start_time = time.time()
+        all_data = {}
+        fragment_keys = {}  # 已到达的账户 -> 其片段的内容哈希
+        portfolio_aggregator.retain(account_ids)
+
+        # 所有账户的历史表现合并为批量请求, 与各账户的摘要/持仓并行获取, 完成后通知前端可以读取
+        performance_future = gateway_scheduler.submit(PRIORITY_PERFORMANCE, refresh_performance_batch, account_ids)
+        future_to_account = {fetch_account_data_async(acc_id, False): acc_id for acc_id in account_ids}
+        pending = set(future_to_account) | {performance_future}
+        for future in concurrent.futures.as_completed(pending):
+            if future is performance_future:
+                try:
+                    performance = future.result()
+                except Exception as exc:
+                    log_event('performance_batch_failed', '批量获取历史表现数据时产生异常', level='error', error=str(exc))
+                    performance = {}
+                # 历史数据本身不随数据流下发, 前端在选中账户时再通过 /api/history 获取; missing 为没有历史数据的账户
+                missing = [acc_id for acc_id in account_ids if acc_id not in performance]
+                yield json.dumps({'type': 'performance', 'accounts': list(performance), 'missing': missing}) + '\n'
+                continue
 
-    max_workers = min(len(account_ids), 10)
-    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
-        future_to_account = {executor.submit(fetch_all_data_for_account, acc_id): acc_id for acc_id in account_ids}
-        for future in concurrent.futures.as_completed(future_to_account):
             acc_id = future_to_account[future]
             try:
                 _, data = future.result()
-                historical_data[acc_id] = data.pop('performance', None)
-                all_data[acc_id] = data
+                data.pop('performance', None)
             except Exception as exc:
-                print(f"!!! 获取账户 {acc_id} 数据时产生异常: {exc}")
-                all_data[acc_id] = None
-                historical_data[acc_id] = None
-    
-    aggregated_data = aggregate_portfolio_data(all_data)
-    
-    end_time = time.time()
-    print(f"--- ✅ 所有数据加载完毕，总耗时: {end_time - start_time:.2f} 秒 ---")
-    
-    historical_data_json = json.dumps(historical_data)
-    return render_template('index.html', 
-                           all_data=all_data, 
-                           aggregated_data=aggregated_data,
-                           historical_data_json=historical_data_json)
+                log_event('account_fetch_failed', '获取账户数据时产生异常', level='error', account=acc_id, error=str(exc))
+                data = None
+            all_data[acc_id] = data
+
+            # 累计表只减去该账户旧的贡献、加上新的贡献; 聚合持仓表只在最后一个账户到达后生成一次
+            portfolio_aggregator.update_account(acc_id, data)
+            portfolio_state.update_account(acc_id, data)
+            portfolio_state.update_aggregate('all', portfolio_aggregator.valuation_input(account_ids))
+            if data:
+                price_snapshots.warm(p.conid for p in data['positions'] if p.conid is not None)
+
+            # 片段按内容哈希缓存: 摘要和持仓未变化的账户 (以及由它们组成的聚合视图) 直接复用上次渲染的 HTML
+            account_key = fragment_keys[acc_id] = account_fragment_key(acc_id, data)
+            # 聚合摘要只是几个合计数, 每个账户到达时都重新渲染推送 (体积很小, 不缓存)
+            aggregate_summary = {'summary': portfolio_aggregator.summary(account_ids),
+                                 'excluded_accounts': portfolio_aggregator.excluded_accounts(account_ids)}
+            yield json.dumps({
+                'type': 'account',
+                'account_id': acc_id,
+                'summary_html': fragment_cache.get_or_render(('account_summary', account_key),
+                                                             lambda: render_fragment('account_summary', acc_id, data)),
+                'table_html': fragment_cache.get_or_render(('account_table', account_key),
+                                                           lambda: render_fragment('account_table', acc_id, data)),
+                'aggregate_summary_html': render_fragment('aggregate_summary', aggregate_summary),
+            }) + '\n'
+
+            if len(all_data) == len(account_ids):
+                aggregated_data = portfolio_aggregator.result(account_ids)
+                aggregate_key = aggregate_fragment_key(account_ids, fragment_keys)
+                yield json.dumps({
+                    'type': 'aggregate',
+                    'summary_html': fragment_cache.get_or_render(('aggregate_summary', aggregate_key),
+                                                                 lambda: render_fragment('aggregate_summary', aggregated_data)),
+                    'table_html': fragment_cache.get_or_render(('aggregate_table', aggregate_key),
+                                                               lambda: render_fragment('aggregate_table', aggregated_data)),
+                }) + '\n'
+
+        elapsed = time.time() - start_time
+        metrics.observe('ibkr_dashboard_load_seconds', elapsed)
+        log_event('dashboard_load_done', '所有数据加载完毕', accounts=len(all_data), elapsed_seconds=round(elapsed, 3))
+        for name, entry in sorted(gateway.stats().items()):
+            log_event('gateway_stats', '网关接口累计调用统计', endpoint=name, calls=entry['calls'],
+                      avg_ms=round(entry['avg_seconds'] * 1000), max_ms=round(entry['max_seconds'] * 1000),
+                      errors=entry['errors'], throttled=entry['throttled'], retried=entry['retried'])
+        log_event('snapshot_stats', '价格快照预热统计', **price_snapshots.stats())
+        yield json.dumps({'type': 'done', 'elapsed': elapsed}) + '\n'
+
+    headers = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson', headers=headers)
+
+def cacheable_response(body, mimetype='application/json'):
+    """以内容哈希作为 ETag 返回已序列化的响应体: 客户端持有相同版本时返回 304, 支持 gzip 且响应体较大时压缩"""
+    use_gzip = len(body) >= RESPONSE_GZIP_MIN_BYTES and flask_request.accept_encodings['gzip'] > 0
+    # 压缩与未压缩的表示使用不同的 ETag, 避免中间缓存混用
+    etag = hashlib.sha1(body).hexdigest()[:20] + ('-gz' if use_gzip else '')
+    headers = {'Cache-Control': 'private, no-cache', 'Vary': 'Accept-Encoding'}
+    if flask_request.if_none_match.contains_weak(etag):
+        response = Response(status=304, headers=headers)
+    else:
+        if use_gzip:
+            body = gzip.compress(body, compresslevel=6)
+            headers['Content-Encoding'] = 'gzip'
+        response = Response(body, mimetype=mimetype, headers=headers)
+    response.set_etag(etag)
+    return response
+
+@app.route('/api/history/<account_id>')
+def api_history(account_id):
+    """单个账户的每日 TWR 历史, 列式返回 {dates: [...], twr: [...], stats: {...}}; ?points=N 时降采样到不超过 N 个点
+
+    只读取共享缓存与存储, 不请求网关; 数据由仪表盘数据流的批量刷新写入。
+    """
+    try:
+        max_points = max(0, int(flask_request.args.get('points', 0)))
+    except ValueError:
+        return jsonify({'error': 'points 参数必须是整数'}), 400
+    try:
+        result = load_cached_performance(account_id)
+    except sqlite3.Error as e:
+        log_event('performance_failed', '读取历史表现数据时出错', level='error', account=account_id, error=str(e))
+        return jsonify({'error': '读取历史表现数据失败'}), 503
+    if not result:
+        return jsonify({'error': '没有该账户的历史表现数据'}), 404
+    dates, twr = downsample_returns(result['history']['dates'], result['history']['twr'], max_points)
+    body = json.dumps({'account_id': account_id, 'dates': dates, 'twr': twr, 'stats': result['stats']},
+                      separators=(',', ':')).encode('utf-8')
+    return cacheable_response(body)
 
 @app.route('/api/prices')
 def api_prices():
-    """提供给前端的API，用于动态获取价格"""
+    """提供给前端的API: 获取价格并返回服务端计算好的每行及各账户估值"""
     conids_str = flask_request.args.get('conids', '')
     if not conids_str: return jsonify({})
         
     conids = conids_str.split(',')
-    raw_price_data = get_price_snapshots(conids)
+    raw_price_data = price_cache.get(conids)
     
     price_dict = {}
     for conid in conids:
         data = raw_price_data.get(conid)
         if data:
-            price = data.get('31', 'N/A')
-            is_closing_price = isinstance(price, str) and price.startswith('C')
-            price_dict[conid] = {'price': price[1:] if is_closing_price else price, 'change': data.get('83', 'N/A')}
-    return jsonify(price_dict)
+            price_dict[conid] = format_price_snapshot(data)
+    portfolio_state.apply_prices(price_dict)
+    valuation = portfolio_state.valuate(conids)
+    net_liq_history.record(valuation['accounts'])
+    return jsonify(valuation)
+
+@app.route('/api/netliq/<account_id>')
+def api_net_liq(account_id):
+    """账户的日内净清算价值序列, 列式返回 {t: [...], v: [...]}; ?resolution=tick|1m|5m, 默认 1m"""
+    resolution = flask_request.args.get('resolution', '1m')
+    series = net_liq_history.series(account_id, resolution)
+    if series is None:
+        return jsonify({'error': f'不支持的分辨率, 可选: {", ".join(NET_LIQ_RESOLUTIONS)}'}), 400
+    body = json.dumps({'account_id': account_id, 'resolution': resolution, **series}, separators=(',', ':')).encode('utf-8')
+    return cacheable_response(body)
+
+@app.route('/api/prices/stream')
+def api_prices_stream():
+    """SSE 估值推送: 首条消息为当前已知估值, 之后只推送订阅 conid 中价格发生变化的部分"""
+    conids = [c for c in flask_request.args.get('conids', '').split(',') if c]
+    if not conids: return Response(status=204)
+
+    def event_stream():
+        subscriber = price_stream_hub.subscribe(conids)
+        try:
+            while True:
+                try:
+                    delta = subscriber.get(timeout=PRICE_STREAM_HEARTBEAT_SECONDS)
+                    yield f"data: {json.dumps(delta)}\n\n"
+                except queue.Empty:
+                    yield ": keepalive\n\n"
+        finally:
+            price_stream_hub.unsubscribe(subscriber)
+
+    headers = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    return Response(event_stream(), mimetype='text/event-stream', headers=headers)
 
 @app.route('/login')
 def login_page():
@@ -342,17 +2377,23 @@ def login_page():
 
 @app.route('/api/check_auth')
 def check_auth_status():
-    """提供给前端的API，用于轮询认证状态"""
-    return jsonify({'status': 'success' if is_gateway_running() else 'pending'})
+    """提供给前端的API，用于轮询认证状态 (读取健康检查缓存的状态, 不直接请求网关)"""
+    status = gateway_health.status(watch=True)
+    return jsonify({'status': 'success' if status['connected'] else 'pending', **status})
 
 # --- 主程序入口 ---
 if __name__ == '__main__':
     print("="*40 + "\n" + " 启动 IBKR 实时报告应用 ".center(40, "=") + "\n" + "="*40)
     
-    if not is_gateway_running():
-        start_gateway()
-        print(">>> 等待网关初始化 (约10-15秒)...")
-        time.sleep(15)
+    # 网关未响应时才启动它, 然后等到它真正可以访问为止 (而不是固定等待), 登录由用户在登录页完成
+    if not gateway_health.status()['reachable'] and start_gateway():
+        log_event('gateway_wait', '等待网关初始化', timeout_seconds=GATEWAY_STARTUP_TIMEOUT_SECONDS)
+        wait_start = time.monotonic()
+        status = gateway_health.wait_until(lambda s: s['reachable'], GATEWAY_STARTUP_TIMEOUT_SECONDS)
+        if status['reachable']:
+            log_event('gateway_ready', '网关已可以访问', elapsed_seconds=round(time.monotonic() - wait_start, 1))
+        else:
+            log_event('gateway_wait_timeout', '等待网关超时, 仍继续启动 Web 服务器', level='warning')
 
     print("\n>>> ✅ Flask Web 服务器已成功启动。")
     print(">>> ➡️  请在浏览器中手动访问以下地址:")
@@ -362,4 +2403,4 @@ if __name__ == '__main__':
     try:
         app.run(host='0.0.0.0', port=8000, debug=False)
     except OSError as e:
-        print(f"!!! 启动 Web 服务器失败: {e}\n!!! 端口 8000 可能已被占用。")
\ No newline at end of file
+        log_event('server_start_failed', '启动 Web 服务器失败, 端口 8000 可能已被占用', level='error', error=str(e))
\ No newline at end of file
@@ -0,0 +1,208 @@
+import argparse
+import collections
+import os
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+from bar_store import BarStore, DEFAULT_ROOT
+
+# 基于 1 分钟 K 线的向量化重采样与指标计算: 按美东常规交易时段 (RTH 09:30-16:00) 对齐,
+# 同一分桶的 OHLCV 用 np.*.reduceat 一次性聚合, 不逐行循环。
+
+MARKET_TIMEZONE = 'US/Eastern'
+RTH_OPEN_MINUTE = 9 * 60 + 30
+RTH_MINUTES = 390
+NS_PER_MINUTE = 60 * 1_000_000_000
+NS_PER_DAY = 24 * 60 * NS_PER_MINUTE
+TRADING_DAYS_PER_YEAR = 252
+
+# 支持的目标周期 -> 每个分桶包含的交易分钟数; 日线 (1d) 按交易日整体聚合
+TIMEFRAME_MINUTES = {
+    '1min': 1,
+    '5min': 5,
+    '15min': 15,
+    '30min': 30,
+    '1h': 60,
+    '1d': RTH_MINUTES,
+}
+
+RESULT_CACHE_SIZE = 64
+
+
+def session_buckets(ts_ns, bucket_minutes):
+    """计算每根 1 分钟 K 线所属的交易日与分桶编号
+
+    返回 (rth_mask, session_day, bucket): session_day 为美东本地日期距 1970-01-01 的天数,
+    bucket 为该分钟距开盘的分钟数整除 bucket_minutes; 非常规时段的 K 线由 rth_mask 过滤。
+    """
+    local_ns = pd.DatetimeIndex(ts_ns.view('datetime64[ns]')).tz_localize('UTC').tz_convert(MARKET_TIMEZONE).tz_localize(None).asi8
+    session_day = local_ns // NS_PER_DAY
+    minute_of_session = (local_ns - session_day * NS_PER_DAY) // NS_PER_MINUTE - RTH_OPEN_MINUTE
+    rth_mask = (minute_of_session >= 0) & (minute_of_session < RTH_MINUTES)
+    return rth_mask, session_day, minute_of_session // bucket_minutes
+
+
+def resample_arrays(arrays, timeframe):
+    """将 BarStore.read_arrays 的 1 分钟数据重采样为 timeframe 周期的 OHLCV DataFrame
+
+    日内周期以分桶内第一根 K 线的时间 (UTC) 为索引, 日线以交易日日期为索引。
+    输入需按时间升序 (BarStore 的读取结果即满足)。
+    """
+    bucket_minutes = TIMEFRAME_MINUTES[timeframe]
+    ts = np.asarray(arrays['ts'])
+    rth_mask, session_day, bucket = session_buckets(ts, bucket_minutes)
+    ts, session_day, bucket = ts[rth_mask], session_day[rth_mask], bucket[rth_mask]
+    columns = {name: np.asarray(arrays[name])[rth_mask] for name in ('open', 'high', 'low', 'close', 'volume') if name in arrays}
+    if not len(ts):
+        return pd.DataFrame(columns=list(columns) + ['bars'])
+
+    key = session_day * (RTH_MINUTES // bucket_minutes + 1) + bucket
+    starts = np.flatnonzero(np.r_[True, key[1:] != key[:-1]])
+    ends = np.r_[starts[1:], len(key)] - 1
+
+    result = {}
+    if 'open' in columns: result['open'] = columns['open'][starts]
+    if 'high' in columns: result['high'] = np.maximum.reduceat(columns['high'], starts)
+    if 'low' in columns: result['low'] = np.minimum.reduceat(columns['low'], starts)
+    if 'close' in columns: result['close'] = columns['close'][ends]
+    if 'volume' in columns: result['volume'] = np.add.reduceat(columns['volume'], starts)
+    result['bars'] = np.diff(np.r_[starts, len(key)])
+
+    if timeframe == '1d':
+        index = pd.DatetimeIndex((session_day[starts] * NS_PER_DAY).view('datetime64[ns]'), name='date')
+    else:
+        index = pd.DatetimeIndex(ts[starts].view('datetime64[ns]'), name='date').tz_localize('UTC')
+    return pd.DataFrame(result, index=index)
+
+
+# --- 指标 ---
+
+def rolling_mean(values, window):
+    """基于累加和的滑动均值, 前 window-1 个位置为 nan"""
+    values = np.asarray(values, dtype=float)
+    out = np.full(len(values), np.nan)
+    if len(values) >= window:
+        csum = np.cumsum(np.r_[0.0, values])
+        out[window - 1:] = (csum[window:] - csum[:-window]) / window
+    return out
+
+
+def compute_indicators(bars, sma_windows=(20, 50), ema_spans=(12, 26), volatility_window=20, rsi_window=14, atr_window=14):
+    """在重采样后的 K 线上计算常用指标, 返回与 bars 同索引的 DataFrame
+
+    包含: 简单/对数收益率、SMA、EMA、MACD、年化滚动波动率、RSI (Wilder 平滑)、ATR、布林带,
+    日内周期另有按交易日重置的 VWAP。全部为整列向量化计算。
+    """
+    close = bars['close'].to_numpy(dtype=float)
+    out = pd.DataFrame(index=bars.index)
+    prev_close = np.r_[np.nan, close[:-1]]
+    out['return'] = close / prev_close - 1
+    log_return = np.log(close / prev_close)
+    out['log_return'] = log_return
+
+    for window in sma_windows:
+        out[f'sma_{window}'] = rolling_mean(close, window)
+    close_series = pd.Series(close, index=bars.index)
+    for span in ema_spans:
+        out[f'ema_{span}'] = close_series.ewm(span=span, adjust=False).mean().to_numpy()
+    if len(ema_spans) >= 2:
+        fast, slow = ema_spans[0], ema_spans[1]
+        out['macd'] = out[f'ema_{fast}'] - out[f'ema_{slow}']
+        out['macd_signal'] = out['macd'].ewm(span=9, adjust=False).mean()
+
+    # 波动率按每年的分桶数年化: 日线 252, 日内周期再乘以每个交易日的分桶数
+    minutes_per_bar = np.nanmedian(bars['bars']) if 'bars' in bars.columns and len(bars) else RTH_MINUTES
+    periods_per_year = TRADING_DAYS_PER_YEAR * max(1.0, RTH_MINUTES / minutes_per_bar)
+    log_return_series = pd.Series(log_return, index=bars.index)
+    out['volatility'] = log_return_series.rolling(volatility_window).std().to_numpy() * np.sqrt(periods_per_year)
+
+    change = np.diff(close, prepend=np.nan)
+    gain = pd.Series(np.where(change > 0, change, 0.0), index=bars.index)
+    loss = pd.Series(np.where(change < 0, -change, 0.0), index=bars.index)
+    avg_gain = gain.ewm(alpha=1 / rsi_window, adjust=False, min_periods=rsi_window).mean()
+    avg_loss = loss.ewm(alpha=1 / rsi_window, adjust=False, min_periods=rsi_window).mean()
+    out['rsi'] = 100 - 100 / (1 + avg_gain / avg_loss)
+
+    if {'high', 'low'} <= set(bars.columns):
+        high, low = bars['high'].to_numpy(dtype=float), bars['low'].to_numpy(dtype=float)
+        true_range = np.fmax(high - low, np.fmax(np.abs(high - prev_close), np.abs(low - prev_close)))
+        out['atr'] = pd.Series(true_range, index=bars.index).ewm(alpha=1 / atr_window, adjust=False, min_periods=atr_window).mean()
+
+    middle = rolling_mean(close, volatility_window)
+    std = close_series.rolling(volatility_window).std(ddof=0).to_numpy()
+    out['bb_middle'] = middle
+    out['bb_upper'] = middle + 2 * std
+    out['bb_lower'] = middle - 2 * std
+
+    if 'volume' in bars.columns and isinstance(bars.index, pd.DatetimeIndex) and bars.index.tz is not None:
+        typical = (bars['high'] + bars['low'] + bars['close']).to_numpy(dtype=float) / 3 if {'high', 'low'} <= set(bars.columns) else close
+        volume = bars['volume'].to_numpy(dtype=float)
+        session = bars.index.tz_convert(MARKET_TIMEZONE).normalize()
+        grouped = pd.DataFrame({'pv': typical * volume, 'v': volume}).groupby(np.asarray(session.asi8))
+        out['vwap'] = (grouped['pv'].cumsum() / grouped['v'].cumsum()).to_numpy()
+    return out
+
+
+class BarAnalytics:
+    """在 BarStore 之上提供带缓存的重采样与指标查询
+
+    缓存键包含所涉及分区文件的修改时间, 存储中数据更新后旧结果自动失效; 重复查询直接返回缓存的结果。
+    """
+
+    def __init__(self, store=None, cache_size=RESULT_CACHE_SIZE):
+        self.store = store or BarStore(DEFAULT_ROOT)
+        self.cache_size = cache_size
+        self._cache = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _data_version(self, symbol):
+        directory = os.path.join(self.store.root, symbol)
+        return tuple((month, os.path.getmtime(os.path.join(directory, month))) for month in self.store.partitions(symbol))
+
+    def _cached(self, key, compute):
+        with self._lock:
+            if key in self._cache:
+                self.hits += 1
+                self._cache.move_to_end(key)
+                return self._cache[key]
+            self.misses += 1
+        value = compute()
+        with self._lock:
+            self._cache[key] = value
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return value
+
+    def resample(self, symbol, timeframe, start, end):
+        key = ('bars', symbol, timeframe, str(start), str(end), self._data_version(symbol))
+        return self._cached(key, lambda: resample_arrays(self.store.read_arrays(symbol, start, end), timeframe))
+
+    def indicators(self, symbol, timeframe, start, end, **params):
+        key = ('indicators', symbol, timeframe, str(start), str(end), tuple(sorted(params.items())), self._data_version(symbol))
+        return self._cached(key, lambda: compute_indicators(self.resample(symbol, timeframe, start, end), **params))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='从列式存储读取 1 分钟 K 线, 重采样并计算指标')
+    parser.add_argument('symbol')
+    parser.add_argument('--timeframe', default='1d', choices=list(TIMEFRAME_MINUTES))
+    parser.add_argument('--start', default='1970-01-01')
+    parser.add_argument('--end', default=pd.Timestamp.now(tz='UTC').strftime('%Y-%m-%d %H:%M'))
+    parser.add_argument('--root', default=DEFAULT_ROOT)
+    args = parser.parse_args()
+
+    analytics = BarAnalytics(BarStore(args.root))
+    start_time = time.perf_counter()
+    bars = analytics.resample(args.symbol, args.timeframe, args.start, args.end)
+    indicators = analytics.indicators(args.symbol, args.timeframe, args.start, args.end)
+    print(bars.join(indicators).tail(10))
+    print(f"{len(bars)} 根 {args.timeframe} K 线, 耗时 {(time.perf_counter() - start_time) * 1000:.1f} ms")
+
+
+if __name__ == '__main__':
+    main()
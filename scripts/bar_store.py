@@ -0,0 +1,205 @@
+import argparse
+import os
+import shutil
+import time
+
+import numpy as np
+import pandas as pd
+
+# 按 品种/月份 分区的列式 K 线存储 (每种 K 线周期一个根目录):
+#   <root>/<SYMBOL>/<YYYY-MM>/ts.npy      UTC 纳秒时间戳 (int64, 升序且唯一)
+#   <root>/<SYMBOL>/<YYYY-MM>/<列名>.npy  与 ts 等长的数值列 (open/high/low/close/volume/...)
+# 读取时只以内存映射方式打开日期范围覆盖的分区, 单个分区内的切片不产生拷贝。
+
+STORE_BASE_DIR = os.path.join('data', 'bar_store')
+TIMESTAMP_FILE = 'ts.npy'
+OHLCV_COLUMNS = ('open', 'high', 'low', 'close', 'volume')
+
+
+def store_root(bar_size='1 min', base=STORE_BASE_DIR):
+    """每种 K 线周期使用独立的存储根目录, 如 data/bar_store/1_min"""
+    return os.path.join(base, bar_size.replace(' ', '_'))
+
+
+DEFAULT_ROOT = store_root()
+
+
+def to_utc_timestamp(value):
+    """将字符串/日期/时间戳统一转换为 UTC 的 pd.Timestamp; 不带时区的按 UTC 处理"""
+    ts = pd.Timestamp(value)
+    return ts.tz_localize('UTC') if ts.tzinfo is None else ts.tz_convert('UTC')
+
+
+def month_range(start, end):
+    """返回覆盖 [start, end) 的 'YYYY-MM' 分区名列表"""
+    if end <= start:
+        return []
+    months = pd.period_range(start.tz_localize(None).to_period('M'), (end - pd.Timedelta(1)).tz_localize(None).to_period('M'), freq='M')
+    return [str(p) for p in months]
+
+
+class BarStore:
+    """按品种和月份分区的 NumPy 列式 K 线存储, 提供增量写入和基于内存映射的日期范围读取"""
+
+    def __init__(self, root=DEFAULT_ROOT):
+        self.root = root
+
+    def symbols(self):
+        if not os.path.isdir(self.root):
+            return []
+        return sorted(name for name in os.listdir(self.root) if os.path.isdir(os.path.join(self.root, name)))
+
+    def partitions(self, symbol):
+        directory = os.path.join(self.root, symbol)
+        if not os.path.isdir(directory):
+            return []
+        return sorted(name for name in os.listdir(directory)
+                      if len(name) == 7 and os.path.exists(os.path.join(directory, name, TIMESTAMP_FILE)))
+
+    def _load_partition(self, symbol, month, columns=None):
+        """以只读内存映射打开一个分区, 返回 (ts, {列名: 数组})"""
+        directory = os.path.join(self.root, symbol, month)
+        ts = np.load(os.path.join(directory, TIMESTAMP_FILE), mmap_mode='r')
+        if columns is None:
+            columns = sorted(name[:-4] for name in os.listdir(directory) if name.endswith('.npy') and name != TIMESTAMP_FILE)
+        data = {}
+        for column in columns:
+            path = os.path.join(directory, f'{column}.npy')
+            if os.path.exists(path):
+                data[column] = np.load(path, mmap_mode='r')
+        return ts, data
+
+    # --- 写入 ---
+
+    def write(self, symbol, df):
+        """把以时间为索引的 K 线 DataFrame 写入对应的月份分区
+
+        与分区内已有数据按时间戳合并去重 (新数据优先), 每个分区整体写入临时目录后再替换,
+        读取方不会看到写了一半的分区。返回写入的行数。
+        """
+        if df is None or df.empty:
+            return 0
+        df = df.copy()
+        df.index = pd.to_datetime(df.index, utc=True)
+        df = df.select_dtypes(include=[np.number])
+        months = df.index.tz_localize(None).to_period('M').astype(str)
+        for month, part in df.groupby(months, sort=True):
+            self._write_partition(symbol, month, part)
+        return len(df)
+
+    def _write_partition(self, symbol, month, part):
+        ts = part.index.as_unit('ns').asi8
+        columns = {name: part[name].to_numpy() for name in part.columns}
+        if month in self.partitions(symbol):
+            old_ts, old_columns = self._load_partition(symbol, month)
+            keep = ~np.isin(old_ts, ts)
+            ts = np.concatenate([np.asarray(old_ts)[keep], ts])
+            for name in set(old_columns) | set(columns):
+                old = np.asarray(old_columns[name])[keep] if name in old_columns else np.full(keep.sum(), np.nan)
+                new = columns[name] if name in columns else np.full(len(part), np.nan)
+                columns[name] = np.concatenate([old, new])
+        order = np.argsort(ts, kind='stable')
+
+        directory = os.path.join(self.root, symbol, month)
+        tmp_dir = f'{directory}.{os.getpid()}.tmp'
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+        np.save(os.path.join(tmp_dir, TIMESTAMP_FILE), ts[order])
+        for name, values in columns.items():
+            np.save(os.path.join(tmp_dir, f'{name}.npy'), values[order])
+        old_dir = f'{directory}.{os.getpid()}.old'
+        if os.path.exists(directory):
+            os.replace(directory, old_dir)
+        os.replace(tmp_dir, directory)
+        shutil.rmtree(old_dir, ignore_errors=True)
+
+    def ingest_csv(self, symbol, path, chunksize=200_000):
+        """分块读取抓取脚本输出的 CSV (首列为 date) 并写入分区, 不一次性载入整个文件"""
+        rows = 0
+        for chunk in pd.read_csv(path, index_col=0, chunksize=chunksize):
+            rows += self.write(symbol, chunk)
+        return rows
+
+    # --- 读取 ---
+
+    def read_arrays(self, symbol, start, end, columns=OHLCV_COLUMNS):
+        """读取 [start, end) 内的 K 线, 返回 {'ts': int64 纳秒数组, 列名: 数组}
+
+        只打开日期范围覆盖的月份分区; 范围落在单个分区内时返回的是内存映射上的切片 (零拷贝),
+        跨多个分区时各分区切片拼接为一份新数组。
+        """
+        start, end = to_utc_timestamp(start), to_utc_timestamp(end)
+        start_ns, end_ns = start.value, end.value
+        available = set(self.partitions(symbol))
+        pieces = []
+        for month in month_range(start, end):
+            if month not in available:
+                continue
+            ts, data = self._load_partition(symbol, month, columns)
+            lo, hi = np.searchsorted(ts, [start_ns, end_ns])
+            if hi > lo:
+                pieces.append((ts[lo:hi], {name: values[lo:hi] for name, values in data.items()}))
+
+        if not pieces:
+            return {'ts': np.empty(0, dtype=np.int64), **{name: np.empty(0) for name in columns or ()}}
+        if len(pieces) == 1:
+            ts, data = pieces[0]
+            return {'ts': ts, **data}
+        names = pieces[0][1].keys()
+        result = {'ts': np.concatenate([ts for ts, _ in pieces])}
+        for name in names:
+            result[name] = np.concatenate([data[name] for _, data in pieces])
+        return result
+
+    def read(self, symbol, start, end, columns=OHLCV_COLUMNS):
+        """与 read_arrays 相同, 但返回以 UTC DatetimeIndex 为索引的 DataFrame (列直接引用底层数组)"""
+        arrays = self.read_arrays(symbol, start, end, columns)
+        index = pd.DatetimeIndex(np.asarray(arrays.pop('ts')).view('datetime64[ns]'), name='date').tz_localize('UTC')
+        return pd.DataFrame(arrays, index=index, copy=False)
+
+    def bounds(self, symbol):
+        """返回该品种已存储数据的 (最早, 最晚) 时间, 无数据时返回 None"""
+        partitions = self.partitions(symbol)
+        if not partitions:
+            return None
+        first, _ = self._load_partition(symbol, partitions[0], [])
+        last, _ = self._load_partition(symbol, partitions[-1], [])
+        return pd.Timestamp(int(first[0]), tz='UTC'), pd.Timestamp(int(last[-1]), tz='UTC')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='K 线列式存储: 导入 CSV 或查看已存储的数据')
+    parser.add_argument('--root', default=DEFAULT_ROOT)
+    sub = parser.add_subparsers(dest='command', required=True)
+    ingest = sub.add_parser('ingest', help='把抓取脚本输出的 CSV 导入存储')
+    ingest.add_argument('symbol')
+    ingest.add_argument('csv_path')
+    info = sub.add_parser('info', help='列出各品种的分区数与时间范围')
+    info.add_argument('symbols', nargs='*')
+    read = sub.add_parser('read', help='读取一段时间的数据并打印耗时')
+    read.add_argument('symbol')
+    read.add_argument('start')
+    read.add_argument('end')
+    args = parser.parse_args()
+
+    store = BarStore(args.root)
+    if args.command == 'ingest':
+        start_time = time.time()
+        rows = store.ingest_csv(args.symbol, args.csv_path)
+        print(f"已导入 {rows} 条 {args.symbol} K线数据, 耗时 {time.time() - start_time:.2f} 秒。")
+    elif args.command == 'info':
+        for symbol in args.symbols or store.symbols():
+            bounds = store.bounds(symbol)
+            if bounds:
+                print(f"{symbol}: {len(store.partitions(symbol))} 个分区, {bounds[0]} ~ {bounds[1]}")
+            else:
+                print(f"{symbol}: 无数据")
+    elif args.command == 'read':
+        start_time = time.perf_counter()
+        df = store.read(args.symbol, args.start, args.end)
+        print(df)
+        print(f"读取 {len(df)} 条, 耗时 {(time.perf_counter() - start_time) * 1000:.1f} ms")
+
+
+if __name__ == '__main__':
+    main()
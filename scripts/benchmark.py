@@ -0,0 +1,147 @@
+import argparse
+import concurrent.futures
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+import requests
+from werkzeug.serving import make_server
+
+from mock_gateway import MockGateway, QuietRequestHandler, add_config_arguments, config_from_args, serve_in_background
+
+# 离线基准测试: 启动模拟网关和主程序 (均在本进程内, 走真实 HTTP), 测量
+#   1. 首页 + 仪表盘数据流的完整加载耗时 (首次为冷缓存, 之后为热缓存)
+#   2. /api/prices 在 N 个并发客户端下的吞吐量
+#   3. 以上过程中主程序向网关发出的上游请求数
+# 例: python scripts/benchmark.py --accounts 10 --positions 200 --clients 16 --duration 10
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def start_dashboard_app(gateway_url, data_dir):
+    """以指向模拟网关的配置导入 app.main 并在后台线程中启动, 返回 (模块, 基础地址); 持久化数据放在 data_dir"""
+    os.environ['IBKR_GATEWAY_URL'] = gateway_url
+    os.environ['IBKR_PERFORMANCE_DB'] = os.path.join(data_dir, 'performance.sqlite3')
+    os.environ['IBKR_SHARED_CACHE_DB'] = os.path.join(data_dir, 'shared_cache.sqlite3')
+    # 主程序的日志默认关闭, 避免与测试报告混在一起; 需要时可显式设置 IBKR_LOG_FORMAT
+    os.environ.setdefault('IBKR_LOG_FORMAT', 'off')
+    sys.path.insert(0, PROJECT_ROOT)
+    from app import main as dashboard
+    server = make_server('127.0.0.1', 0, dashboard.app, threaded=True, request_handler=QuietRequestHandler)
+    threading.Thread(target=server.serve_forever, name='dashboard-app', daemon=True).start()
+    return dashboard, f'http://127.0.0.1:{server.server_port}'
+
+
+def load_dashboard(session, app_url):
+    """请求首页并读完整个 NDJSON 数据流, 返回 (首页耗时, 完整加载耗时, 页面中出现的 conid)"""
+    start = time.perf_counter()
+    response = session.get(f'{app_url}/')
+    response.raise_for_status()
+    shell_seconds = time.perf_counter() - start
+    conids = set()
+    with session.get(f'{app_url}/api/dashboard/stream', stream=True) as stream:
+        stream.raise_for_status()
+        for line in stream.iter_lines():
+            if not line:
+                continue
+            message = json.loads(line)
+            if message.get('type') == 'account':
+                conids.update(extract_conids(message.get('table_html', '')))
+    return shell_seconds, time.perf_counter() - start, sorted(conids)
+
+
+def extract_conids(html):
+    marker = 'data-conid="'
+    conids, index = [], html.find(marker)
+    while index != -1:
+        end = html.find('"', index + len(marker))
+        conids.append(html[index + len(marker):end])
+        index = html.find(marker, end)
+    return conids
+
+
+def benchmark_prices(app_url, conids, clients, duration):
+    """N 个客户端各自循环请求 /api/prices, 返回 (总请求数, 每秒请求数, 各请求耗时数组)"""
+    query = ','.join(conids)
+    deadline = time.perf_counter() + duration
+    latencies = [[] for _ in range(clients)]
+
+    def client(index):
+        session = requests.Session()
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            response = session.get(f'{app_url}/api/prices', params={'conids': query})
+            response.raise_for_status()
+            latencies[index].append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=clients) as executor:
+        list(executor.map(client, range(clients)))
+    elapsed = time.perf_counter() - start
+    samples = np.concatenate([np.asarray(l) for l in latencies]) if any(latencies) else np.empty(0)
+    return len(samples), len(samples) / elapsed, samples
+
+
+def percentiles(samples):
+    if not len(samples):
+        return {'p50_ms': None, 'p95_ms': None, 'max_ms': None}
+    p50, p95 = np.percentile(samples, [50, 95])
+    return {'p50_ms': round(p50 * 1000, 1), 'p95_ms': round(p95 * 1000, 1), 'max_ms': round(samples.max() * 1000, 1)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='使用模拟网关对仪表盘加载与价格轮询做基准测试')
+    add_config_arguments(parser)
+    parser.add_argument('--page-loads', type=int, default=5, help='完整页面加载的次数 (第一次为冷缓存)')
+    parser.add_argument('--clients', type=int, default=8, help='/api/prices 的并发客户端数')
+    parser.add_argument('--duration', type=float, default=10.0, help='/api/prices 压测时长 (秒)')
+    parser.add_argument('--json', action='store_true', help='以 JSON 输出结果')
+    args = parser.parse_args()
+
+    gateway = MockGateway(config_from_args(args))
+    _, gateway_url = serve_in_background(gateway)
+    dashboard, app_url = start_dashboard_app(gateway_url, tempfile.mkdtemp(prefix='ibkr-benchmark-'))
+
+    report = {'config': {key: value for key, value in vars(args).items() if key != 'json'}}
+    session = requests.Session()
+
+    loads, conids = [], []
+    for i in range(args.page_loads):
+        gateway.reset_stats()
+        shell_seconds, total_seconds, conids = load_dashboard(session, app_url)
+        loads.append({'shell_ms': round(shell_seconds * 1000, 1), 'total_ms': round(total_seconds * 1000, 1),
+                      'upstream_calls': gateway.stats()['calls']})
+    report['page_loads'] = loads
+
+    gateway.reset_stats()
+    requests_done, rps, samples = benchmark_prices(app_url, conids, args.clients, args.duration)
+    upstream = gateway.stats()
+    report['prices'] = {'clients': args.clients, 'conids': len(conids), 'requests': requests_done,
+                        'requests_per_second': round(rps, 1), **percentiles(samples),
+                        'upstream_calls': upstream['calls'], 'upstream_errors': upstream['errors']}
+    report['gateway_client'] = dashboard.gateway.stats()
+
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+        return
+    print("\n=== 页面加载 (首页 + 仪表盘数据流) ===")
+    for i, load in enumerate(loads):
+        label = '冷缓存' if i == 0 else '热缓存'
+        calls = ', '.join(f'{name}={count}' for name, count in sorted(load['upstream_calls'].items()))
+        print(f"  第 {i + 1} 次 ({label}): 首页 {load['shell_ms']} ms, 完整加载 {load['total_ms']} ms | 上游: {calls}")
+    prices = report['prices']
+    print(f"\n=== /api/prices ({prices['clients']} 个并发客户端, {prices['conids']} 个 conid, {args.duration:.0f} 秒) ===")
+    print(f"  {prices['requests']} 次请求, {prices['requests_per_second']} 次/秒, "
+          f"p50 {prices['p50_ms']} ms, p95 {prices['p95_ms']} ms, 最长 {prices['max_ms']} ms")
+    calls = ', '.join(f'{name}={count}' for name, count in sorted(prices['upstream_calls'].items()))
+    print(f"  上游请求: {calls or '无'}")
+    if prices['upstream_errors']:
+        print(f"  上游注入错误: {prices['upstream_errors']}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,114 +1,384 @@
 from ib_insync import *
 import pandas as pd
 import datetime
+import asyncio
+import argparse
+import collections
+import json
+import math
+import os
 import time
 from tqdm.auto import tqdm
 import pytz # 导入 pytz
+from bar_store import BarStore, STORE_BASE_DIR, store_root
 
 # 定义时区
 us_eastern = pytz.timezone('US/Eastern')
 utc = pytz.utc # UTC 时区
 
-# 连接到 IB Gateway 或 TWS
-ib = IB()
-print("尝试连接到 IB Gateway/TWS...")
-try:
-    ib.connect('127.0.0.1', 7496, clientId=30)
-    print("成功连接到 IB Gateway/TWS。")
-except Exception as e:
-    print(f"连接失败: {e}")
-    print("请确保 IB Gateway 或 TWS 正在运行，并且 API 端口已启用。")
-    exit()
+# 每种 K 线周期单次请求的跨度 (天); 下载按此长度切分时间窗口。
+# 取自 TWS API 文档 Historical Bar Data 一节 "Valid Duration and Bar Size Settings" 表中各周期可用的最长 durationStr
+# (1 D: 1 min 起; 2 D: 2 mins 起; 1 W: 3 mins 起; 1 M: 30 mins 起; 1 Y: 1 day 起), 1 W/1 M/1 Y 分别按 7/30/365 天计。
+# 网关实际接受的跨度往往更长, 可用 --chunk-days 调大; 被拒绝的窗口会自动对半拆分重试 (见 fetch_span)。
+MAX_REQUEST_DAYS = {
+    '1 min': 1,
+    '2 mins': 2,
+    '5 mins': 7,
+    '15 mins': 7,
+    '30 mins': 30,
+    '1 hour': 30,
+    '1 day': 365,
+}
+# 请求被拒绝时对半拆分窗口重试; 跨度不超过该值的窗口不再拆分 (durationStr 以天为单位, 再拆也不会缩小请求)
+MIN_SPLIT_SPAN = datetime.timedelta(days=1)
 
-# 定义 QQQ 合约
-contract = Stock('QQQ', 'SMART', 'USD')
+# 历史数据限速规则: 全局每 10 分钟最多 60 个请求; 同一合约 2 秒内发出 6 个及以上请求即违规, 因此最多 5 个
+PACING_MAX_REQUESTS = 60
+PACING_WINDOW_SECONDS = 600
+PACING_CONTRACT_MAX_REQUESTS = 5
+PACING_CONTRACT_WINDOW_SECONDS = 2
+# 同时在途的历史数据请求数 (网关上限为 50, 保守取值)
+MAX_IN_FLIGHT_REQUESTS = 6
+# 单个窗口请求失败 (限速、超时等) 时的重试次数与初始等待
+REQUEST_RETRIES = 3
+RETRY_BACKOFF_SECONDS = 30
 
-# 定义起始日期和结束日期，并将其设置为时区感知 (UTC)
-end_date = datetime.datetime.now(utc)
-start_date = end_date - datetime.timedelta(days=5 * 365) # 往前推 5 年
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=utc)
 
-# 存储所有历史数据的列表
-all_bars = []
 
-# 定义每次请求的时间段
-duration_per_request = '1 D' # 每次请求 1 天的数据
+class PacingLimiter:
+    """滑动窗口限速器: window_seconds 内最多放行 max_requests 个请求"""
 
-current_end_date = end_date
+    def __init__(self, max_requests, window_seconds):
+        self.max_requests = max_requests
+        self.window_seconds = window_seconds
+        self._sent = collections.deque()
+        self._lock = asyncio.Lock()
 
-print(f"开始获取 QQQ 1分钟历史数据，从 {start_date.strftime('%Y-%m-%d %H:%M %Z')} 到 {end_date.strftime('%Y-%m-%d %H:%M %Z')}...")
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                while self._sent and now - self._sent[0] >= self.window_seconds:
+                    self._sent.popleft()
+                if len(self._sent) < self.max_requests:
+                    self._sent.append(now)
+                    return
+                await asyncio.sleep(self._sent[0] + self.window_seconds - now)
 
-# 估算总共需要多少次请求以设置进度条的迭代次数
-total_days = (end_date - start_date).days
-estimated_iterations = total_days + 1
 
-# 使用 tqdm 创建进度条，并使用 bar_format 自定义外观
-custom_bar_format = '{desc}: {percentage:.0f}%|{bar}| {n_fmt}/{total_fmt} [{elapsed}<{remaining}, {rate_fmt}]'
+def build_windows(start_date, end_date, chunk_days):
+    """把 [start_date, end_date) 切分为按 UTC 日期对齐的固定长度窗口
 
-with tqdm(total=estimated_iterations, desc="数据获取中", bar_format=custom_bar_format) as pbar:
-    while current_end_date > start_date:
-        if current_end_date > datetime.datetime.now(utc):
-            current_end_date = datetime.datetime.now(utc)
+    窗口边界只取决于 chunk_days, 与运行时刻无关, 因此中断后重新运行时已完成的窗口可以直接跳过。
+    返回 (对齐的窗口起点, 实际请求起点, 实际请求终点, 窗口是否已完整结束) 列表, 进度按对齐起点记录。
+    """
+    step = datetime.timedelta(days=chunk_days)
+    first = math.floor((start_date - EPOCH) / step)
+    windows = []
+    window_start = EPOCH + first * step
+    while window_start < end_date:
+        window_end = window_start + step
+        windows.append((window_start, max(window_start, start_date), min(window_end, end_date), window_end <= end_date))
+        window_start = window_end
+    return windows
 
-        pbar.set_description(f"获取数据 (截止到 {current_end_date.strftime('%Y-%m-%d %H:%M %Z')})")
 
-        try:
-            end_dt_str_for_ib = current_end_date.astimezone(us_eastern).strftime('%Y%m%d %H:%M:%S') + ' US/Eastern'
-
-            bars = ib.reqHistoricalData(
-                contract,
-                endDateTime=end_dt_str_for_ib,
-                durationStr=duration_per_request,
-                barSizeSetting='1 min',
-                whatToShow='TRADES',
-                useRTH=True,
-                formatDate=1
-            )
-
-            if not bars:
-                print(f"\n警告: 在 {current_end_date.strftime('%Y-%m-%d %H:%M %Z')} 之前没有更多数据，可能已获取到起始日期或无交易数据。")
-                current_end_date = current_end_date - datetime.timedelta(days=1)
-                pbar.update(1)
-                time.sleep(5)
-                continue
-
-            # --- 实时打印获取到的数据摘要 ---
-            if bars: # 确保 bars 列表非空
-                # pbar.write() 用于在进度条上方打印内容，避免进度条被覆盖
-                pbar.write(f"  > 获取到 {len(bars)} 条 K 线，日期范围：")
-                pbar.write(f"    - 起始：{bars[0].date.strftime('%Y-%m-%d %H:%M:%S')} O:{bars[0].open} H:{bars[0].high} L:{bars[0].low} C:{bars[0].close} V:{bars[0].volume}")
-                pbar.write(f"    - 结束：{bars[-1].date.strftime('%Y-%m-%d %H:%M:%S')} O:{bars[-1].open} H:{bars[-1].high} L:{bars[-1].low} C:{bars[-1].close} V:{bars[-1].volume}")
-            # --- 实时打印结束 ---
-
-            new_current_end_date_utc = bars[0].date.astimezone(utc)
-            all_bars = bars + all_bars
-            current_end_date = new_current_end_date_utc
-            pbar.update(1)
-            time.sleep(10)
+def format_duration(window_start, window_end):
+    """按窗口长度生成 durationStr, 向上取整到天"""
+    days = max(1, math.ceil((window_end - window_start) / datetime.timedelta(days=1)))
+    return f'{days} D' if days <= 365 else f'{math.ceil(days / 365)} Y'
+
+
+class SymbolCheckpoint:
+    """单个品种的下载进度: 每个窗口的数据写入独立的分块文件, 完成后记录到 checkpoint.json
+
+    checkpoint.json 同时记录已写入列式存储的分块 (文件名 -> 写入时的修改时间), 重新运行时只写入新的或被重新下载过的分块。
+    """
+
+    def __init__(self, out_dir, symbol, bar_size, what_to_show):
+        self.directory = os.path.join(out_dir, symbol)
+        self.chunk_dir = os.path.join(self.directory, 'chunks')
+        self.path = os.path.join(self.directory, 'checkpoint.json')
+        os.makedirs(self.chunk_dir, exist_ok=True)
+        self.state = {'symbol': symbol, 'bar_size': bar_size, 'what_to_show': what_to_show, 'done': {}, 'ingested': {}}
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                saved = json.load(f)
+            # K 线周期或数据类型变了, 旧的分块不能复用
+            if saved.get('bar_size') == bar_size and saved.get('what_to_show') == what_to_show:
+                self.state = saved
+                self.state.setdefault('ingested', {})
+
+    @staticmethod
+    def key(window_start):
+        return window_start.strftime('%Y%m%dT%H%M%S')
+
+    def is_done(self, window_start, window_end):
+        """窗口是否已被某个已完成的分块覆盖; 窗口长度 (--chunk-days 或 MAX_REQUEST_DAYS) 改变后, 旧的分块仍然有效"""
+        if self.key(window_start) in self.state['done']:
+            return True
+        return any(self.key(window_start) >= key and window_end <= datetime.datetime.fromisoformat(done['end'])
+                   for key, done in self.state['done'].items())
+
+    def chunk_path(self, window_start):
+        return os.path.join(self.chunk_dir, f'{self.key(window_start)}.csv')
+
+    def _save(self):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.state, f, indent=1)
+        os.replace(tmp_path, self.path)
+
+    def save_chunk(self, window_start, window_end, df, complete):
+        """写入分块文件; 仅当窗口已完整结束时才记入进度, 当前仍在进行的窗口下次运行会重新下载"""
+        path = self.chunk_path(window_start)
+        tmp_path = path + '.tmp'
+        df.to_csv(tmp_path)
+        os.replace(tmp_path, path)
+        if complete:
+            self.state['done'][self.key(window_start)] = {'end': window_end.isoformat(), 'rows': len(df)}
+            self._save()
+
+    def chunk_files(self):
+        return sorted(os.path.join(self.chunk_dir, name) for name in os.listdir(self.chunk_dir) if name.endswith('.csv'))
+
+    def pending_ingest(self):
+        """尚未写入列式存储, 或写入后又被重新下载 (修改时间变了) 的分块文件"""
+        ingested = self.state['ingested']
+        return [path for path in self.chunk_files() if ingested.get(os.path.basename(path)) != os.stat(path).st_mtime_ns]
+
+    def mark_ingested(self, path):
+        self.state['ingested'][os.path.basename(path)] = os.stat(path).st_mtime_ns
+        self._save()
+
+
+def bars_to_frame(bars, window_start, window_end):
+    """将 BarData 列表转换为以 UTC 时间为索引的 DataFrame, 只保留落在窗口内的 K 线"""
+    df = util.df(bars)
+    if df is None or df.empty:
+        return pd.DataFrame(columns=['open', 'high', 'low', 'close', 'volume', 'average', 'barCount'],
+                            index=pd.DatetimeIndex([], tz=utc, name='date'))
+    df['date'] = pd.to_datetime(df['date'], utc=True)
+    df = df.set_index('date')
+    return df[(df.index >= window_start) & (df.index < window_end)]
+
+
+def is_confirmed_empty(error):
+    """网关明确答复窗口内没有数据 (HMDS query returned no data), 区别于限速违规、超时等失败"""
+    return isinstance(error, RequestError) and error.code == 162 and 'no data' in error.message.lower()
+
+
+def is_rejected(error):
+    """网关拒绝了请求本身 (如跨度对该 K 线周期过大), 区别于无数据答复和限速违规; 原样重试没有意义"""
+    return (isinstance(error, RequestError) and not is_confirmed_empty(error)
+            and 'pacing' not in error.message.lower())
+
+
+async def request_bars(ib, contract, window_start, window_end, args, global_pacing, contract_pacing, in_flight, pbar):
+    """在限速与并发许可内请求一个时间段, 失败时退避重试; 返回 (bars, error)
+
+    请求被拒绝 (is_rejected) 时不重试, 直接返回, 由调用方拆分窗口。
+    """
+    delay = RETRY_BACKOFF_SECONDS
+    for attempt in range(REQUEST_RETRIES + 1):
+        async with in_flight:
+            await global_pacing.acquire()
+            await contract_pacing.acquire()
+            started = time.monotonic()
+            try:
+                bars = await ib.reqHistoricalDataAsync(
+                    contract,
+                    endDateTime=window_end,
+                    durationStr=format_duration(window_start, window_end),
+                    barSizeSetting=args.bar_size,
+                    whatToShow=args.what_to_show,
+                    useRTH=True,
+                    formatDate=2,
+                    timeout=args.timeout,
+                )
+                error = None
+                # 请求超时时 ib_insync 不抛异常, 而是返回空列表
+                if not bars and args.timeout and time.monotonic() - started >= args.timeout:
+                    error = asyncio.TimeoutError(f'{args.timeout:g} 秒内未返回')
+            except Exception as e:
+                bars, error = [], e
+        # 没有报错的空结果 (正常结束但无 K 线) 或 HMDS 的无数据答复才视为窗口内确实没有交易 (节假日、上市前)
+        confirmed_empty = not bars and (error is None or is_confirmed_empty(error))
+        if bars or confirmed_empty or is_rejected(error) or attempt == REQUEST_RETRIES:
+            break
+        pbar.write(f"  ! {contract.symbol} {window_start:%Y-%m-%d} ~ {window_end:%Y-%m-%d} 未获取到数据"
+                   f"{f' ({error})' if error else ''}, {delay} 秒后重试 ({attempt + 1}/{REQUEST_RETRIES})")
+        await asyncio.sleep(delay)
+        delay *= 2
+    return bars, error
+
+
+async def fetch_span(ib, contract, window_start, window_end, args, global_pacing, contract_pacing, in_flight, pbar):
+    """下载一个时间段并转换为 DataFrame; 请求被拒绝时把时间段对半拆分后分别下载再拼接
 
+    任何一部分最终失败都返回 None, 整个窗口不落盘。
+    """
+    bars, error = await request_bars(ib, contract, window_start, window_end, args,
+                                     global_pacing, contract_pacing, in_flight, pbar)
+    if not bars and is_rejected(error) and window_end - window_start > MIN_SPLIT_SPAN:
+        middle = window_start + (window_end - window_start) / 2
+        pbar.write(f"  ! {contract.symbol} {window_start:%Y-%m-%d} ~ {window_end:%Y-%m-%d} 请求被拒绝 ({error}), 拆分为两半重试")
+        parts = []
+        for start, end in ((window_start, middle), (middle, window_end)):
+            part = await fetch_span(ib, contract, start, end, args, global_pacing, contract_pacing, in_flight, pbar)
+            if part is None:
+                return None
+            parts.append(part)
+        return pd.concat(parts)
+    if not bars and not (error is None or is_confirmed_empty(error)):
+        pbar.write(f"  ! {contract.symbol} {window_start:%Y-%m-%d} ~ {window_end:%Y-%m-%d} 获取失败: {error}")
+        return None
+    return bars_to_frame(bars, window_start, window_end)
+
+
+async def fetch_window(ib, contract, window, args, checkpoint, global_pacing, contract_pacing, in_flight, pbar):
+    """下载单个窗口 (必要时拆分为更小的请求), 拿到数据或确认无数据后立即落盘
+
+    重试用完仍失败的窗口不写分块也不记入进度, 下次运行时重新下载。拆分后的数据仍按对齐的窗口起点写入同一个分块。
+    """
+    key, window_start, window_end, complete = window
+    df = await fetch_span(ib, contract, window_start, window_end, args, global_pacing, contract_pacing, in_flight, pbar)
+    if df is None:
+        pbar.write(f"  ! {contract.symbol} {window_start:%Y-%m-%d} ~ {window_end:%Y-%m-%d} 未记入进度, 下次运行时重新下载")
+        pbar.update(1)
+        return 0
+    checkpoint.save_chunk(key, window_end, df, complete)
+    if len(df):
+        pbar.write(f"  > {contract.symbol} {df.index[0]:%Y-%m-%d %H:%M} ~ {df.index[-1]:%Y-%m-%d %H:%M}: {len(df)} 条 K 线")
+    pbar.update(1)
+    return len(df)
+
+
+def merge_chunks(checkpoint, output_filename, start_date):
+    """按时间顺序把分块文件逐个追加到一个 CSV, 不在内存中拼接全部数据
+
+    窗口长度改变过时新旧分块可能重叠, 只追加晚于已写入最后一条的 K 线。
+    """
+    rows = 0
+    tmp_path = output_filename + '.tmp'
+    header = True
+    last = None
+    for path in checkpoint.chunk_files():
+        df = pd.read_csv(path, index_col='date', parse_dates=['date'])
+        df = df[df.index >= start_date if last is None else df.index > last]
+        if df.empty:
+            continue
+        last = df.index[-1]
+        df.to_csv(tmp_path, mode='w' if header else 'a', header=header)
+        header = False
+        rows += len(df)
+    if rows:
+        os.replace(tmp_path, output_filename)
+    return rows
+
+
+async def download(ib, args):
+    end_date = datetime.datetime.now(utc).replace(second=0, microsecond=0)
+    start_date = end_date - datetime.timedelta(days=args.years * 365)
+    chunk_days = args.chunk_days or MAX_REQUEST_DAYS[args.bar_size]
+    # 请求出错 (限速违规、无数据等) 时抛出 RequestError 而不是静默返回空列表, 以便区分失败与确实无数据
+    ib.RaiseRequestErrors = True
+
+    global_pacing = PacingLimiter(args.pacing_requests, args.pacing_window)
+    in_flight = asyncio.Semaphore(args.max_in_flight)
+    jobs, checkpoints = [], {}
+
+    for symbol in args.symbols:
+        contract = Stock(symbol, 'SMART', 'USD')
+        await ib.qualifyContractsAsync(contract)
+        checkpoint = SymbolCheckpoint(args.out_dir, symbol, args.bar_size, args.what_to_show)
+        checkpoints[symbol] = checkpoint
+
+        # 从最早可用时间开始切窗口, 避免对上市前的时间段发出注定为空的请求
+        symbol_start = start_date
+        try:
+            head = await ib.reqHeadTimeStampAsync(contract, whatToShow=args.what_to_show, useRTH=True, formatDate=2)
+            if isinstance(head, datetime.datetime):
+                symbol_start = max(start_date, head.astimezone(utc))
         except Exception as e:
-            print(f"\n获取数据时发生错误: {e}")
-            time.sleep(30)
-            current_end_date = current_end_date - datetime.timedelta(days=1)
+            print(f"获取 {symbol} 最早数据时间失败: {e}")
+
+        windows = build_windows(symbol_start, end_date, chunk_days)
+        pending = [w for w in windows if not checkpoint.is_done(w[0], w[2])]
+        print(f"{symbol}: 共 {len(windows)} 个窗口 (每个 {chunk_days} 天), 已完成 {len(windows) - len(pending)} 个, 待下载 {len(pending)} 个。")
+        contract_pacing = PacingLimiter(PACING_CONTRACT_MAX_REQUESTS, PACING_CONTRACT_WINDOW_SECONDS)
+        # 从最近的窗口开始下载, 中断时优先保住最新的数据
+        jobs.extend((contract, w, contract_pacing) for w in reversed(pending))
+
+    custom_bar_format = '{desc}: {percentage:.0f}%|{bar}| {n_fmt}/{total_fmt} [{elapsed}<{remaining}, {rate_fmt}]'
+    with tqdm(total=len(jobs), desc="数据获取中", bar_format=custom_bar_format) as pbar:
+        await asyncio.gather(*(
+            fetch_window(ib, contract, window, args, checkpoints[contract.symbol], global_pacing, contract_pacing, in_flight, pbar)
+            for contract, window, contract_pacing in jobs
+        ))
+
+    store = BarStore(store_root(args.bar_size, args.store_dir))
+    for symbol, checkpoint in checkpoints.items():
+        rows = 0
+        pending = checkpoint.pending_ingest()
+        for path in pending:
+            rows += store.write(symbol, pd.read_csv(path, index_col='date'))
+            checkpoint.mark_ingested(path)
+        if not checkpoint.chunk_files():
+            print(f"未能获取到任何 {symbol} 历史数据。")
             continue
+        if pending:
+            print(f"成功获取 {rows} 条 {symbol} K线数据 ({len(pending)} 个新分块), 已写入列式存储 {store.root}")
+        else:
+            print(f"{symbol} 没有新的分块需要写入列式存储。")
+        if args.csv:
+            output_filename = os.path.join(args.out_dir, f'{symbol}_{args.years}_year_{args.bar_size.replace(" ", "_")}_data.csv')
+            merge_chunks(checkpoint, output_filename, start_date)
+            print(f"数据已另存为 {output_filename}")
 
-# 将数据转换为 Pandas DataFrame
-if all_bars:
-    df = util.df(all_bars)
-    df['date'] = pd.to_datetime(df['date'])
-    df = df.set_index('date')
-    df.index = df.index.tz_convert(utc)
-    df = df[df.index >= start_date]
-
-    print(f"\n成功获取 {len(df)} 条 QQQ 1分钟K线数据。")
-    print(df.head())
-    print(df.tail())
-
-    output_filename = 'QQQ_5_year_1_minute_data.csv'
-    df.to_csv(output_filename)
-    print(f"数据已保存到 {output_filename}")
-else:
-    print("\n未能获取到任何 QQQ 历史数据。")
-
-# 断开连接
-ib.disconnect()
-print("已断开与 IB API 的连接。")
\ No newline at end of file
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='按限速规则并发下载 IBKR 历史 K 线, 支持断点续传')
+    parser.add_argument('symbols', nargs='*', default=['QQQ'], help='股票代码列表 (默认 QQQ)')
+    parser.add_argument('--years', type=int, default=5, help='下载最近多少年的数据')
+    parser.add_argument('--bar-size', default='1 min', choices=sorted(MAX_REQUEST_DAYS), help='K 线周期')
+    parser.add_argument('--what-to-show', default='TRADES')
+    parser.add_argument('--chunk-days', type=int, default=None, help='单次请求的跨度 (天), 默认取文档给出的该周期最长跨度 (MAX_REQUEST_DAYS); 被拒绝时自动拆分')
+    parser.add_argument('--out-dir', default='data/bars', help='分块文件、进度文件及合并 CSV 的目录')
+    parser.add_argument('--store-dir', default=STORE_BASE_DIR, help='按品种/月份分区的列式存储目录 (参见 bar_store.py)')
+    parser.add_argument('--csv', action='store_true', help='同时输出合并后的单个 CSV 文件')
+    parser.add_argument('--max-in-flight', type=int, default=MAX_IN_FLIGHT_REQUESTS)
+    parser.add_argument('--pacing-requests', type=int, default=PACING_MAX_REQUESTS)
+    parser.add_argument('--pacing-window', type=float, default=PACING_WINDOW_SECONDS)
+    parser.add_argument('--timeout', type=float, default=600, help='单个请求的超时时间 (秒)')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=7496)
+    parser.add_argument('--client-id', type=int, default=30)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+
+    # 连接到 IB Gateway 或 TWS
+    ib = IB()
+    print("尝试连接到 IB Gateway/TWS...")
+    try:
+        ib.connect(args.host, args.port, clientId=args.client_id)
+        print("成功连接到 IB Gateway/TWS。")
+    except Exception as e:
+        print(f"连接失败: {e}")
+        print("请确保 IB Gateway 或 TWS 正在运行，并且 API 端口已启用。")
+        return
+
+    try:
+        ib.run(download(ib, args))
+    finally:
+        # 断开连接
+        ib.disconnect()
+        print("已断开与 IB API 的连接。")
+
+
+if __name__ == '__main__':
+    main()
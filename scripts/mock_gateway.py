@@ -0,0 +1,244 @@
+import argparse
+import collections
+import datetime
+import random
+import threading
+import time
+
+from flask import Flask, jsonify, request
+from werkzeug.serving import WSGIRequestHandler, make_server
+
+# 本地模拟的 Client Portal 网关: 实现 app/main.py 用到的接口, 账户数、持仓数、延迟和错误注入均可配置,
+# 用于在没有真实 IBKR 网关和账户的情况下做性能测试。启动后设置
+#   IBKR_GATEWAY_URL=http://127.0.0.1:<端口>/v1/api/
+# 即可让主程序连接到这里。
+
+POSITIONS_PAGE_SIZE = 100
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+    """不输出每个请求的访问日志, 避免压测时刷屏"""
+
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+class MockGatewayConfig:
+    """模拟网关的行为参数"""
+
+    def __init__(self, accounts=3, positions=50, latency_ms=20.0, jitter_ms=10.0, error_rate=0.0,
+                 throttle_rate=0.0, performance_latency_ms=500.0, history_days=365, cold_snapshots=False, seed=0):
+        self.accounts = accounts
+        self.positions = positions
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.performance_latency_ms = performance_latency_ms
+        self.history_days = history_days
+        self.cold_snapshots = cold_snapshots
+        self.seed = seed
+
+
+class MockGateway:
+    """模拟网关的数据与调用统计; create_app() 返回挂载了全部接口的 Flask 应用"""
+
+    def __init__(self, config):
+        self.config = config
+        self._rng = random.Random(config.seed)
+        self._lock = threading.Lock()
+        self.calls = collections.Counter()
+        self.errors = collections.Counter()
+        self._warmed = set()
+        self.account_ids = [f'U{1000000 + i}' for i in range(config.accounts)]
+        # 每个账户的持仓从同一个合约池中取, 使聚合视图里有跨账户的同一合约
+        pool_size = max(config.positions * 2, 1)
+        self.contracts = {conid: {'price': 20 + self._rng.random() * 480, 'desc': f'SYM{conid}'}
+                          for conid in range(100001, 100001 + pool_size)}
+        conids = list(self.contracts)
+        self.positions = {
+            account_id: [self._position(conid) for conid in self._rng.sample(conids, min(config.positions, len(conids)))]
+            for account_id in self.account_ids
+        }
+
+    def _position(self, conid):
+        contract = self.contracts[conid]
+        quantity = self._rng.randint(1, 500)
+        avg_cost = round(contract['price'] * (0.7 + self._rng.random() * 0.6), 4)
+        return {'conid': conid, 'contractDesc': contract['desc'], 'assetClass': 'STK', 'currency': 'USD',
+                'position': quantity, 'avgCost': avg_cost, 'mktPrice': contract['price'],
+                'mktValue': round(quantity * contract['price'], 2)}
+
+    def _simulate(self, endpoint, latency_ms=None):
+        """记录调用并模拟延迟; 按配置的比例返回 429/500 错误响应, 正常时返回 None"""
+        with self._lock:
+            self.calls[endpoint] += 1
+            roll = self._rng.random()
+        latency = self.config.latency_ms if latency_ms is None else latency_ms
+        delay = max(0.0, latency + self._rng.uniform(-self.config.jitter_ms, self.config.jitter_ms)) / 1000
+        if delay:
+            time.sleep(delay)
+        if roll < self.config.throttle_rate:
+            with self._lock:
+                self.errors[f'{endpoint} 429'] += 1
+            response = jsonify({'error': 'rate limited'})
+            response.status_code = 429
+            response.headers['Retry-After'] = '1'
+            return response
+        if roll < self.config.throttle_rate + self.config.error_rate:
+            with self._lock:
+                self.errors[f'{endpoint} 500'] += 1
+            response = jsonify({'error': 'internal error'})
+            response.status_code = 500
+            return response
+        return None
+
+    def stats(self):
+        with self._lock:
+            return {'calls': dict(self.calls), 'errors': dict(self.errors), 'total_calls': sum(self.calls.values())}
+
+    def reset_stats(self):
+        with self._lock:
+            self.calls.clear()
+            self.errors.clear()
+
+    def _snapshot(self, conid):
+        contract = self.contracts.get(conid)
+        if contract is None:
+            return {'conid': conid}
+        if self.config.cold_snapshots:
+            # 与真实网关一样, 首次请求的 conid 只建立订阅, 不返回价格字段
+            with self._lock:
+                cold = conid not in self._warmed
+                self._warmed.add(conid)
+            if cold:
+                return {'conid': conid}
+        # 价格在基准价附近随机游走, 使每次轮询都有变化
+        price = contract['price'] * (1 + self._rng.uniform(-0.002, 0.002))
+        contract['price'] = price
+        return {'conid': conid, '31': f'{price:.2f}', '83': f'{self._rng.uniform(-3, 3):.2f}'}
+
+    def _cumulative_returns(self, account_id, period):
+        days = {'7D': 7, '1M': 28, '3M': 89, '6M': 180, '12M': 364}.get(period, self.config.history_days)
+        rng = random.Random(f'{self.config.seed}-{account_id}')
+        end = datetime.date.today()
+        dates, returns, value = [], [], 1.0
+        for offset in range(days, -1, -1):
+            day = end - datetime.timedelta(days=offset)
+            if day.weekday() >= 5:
+                continue
+            dates.append(day.strftime('%Y%m%d'))
+            returns.append(value - 1)
+            value *= 1 + rng.gauss(0.0004, 0.01)
+        return dates, returns
+
+    def create_app(self):
+        app = Flask(__name__)
+
+        @app.route('/v1/api/iserver/auth/status', methods=['GET', 'POST'])
+        def auth_status():
+            return self._simulate('iserver/auth/status') or jsonify({'authenticated': True, 'connected': True, 'competing': False})
+
+        @app.route('/v1/api/portfolio/accounts')
+        def accounts():
+            return self._simulate('portfolio/accounts') or jsonify([{'accountId': a, 'id': a} for a in self.account_ids])
+
+        @app.route('/v1/api/portfolio/<account_id>/summary')
+        def summary(account_id):
+            error = self._simulate('portfolio/{id}/summary')
+            if error:
+                return error
+            positions = self.positions.get(account_id, [])
+            market_value = sum(p['mktValue'] for p in positions)
+            cash = 10000.0
+            return jsonify({
+                'netliquidation': {'amount': market_value + cash, 'currency': 'USD'},
+                'realizedpnl': {'amount': 0.0, 'currency': 'USD'},
+                'cashbalance': {'amount': cash, 'currency': 'USD'},
+                'buyingpower': {'amount': cash * 4, 'currency': 'USD'},
+            })
+
+        @app.route('/v1/api/portfolio/<account_id>/positions/<int:page>')
+        def positions(account_id, page):
+            error = self._simulate('portfolio/{id}/positions')
+            if error:
+                return error
+            rows = self.positions.get(account_id, [])
+            return jsonify(rows[page * POSITIONS_PAGE_SIZE:(page + 1) * POSITIONS_PAGE_SIZE])
+
+        @app.route('/v1/api/iserver/marketdata/snapshot')
+        @app.route('/v1/api/md/snapshot')
+        def snapshot():
+            error = self._simulate('md/snapshot')
+            if error:
+                return error
+            conids = [int(c) for c in request.args.get('conids', '').split(',') if c.strip().isdigit()]
+            return jsonify([self._snapshot(conid) for conid in conids])
+
+        @app.route('/v1/api/pa/performance', methods=['POST'])
+        def performance():
+            error = self._simulate('pa/performance', self.config.performance_latency_ms)
+            if error:
+                return error
+            payload = request.get_json(silent=True) or {}
+            account_ids = payload.get('acctIds', [])
+            dates, data = [], []
+            for account_id in account_ids:
+                dates, returns = self._cumulative_returns(account_id, payload.get('period'))
+                data.append({'id': account_id, 'returns': returns})
+            return jsonify({'cps': {'dates': dates, 'data': data}})
+
+        @app.route('/mock/stats')
+        def mock_stats():
+            return jsonify(self.stats())
+
+        @app.route('/mock/reset', methods=['POST'])
+        def mock_reset():
+            self.reset_stats()
+            return jsonify({'status': 'ok'})
+
+        return app
+
+
+def serve_in_background(gateway, host='127.0.0.1', port=0):
+    """在后台线程中启动模拟网关, 返回 (server, base_url); port=0 时自动选择空闲端口"""
+    server = make_server(host, port, gateway.create_app(), threaded=True, request_handler=QuietRequestHandler)
+    thread = threading.Thread(target=server.serve_forever, name='mock-gateway', daemon=True)
+    thread.start()
+    return server, f'http://{host}:{server.server_port}/v1/api/'
+
+
+def add_config_arguments(parser):
+    parser.add_argument('--accounts', type=int, default=3, help='模拟的账户数')
+    parser.add_argument('--positions', type=int, default=50, help='每个账户的持仓数')
+    parser.add_argument('--latency-ms', type=float, default=20.0, help='每个接口的平均延迟 (毫秒)')
+    parser.add_argument('--jitter-ms', type=float, default=10.0, help='延迟的随机抖动范围 (毫秒)')
+    parser.add_argument('--performance-latency-ms', type=float, default=500.0, help='/pa/performance 的平均延迟 (毫秒)')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='返回 500 的请求比例')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='返回 429 的请求比例')
+    parser.add_argument('--cold-snapshots', action='store_true', help='首次请求的 conid 不返回价格字段 (模拟订阅预热)')
+    parser.add_argument('--seed', type=int, default=0)
+
+
+def config_from_args(args):
+    return MockGatewayConfig(accounts=args.accounts, positions=args.positions, latency_ms=args.latency_ms,
+                             jitter_ms=args.jitter_ms, error_rate=args.error_rate, throttle_rate=args.throttle_rate,
+                             performance_latency_ms=args.performance_latency_ms, cold_snapshots=args.cold_snapshots,
+                             seed=args.seed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='本地模拟的 IBKR Client Portal 网关')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5001)
+    add_config_arguments(parser)
+    args = parser.parse_args()
+
+    gateway = MockGateway(config_from_args(args))
+    print(f"模拟网关已启动: {len(gateway.account_ids)} 个账户, 每个账户 {args.positions} 条持仓")
+    print(f"使用方式: IBKR_GATEWAY_URL=http://{args.host}:{args.port}/v1/api/ python app/main.py")
+    make_server(args.host, args.port, gateway.create_app(), threaded=True).serve_forever()
+
+
+if __name__ == '__main__':
+    main()
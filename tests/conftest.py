@@ -0,0 +1,12 @@
+import os
+import sys
+import tempfile
+
+# 测试使用临时的持久化文件并关闭日志, 在导入 app.main 之前设置
+_data_dir = tempfile.mkdtemp(prefix='ibkr-tests-')
+os.environ.setdefault('IBKR_PERFORMANCE_DB', os.path.join(_data_dir, 'performance.sqlite3'))
+os.environ.setdefault('IBKR_SHARED_CACHE_DB', os.path.join(_data_dir, 'shared_cache.sqlite3'))
+os.environ.setdefault('IBKR_LOG_FORMAT', 'off')
+os.environ.setdefault('IBKR_GATEWAY_URL', 'http://127.0.0.1:9/v1/api/')
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
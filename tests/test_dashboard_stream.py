@@ -0,0 +1,59 @@
+import concurrent.futures
+import json
+import threading
+
+from app import main
+
+
+def record(conid, position):
+    return main.PositionRecord(conid, f'C{conid}', 'STK', 'USD', position, 1.0, float(position))
+
+
+ACCOUNTS = {
+    'S1': [record(1, 10), record(2, 5)],
+    'S2': [record(1, 20)],
+    'S3': [record(3, 7)],
+}
+
+
+def install_accounts(monkeypatch, arrival_order):
+    delays = {account_id: 0.02 * i for i, account_id in enumerate(arrival_order)}
+
+    def fake_fetch(account_id, include_performance=True, include_raw=False):
+        future = concurrent.futures.Future()
+        data = {'summary': {'net_liquidation': 1.0, 'realized_pnl': 0.0, 'cash': 0.0, 'buying_power': 0.0, 'currency': 'USD'},
+                'positions': ACCOUNTS[account_id], 'incomplete': False}
+        threading.Timer(delays[account_id], lambda: future.set_result((account_id, data))).start()
+        return future
+
+    monkeypatch.setattr(main, 'get_cached_account_ids', lambda: list(ACCOUNTS))
+    monkeypatch.setattr(main, 'fetch_account_data_async', fake_fetch)
+    monkeypatch.setattr(main, 'refresh_performance_batch', lambda account_ids: {})
+
+
+def load(client):
+    return [json.loads(line) for line in client.get('/api/dashboard/stream').data.splitlines()]
+
+
+def test_aggregate_table_sent_once_and_cached_across_arrival_orders(monkeypatch):
+    monkeypatch.setattr(main, 'fragment_cache', main.FragmentCache(64))
+    rendered = []
+    render_fragment = main.render_fragment
+
+    def counting_render(name, *args):
+        rendered.append(name)
+        return render_fragment(name, *args)
+    monkeypatch.setattr(main, 'render_fragment', counting_render)
+    client = main.app.test_client()
+
+    install_accounts(monkeypatch, ['S1', 'S2', 'S3'])
+    first = load(client)
+    aggregates = [m for m in first if m['type'] == 'aggregate']
+    assert len(aggregates) == 1
+    assert all('table-view-all' not in m.get('summary_html', '') for m in first if m['type'] == 'account')
+    assert 'S1: <strong>10.0</strong>' in aggregates[0]['table_html']
+
+    install_accounts(monkeypatch, ['S3', 'S2', 'S1'])
+    second = load(client)
+    assert [m for m in second if m['type'] == 'aggregate'] == aggregates
+    assert rendered.count('aggregate_table') == 1
@@ -0,0 +1,81 @@
+import threading
+import time
+
+from app import main
+
+DOWN = {'reachable': False, 'connected': False, 'authenticated': False}
+UP = {'reachable': True, 'connected': False, 'authenticated': False}
+
+
+class FakeCheck:
+    def __init__(self, status):
+        self.status = status
+        self.times = []
+        self.lock = threading.Lock()
+
+    def __call__(self):
+        with self.lock:
+            self.times.append(time.monotonic())
+            return dict(self.status)
+
+    def gaps(self):
+        with self.lock:
+            return [b - a for a, b in zip(self.times, self.times[1:])]
+
+
+def test_reads_do_not_reset_backoff():
+    check = FakeCheck(DOWN)
+    monitor = main.GatewayHealthMonitor(check, interval=10, min_interval=0.02, max_backoff=0.16)
+    deadline = time.monotonic() + 0.6
+    while time.monotonic() < deadline:
+        assert monitor.status() == DOWN
+        time.sleep(0.001)
+    gaps = check.gaps()
+    assert len(check.times) <= 8
+    assert all(later >= earlier * 0.9 for earlier, later in zip(gaps, gaps[1:]))
+    assert max(gaps) >= 0.15
+
+
+def test_state_change_resets_backoff():
+    check = FakeCheck(DOWN)
+    monitor = main.GatewayHealthMonitor(check, interval=10, min_interval=0.02, max_backoff=0.16)
+    monitor.status()
+    time.sleep(0.5)
+    check.status = UP
+    status = monitor.wait_until(lambda s: s['reachable'], timeout=2)
+    assert status['reachable']
+    changed_at = len(check.times)
+    time.sleep(0.1)
+    gaps = check.gaps()[changed_at - 1:]
+    assert gaps and gaps[0] < 0.05
+
+
+def test_watched_polls_cap_interval():
+    check = FakeCheck(DOWN)
+    monitor = main.GatewayHealthMonitor(check, interval=10, min_interval=0.02, max_backoff=0.5, watch_seconds=0.3)
+    monitor.status()
+    time.sleep(0.8)
+    before = len(check.times)
+    # 退避已增长到上限; 开始轮询后应立即回到 min_interval, 且多个轮询方不会增加检查次数
+    deadline = time.monotonic() + 0.4
+    while time.monotonic() < deadline:
+        assert monitor.status(watch=True) == DOWN
+        time.sleep(0.001)
+    watched = check.gaps()[before:]
+    assert watched and max(watched) < 0.1
+    assert len(check.times) - before <= 0.4 / 0.02 + 2
+    # 停止轮询超过 watch_seconds 后恢复长退避
+    time.sleep(1.0)
+    assert check.gaps()[-1] >= 0.4
+
+
+def test_wait_until_caps_interval():
+    check = FakeCheck(DOWN)
+    monitor = main.GatewayHealthMonitor(check, interval=10, min_interval=0.02, max_backoff=5.0, watch_seconds=0)
+    monitor.status()
+    time.sleep(0.5)
+    threading.Timer(0.3, lambda: setattr(check, 'status', UP)).start()
+    started = time.monotonic()
+    status = monitor.wait_until(lambda s: s['reachable'], timeout=2)
+    assert status['reachable']
+    assert time.monotonic() - started < 0.5
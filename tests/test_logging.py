@@ -0,0 +1,41 @@
+import io
+import json
+import logging
+
+import pytest
+
+from app import main
+
+
+@pytest.fixture
+def log_output():
+    stream = io.StringIO()
+    handler = logging.StreamHandler(stream)
+    handler.setFormatter(main.JsonLogFormatter())
+    main.logger.addHandler(handler)
+    main.logger.setLevel(logging.INFO)
+    yield stream
+    main.configure_logging()
+
+
+def entries(stream, *events):
+    # 其他测试启动的后台线程 (如网关健康检查) 也可能在此期间写日志, 只取关心的事件
+    return [entry for entry in map(json.loads, stream.getvalue().splitlines()) if entry['event'] in events]
+
+
+def test_event_and_fields_are_emitted_as_json(log_output):
+    main.log_event('account_fetch_done', '完成获取账户的数据', account='U1', positions=3)
+    [entry] = entries(log_output, 'account_fetch_done')
+    assert entry['event'] == 'account_fetch_done'
+    assert entry['msg'] == '完成获取账户的数据'
+    assert entry['level'] == 'info'
+    assert entry['account'] == 'U1' and entry['positions'] == 3
+
+
+def test_level_filtering(log_output):
+    main.logger.setLevel(logging.WARNING)
+    main.log_event('quiet', '不输出')
+    # 与 LogRecord 自带属性同名的字段也能原样输出
+    main.log_event('loud', '输出', level='error', name='x', module='y')
+    lines = entries(log_output, 'quiet', 'loud')
+    assert [(e['event'], e['level'], e['name'], e['module']) for e in lines] == [('loud', 'error', 'x', 'y')]
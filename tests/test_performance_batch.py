@@ -0,0 +1,115 @@
+import datetime
+import re
+
+import pytest
+
+from app import main
+
+
+class FakeResponse:
+    def __init__(self, payload):
+        self.payload = payload
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return self.payload
+
+
+def missing_count(reason):
+    match = re.search(r'^ibkr_performance_missing_total\{reason="%s"\} (\S+)$' % reason, main.metrics.render(), re.M)
+    return float(match.group(1)) if match else 0.0
+
+
+def install_response(monkeypatch, payload):
+    posted = []
+
+    def fake_post(path, json=None, **kwargs):
+        posted.append(json)
+        return FakeResponse(payload)
+
+    monkeypatch.setattr(main.gateway, 'post', fake_post)
+    return posted
+
+
+def test_mismatched_account_is_skipped_and_reported_missing(monkeypatch):
+    install_response(monkeypatch, {'cps': {
+        'dates': ['20240103', '20240101', '20240102'],
+        'data': [{'id': 'U1', 'returns': [0.03, 0.01, 0.02]},
+                 {'id': 'U2', 'returns': [0.05, 0.06]}],
+    }})
+    before = missing_count('mismatch')
+    fetched = main._fetch_accounts(['U1', 'U2'], None)
+    assert fetched == {'U1': (['20240101', '20240102', '20240103'], [0.01, 0.02, 0.03])}
+    assert missing_count('mismatch') == before + 1
+
+
+def test_failed_batch_reports_all_accounts_missing(monkeypatch):
+    install_response(monkeypatch, {'cps': {'dates': [], 'data': []}})
+    before = missing_count('error')
+    assert main._fetch_accounts(['U1', 'U2'], None) == {}
+    assert missing_count('error') == before + 2
+
+
+def test_every_account_gets_data_from_a_single_request(monkeypatch):
+    account_ids = [f'UB{i:03d}' for i in range(12)]
+    posted = install_response(monkeypatch, {'cps': {
+        'dates': ['20240101', '20240102'],
+        'data': [{'id': account_id, 'returns': [0.0, 0.01]} for account_id in account_ids],
+    }})
+    result = main.refresh_performance_batch(account_ids)
+    assert sorted(result) == account_ids
+    assert [payload['acctIds'] for payload in posted] == [account_ids]
+
+
+def test_stale_accounts_share_one_request_with_the_longest_period(monkeypatch):
+    today = datetime.date.today()
+    day = lambda offset: (today - datetime.timedelta(days=offset)).strftime('%Y%m%d')
+    monkeypatch.setattr(main, 'PERFORMANCE_REFRESH_MINUTES', 0)
+    main.performance_store.save('UP1', [day(5), day(3)], [0.0, 0.1])
+    main.performance_store.save('UP2', [day(42), day(40)], [0.0, 0.2])
+    dates = [day(offset) for offset in range(60, -1, -1)]
+    posted = install_response(monkeypatch, {'cps': {
+        'dates': dates,
+        'data': [{'id': account_id, 'returns': [0.0] * len(dates)} for account_id in ('UP1', 'UP2')],
+    }})
+    result = main.refresh_performance_batch(['UP1', 'UP2'])
+    assert posted == [{'acctIds': ['UP1', 'UP2'], 'period': '3M'}]
+    assert sorted(result) == ['UP1', 'UP2']
+
+
+def test_history_endpoint_never_calls_the_gateway(monkeypatch):
+    posted = install_response(monkeypatch, {'cps': {'dates': [], 'data': []}})
+    main.performance_store.save('UH1', ['20240101', '20240102'], [0.0, 0.01])
+    client = main.app.test_client()
+    assert client.get('/api/history/UH1').status_code == 200
+    assert client.get('/api/history/UH404').status_code == 404
+    assert posted == []
+
+
+def test_incremental_period_is_rebased_onto_stored_history(monkeypatch):
+    today = datetime.date.today()
+    dates = [(today - datetime.timedelta(days=offset)).strftime('%Y%m%d') for offset in range(9, -1, -1)]
+    growth = [1.0, 1.01, 0.99, 1.02, 1.05, 1.03, 1.04, 1.08, 1.06, 1.1]
+    full = [g - 1 for g in growth]
+    stored_count = 6
+    main.performance_store.save('UR1', dates[:stored_count], full[:stored_count])
+    monkeypatch.setattr(main, 'PERFORMANCE_REFRESH_MINUTES', 0)
+
+    # 区间 (7D) 的累计回报以区间第一天为基准, 第一天为 0
+    period_dates = dates[3:]
+    period_cumulative = [growth[i] / growth[3] - 1 for i in range(3, len(dates))]
+    posted = install_response(monkeypatch, {'cps': {
+        'dates': period_dates, 'data': [{'id': 'UR1', 'returns': period_cumulative}],
+    }})
+    main.refresh_performance_batch(['UR1'])
+    assert posted == [{'acctIds': ['UR1'], 'period': '7D'}]
+
+    stored_dates, stored_cumulative, _ = main.performance_store.load('UR1')
+    assert stored_dates == dates
+    assert stored_cumulative == pytest.approx(full)
+
+
+def test_rebase_without_overlap_returns_none():
+    assert main.rebase_cumulative_returns(['20240101'], [0.1], ['20240105', '20240106'], [0.0, 0.01]) is None
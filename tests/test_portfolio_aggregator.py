@@ -0,0 +1,64 @@
+import pytest
+
+from app import main
+
+
+def record(conid, position, cost_basis, desc=None):
+    return main.PositionRecord(conid, desc or f'C{conid}', 'STK', 'USD', position, cost_basis / position, cost_basis)
+
+
+def account(positions, net_liquidation=100.0):
+    summary = {'net_liquidation': net_liquidation, 'realized_pnl': 0.0, 'cash': 10.0, 'buying_power': 0.0, 'currency': 'USD'}
+    return {'summary': summary, 'positions': positions}
+
+
+def rows(result):
+    return {p.conid: (p.position, p.costBasis, p.holdings_breakdown) for p in result['positions']}
+
+
+def test_running_totals_follow_account_updates():
+    aggregator = main.PortfolioAggregator()
+    aggregator.update_account('A', account([record(1, 10, 100.0), record(2, 5, 50.0)]))
+    aggregator.update_account('B', account([record(1, 20, 300.0)], net_liquidation=200.0))
+    result = aggregator.result(['A', 'B'])
+    assert rows(result) == {1: (30, 400.0, {'A': 10, 'B': 20}), 2: (5, 50.0, {'A': 5})}
+    assert result['summary']['net_liquidation'] == 300.0
+
+    # A 清仓 conid 2 并调整 conid 1: 只替换 A 的贡献
+    aggregator.update_account('A', account([record(1, 4, 40.0)]))
+    result = aggregator.result(['A', 'B'])
+    assert rows(result) == {1: (24, 340.0, {'A': 4, 'B': 20})}
+    assert result['positions'][0].avgCost == pytest.approx(340.0 / 24)
+
+    aggregator.update_account('B', None)
+    assert rows(aggregator.result(['A', 'B'])) == {1: (4, 40.0, {'A': 4})}
+
+
+def test_retain_drops_accounts_no_longer_listed():
+    aggregator = main.PortfolioAggregator()
+    aggregator.update_account('A', account([record(1, 10, 100.0)]))
+    aggregator.update_account('B', account([record(2, 1, 10.0)]))
+    aggregator.retain(['B'])
+    assert rows(aggregator.result(['B'])) == {2: (1, 10.0, {'B': 1})}
+    arrays = aggregator.valuation_input(['B'])
+    assert arrays['conids'].tolist() == ['2']
+    assert arrays['summary']['net_liquidation'] == 100.0
+
+
+def test_incomplete_and_failed_accounts_are_excluded_and_reported():
+    aggregator = main.PortfolioAggregator()
+    aggregator.update_account('A', account([record(1, 10, 100.0)]))
+    aggregator.update_account('B', {**account([record(1, 5, 50.0)], net_liquidation=500.0), 'incomplete': True})
+    aggregator.update_account('C', None)
+    result = aggregator.result(['A', 'B', 'C'])
+    assert rows(result) == {1: (10, 100.0, {'A': 10})}
+    assert result['summary']['net_liquidation'] == 100.0
+    assert result['excluded_accounts'] == ['B', 'C']
+    with main.app.app_context():
+        html = main.render_fragment('aggregate_summary', result)
+    assert '未计入汇总: B, C' in html
+
+    aggregator.update_account('B', account([record(1, 5, 50.0)], net_liquidation=500.0))
+    result = aggregator.result(['A', 'B', 'C'])
+    assert result['excluded_accounts'] == ['C']
+    assert result['summary']['net_liquidation'] == 600.0
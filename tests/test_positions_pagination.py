@@ -0,0 +1,56 @@
+import threading
+
+from app import main
+
+
+def make_positions(count, offset=0):
+    return [{'conid': offset + i, 'position': 1} for i in range(count)]
+
+
+def install_pages(monkeypatch, pages):
+    calls = []
+    lock = threading.Lock()
+
+    def fake_get_account_positions(account_id, page=0):
+        with lock:
+            calls.append(page)
+        return pages(page)
+
+    monkeypatch.setattr(main, 'get_account_positions', fake_get_account_positions)
+    return calls
+
+
+def test_short_account_makes_single_page_call(monkeypatch):
+    calls = install_pages(monkeypatch, lambda page: make_positions(30) if page == 0 else [])
+    positions, complete = main.fetch_position_pages_async('U1').result(timeout=5)
+    assert calls == [0]
+    assert len(positions) == 30
+    assert complete
+
+
+def test_full_first_page_fans_out_until_short_page(monkeypatch):
+    size = main.POSITIONS_PAGE_SIZE
+    counts = {0: size, 1: size, 2: 5}
+    calls = install_pages(monkeypatch, lambda page: make_positions(counts.get(page, 0), page * size))
+    positions, complete = main.fetch_position_pages_async('U1').result(timeout=5)
+    assert complete
+    assert [p['conid'] for p in positions] == list(range(2 * size + 5))
+    assert len(calls) <= 3 + main.POSITIONS_PAGE_CONCURRENCY
+
+
+def test_failed_first_page_stops_pagination(monkeypatch):
+    calls = install_pages(monkeypatch, lambda page: None)
+    positions, complete = main.fetch_position_pages_async('U1').result(timeout=5)
+    assert calls == [0]
+    assert positions == []
+    assert not complete
+
+
+def test_failed_page_stops_scheduling_and_keeps_earlier_pages(monkeypatch):
+    size = main.POSITIONS_PAGE_SIZE
+    calls = install_pages(monkeypatch, lambda page: None if page == 2 else make_positions(size, page * size))
+    positions, complete = main.fetch_position_pages_async('U1').result(timeout=5)
+    assert not complete
+    assert [p['conid'] for p in positions] == list(range(2 * size))
+    assert len(calls) < main.POSITIONS_MAX_PAGES
+    assert max(calls) < 2 + main.POSITIONS_PAGE_CONCURRENCY
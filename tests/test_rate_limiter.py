@@ -0,0 +1,60 @@
+import time
+
+import pytest
+
+from app import main
+
+
+def test_unthrottled_family_is_not_delayed():
+    limiter = main.AdaptiveRateLimiter(None, 0, 8)
+    start = time.monotonic()
+    for _ in range(200):
+        limiter.acquire()
+        limiter.release()
+    assert time.monotonic() - start < 0.1
+
+
+def test_undocumented_endpoints_are_unthrottled():
+    client = main.GatewayClient('http://127.0.0.1:9/v1/api/')
+    for path in ('portfolio/U1/positions/0', 'portfolio/U1/summary', 'iserver/auth/status'):
+        assert client.limiters[main.endpoint_family(path)].rate is None
+    assert client.limiters[main.endpoint_family('portfolio/accounts')].rate == pytest.approx(1 / 5)
+    assert client.limiters[main.endpoint_family('pa/performance')].rate == pytest.approx(1 / 900)
+
+
+def test_throttle_halves_rate_then_recovers_additively():
+    limiter = main.AdaptiveRateLimiter(10.0, 10, 4)
+    limiter.acquire()
+    limiter.release(throttled=True)
+    assert limiter.rate == pytest.approx(5.0)
+    assert limiter.concurrency == 2
+    rates = []
+    while limiter.rate != 10.0:
+        limiter.acquire()
+        limiter.release()
+        rates.append(limiter.rate)
+    assert rates[0] == pytest.approx(5.5)
+    assert len(rates) == 10
+    assert limiter.concurrency == 4
+
+
+def test_unthrottled_family_limits_only_after_429_and_lifts_again():
+    limiter = main.AdaptiveRateLimiter(None, 0, 8)
+    limiter.acquire()
+    limiter.release(throttled=True)
+    assert limiter.rate == pytest.approx(main.GATEWAY_UNLIMITED_FALLBACK_RATE / 2)
+    for _ in range(50):
+        limiter._tokens = 1.0
+        limiter.acquire()
+        limiter.release()
+    assert limiter.rate is None
+
+
+def test_acquire_fails_fast_when_token_is_beyond_timeout():
+    limiter = main.AdaptiveRateLimiter(1 / 900, 1, 1)
+    limiter.acquire(timeout=1)
+    limiter.release()
+    start = time.monotonic()
+    with pytest.raises(main.GatewayRateLimited):
+        limiter.acquire(timeout=5)
+    assert time.monotonic() - start < 0.1
@@ -0,0 +1,39 @@
+from app import main
+
+
+def make_cache(tmp_path, **kwargs):
+    return main.SharedCache(str(tmp_path / 'cache.sqlite3'), 100, **kwargs)
+
+
+def test_l1_hit_skips_sqlite(tmp_path, monkeypatch):
+    cache = make_cache(tmp_path)
+    calls = []
+    cache.get_many_or_compute('ns', ['a'], lambda keys: calls.append(keys) or {'a': 1}, ttl=60)
+
+    def fail_connect():
+        raise AssertionError('L1 命中时不应访问 SQLite')
+    monkeypatch.setattr(cache, '_connect', fail_connect)
+    assert cache.get_many_or_compute('ns', ['a'], lambda keys: {'a': 2}, ttl=60) == {'a': 1}
+    assert calls == [['a']]
+
+
+def test_l1_miss_falls_back_to_sqlite(tmp_path):
+    writer = make_cache(tmp_path)
+    reader = make_cache(tmp_path)
+    writer.get_or_compute('ns', 'a', lambda: {'v': 1}, ttl=60)
+    assert reader.get_or_compute('ns', 'a', lambda: {'v': 2}, ttl=60) == {'v': 1}
+    assert reader.stats()['l1_entries'] == 1
+
+
+def test_l1_respects_entry_expiry(tmp_path):
+    cache = make_cache(tmp_path)
+    cache.get_or_compute('ns', 'a', lambda: 1, ttl=-1)
+    assert cache.get_or_compute('ns', 'a', lambda: 2, ttl=60) == 2
+
+
+def test_l1_is_bounded_and_evictions_use_shared_label_schema(tmp_path):
+    cache = make_cache(tmp_path, l1_max_entries=2)
+    cache.get_many_or_compute('ns', ['a', 'b', 'c'], lambda keys: {k: k for k in keys}, ttl=60)
+    assert cache.stats()['l1_entries'] == 2
+    exported = main.metrics.render()
+    assert 'ibkr_cache_evictions_total{cache="shared_l1",reason="size"}' in exported
@@ -0,0 +1,39 @@
+from app import main
+
+
+def account(positions, incomplete=False, cash=10.0):
+    summary = {'net_liquidation': 0.0, 'realized_pnl': 0.0, 'cash': cash, 'buying_power': 0.0, 'currency': 'USD'}
+    return {'summary': summary, 'positions': positions, 'incomplete': incomplete}
+
+
+def record(conid, position):
+    return main.PositionRecord(conid, f'C{conid}', 'STK', 'USD', position, 1.0, float(position))
+
+
+def test_incomplete_accounts_are_not_recorded_in_net_liq_history():
+    state = main.PortfolioValuationState()
+    aggregator = main.PortfolioAggregator()
+    history = main.NetLiqHistory({'tick': (1, 10)})
+    complete, failed = account([record(1, 10)]), account([], incomplete=True, cash=0.0)
+    for account_id, data in (('V1', complete), ('V2', failed)):
+        state.update_account(account_id, data)
+        aggregator.update_account(account_id, data)
+    state.update_aggregate('all', aggregator.valuation_input(['V1', 'V2']))
+    state.apply_prices({'1': {'price': '2.0', 'change': '0.1'}})
+
+    accounts = state.valuate()['accounts']
+    assert accounts['V1']['fullyPriced']
+    assert not accounts['V2']['fullyPriced']
+    assert not accounts['all']['fullyPriced']
+    history.record(accounts, timestamp=1000)
+    assert history.series('V1', 'tick')['v'] == [30.0]
+    assert history.series('V2', 'tick')['v'] == []
+    assert history.series('all', 'tick')['v'] == []
+
+
+def test_aggregate_is_incomplete_until_every_account_has_loaded():
+    aggregator = main.PortfolioAggregator()
+    aggregator.update_account('V1', account([record(1, 10)]))
+    assert aggregator.valuation_input(['V1', 'V3'])['incomplete']
+    aggregator.update_account('V3', account([]))
+    assert not aggregator.valuation_input(['V1', 'V3'])['incomplete']